@@ -0,0 +1,163 @@
+"""Translates many Python files to Diet Python at once.
+
+diet_python.py works on a single file. This takes a directory (which is
+searched for .py files) or a file listing one path per line, and
+translates every file it finds across a pool of worker processes. The
+results are written to an output directory which mirrors the layout of the
+input, so "-in foo -out bar" turns foo/x/y.py into bar/x/y.py.
+
+A file which can't be translated doesn't stop the run; its error is
+recorded and a summary of the failures is given at the end.
+
+Usage: batch.py -in dir_or_list -out output_dir [-jobs N] [-extra foo]"""
+
+import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
+
+import diet_python
+from python_rewriter.sources import from_path
+
+def common_directory(paths):
+	"""Returns the deepest directory containing every one of the absolute
+	paths. The paths are compared a directory at a time, since comparing
+	characters would make "a/b" the common part of "a/b/x.py" and
+	"a/bc/y.py"."""
+	common = os.path.dirname(paths[0]).split(os.sep)
+	for path in paths[1:]:
+		parts = os.path.dirname(path).split(os.sep)
+		n = 0
+		while n < min(len(common), len(parts)) and common[n] == parts[n]:
+			n += 1
+		common = common[:n]
+	# Absolute paths start with an empty component, before the first
+	# separator, so that's the least we'll have in common
+	return os.sep.join(common) or os.sep
+
+def relative_path(path, directory):
+	"""Returns path relative to directory, which it must be inside (so that
+	its output isn't written outside of the output directory)."""
+	relative = os.path.relpath(path, directory)
+	if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+		raise ValueError(path + ' is not inside ' + directory)
+	return relative
+
+def find_files(in_path):
+	"""Returns a list of (input path, relative output path) pairs for the
+	files given by in_path, which is either a directory or a file listing
+	paths, one per line."""
+	if os.path.isdir(in_path):
+		found = []
+		for root, dirs, files in os.walk(in_path):
+			dirs.sort()
+			for name in sorted(files):
+				if name.endswith('.py'):
+					path = os.path.join(root, name)
+					found.append((path, relative_path(path, in_path)))
+		return found
+
+	# Otherwise we have a list of files. We mirror them relative to the
+	# directory they all have in common.
+	list_file = open(in_path, 'r')
+	paths = [line.strip() for line in list_file if line.strip()]
+	list_file.close()
+	if not paths:
+		return []
+	absolute = [os.path.abspath(p) for p in paths]
+	common = common_directory(absolute)
+	return [(p, relative_path(a, common)) for p, a in zip(paths, absolute)]
+
+def translate_file(job):
+	"""Translates the file in_path, writing the result to out_path. This
+	runs in a worker process, so rather than raising we return the path
+	along with an error message, or None if it worked."""
+	in_path, out_path = job
+	try:
+		in_text = from_path(in_path).text()
+
+		out_dir = os.path.dirname(out_path)
+		if out_dir and not os.path.isdir(out_dir):
+			try:
+				os.makedirs(out_dir)
+			except OSError:
+				# Another worker may have made it in the meantime
+				if not os.path.isdir(out_dir):
+					raise
+
+		out = open(out_path, 'w')
+		try:
+			diet_python.translate_code(in_text, out=out)
+		finally:
+			out.close()
+		return (in_path, None)
+	except Exception, e:
+		# Don't leave half-written output lying around
+		if os.path.exists(out_path):
+			try:
+				os.remove(out_path)
+			except OSError:
+				pass
+		message = str(e) or traceback.format_exc().strip().split('\n')[-1]
+		return (in_path, message)
+
+def translate_all(files, out_dir, jobs=None):
+	"""Translates every (input path, relative output path) pair in files,
+	putting the results in out_dir. Returns a list of (path, error) pairs
+	for those files which failed."""
+	work = [(in_path, os.path.join(out_dir, rel)) for in_path, rel in files]
+	failures = []
+	if jobs == 1:
+		results = map(translate_file, work)
+	else:
+		pool = Pool(jobs)
+		results = pool.imap_unordered(translate_file, work)
+	for path, error in results:
+		if error is not None:
+			failures.append((path, error))
+	if jobs != 1:
+		pool.close()
+		pool.join()
+	return failures
+
+if __name__ == '__main__':
+	usage = "Usage: batch.py -in dir_or_list -out output_dir [-jobs N] [-extra foo]"
+	args = sys.argv
+	if '-in' not in args or '-out' not in args:
+		print usage
+		sys.exit(1)
+	in_path = args[args.index('-in')+1]
+	out_dir = args[args.index('-out')+1]
+	if '-jobs' in args:
+		jobs = int(args[args.index('-jobs')+1])
+	else:
+		jobs = cpu_count()
+	# "-extra foo" will include the transformations from foo.py. These
+	# are loaded before the pool starts, so that the workers inherit them.
+	while '-extra' in args:
+		i = args.index('-extra')
+		n = args[i+1]
+		try:
+			diet_python.add_extra(n)
+		except:
+			print 'Failed to import '+n
+			sys.exit(1)
+		args.pop(i)
+		args.pop(i)
+
+	try:
+		files = find_files(in_path)
+	except (ValueError, IOError), e:
+		sys.stderr.write(str(e)+'\n')
+		sys.exit(1)
+	start = time.time()
+	failures = translate_all(files, out_dir, jobs)
+	taken = time.time() - start
+
+	for path, error in sorted(failures):
+		sys.stderr.write(path+': '+error+'\n')
+	print 'Translated %d of %d files in %.2f seconds (%d failed)' % (
+		len(files) - len(failures), len(files), taken, len(failures))
+	if failures:
+		sys.exit(1)
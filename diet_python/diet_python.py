@@ -20,18 +20,32 @@ except:
 
 import os
 import sys
-from python_rewriter.base import grammar_def, parse, constants
+from cStringIO import StringIO
+from python_rewriter.base import grammar_def, parse, constants, \
+	strip_comments, tree_init, ins
 from python_rewriter.nodes import *
-from pymeta.grammar import OMeta
+from python_rewriter.grammar_cache import make_grammar
+from python_rewriter.filters import walk, merge
+from python_rewriter.emitter import emit
+from python_rewriter.sources import as_source
+import translation_cache
 
+# Functions which are run on every transformed node (see apply)
 extra_filters = []
 
+# Visitors which are run over the whole transformed tree in one pass (see
+# python_rewriter/filters.py), keyed by node class
+node_filters = {}
+
 def apply(arg):
 	"""Runs transformations on the argument. If the argument has a trans
 	method, that is run; if it is a list, apply is mapped to the list;
 	if it is a "type" (None, str, etc.) then that is returned unchanged.
 	"""
-	if type(arg) in [type('string'), type(0), type(None)]:
+	if type(arg) == type('string'):
+		# Names get interned, so every use of a name shares one string
+		return intern(arg)
+	elif type(arg) in [type(0), type(None)]:
 		return arg
 	elif type(arg) == type([0,1]):
 		return map(apply, arg)
@@ -46,6 +60,30 @@ def apply(arg):
 	else:
 		raise Exception("Couldn't transform "+str(arg))
 
+def method(name):
+	"""Returns a Name node for the special method called name (eg.
+	"__add__"), which our rewrites call. The string is interned, so every
+	use shares it, but each use gets its own node since nodes can be changed
+	after they're made (eg. base.add_semis and python_annotator's Annotator
+	set attributes on them)."""
+	return Name(intern(name))
+
+def transform(tree):
+	"""Transforms the Python AST tree into a Diet Python AST, including any
+	extra filters."""
+	diet_tree = apply(tree)
+	if node_filters:
+		diet_tree = walk(diet_tree, node_filters)
+	return diet_tree
+
+def active_filters():
+	"""Returns every extra filter and visitor function in use, in a
+	consistent order."""
+	visitors = []
+	for cls in sorted(node_filters.keys(), key=lambda c: c.__name__):
+		visitors.extend(node_filters[cls])
+	return extra_filters + visitors
+
 def comparison_to_and(node):
 	"""Turns a series of comparisons into a nested series of independent
 	comparisons. The behaviour is similar to logical and, including the
@@ -70,18 +108,17 @@ def comparison_to_and(node):
 	a.__lt__(b, [('__lt__','c'),('__eq__','d'),('__ge__','e'),('__lt__','f')])"""
 	left = node.expr
 	op = {'==':'__eq__', '!=':'__ne__', '>':'__gt__', '<':'__lt__', \
-		'>=':'__ge__', '<=':'__le__'}[node.ops[0][0]]
+		'>=':'__ge__', '<=':'__le__'}
 	ops = [(op[a[0]],a[1]) for a in node.ops]
 	if len(ops) == 1:
-		return CallFunc(Getattr(apply(node.expr), Name(ops[0][0])),[apply(ops[0][1])])
+		return CallFunc(Getattr(apply(node.expr), method(ops[0][0])),[apply(ops[0][1])])
 	else:
 		first_op = ops.pop(0)
-		from python_rewriter.base import grammar
-		matcher = grammar([apply(a[1])])
-		val,err = matcher.apply('thing',0)
-		return CallFunc(Getattr(apply(node.expr), Name(first_op[0])), \
+		# Each expression is printed once, with the emitter rather than a
+		# new grammar matcher
+		return CallFunc(Getattr(apply(node.expr), method(first_op[0])), \
 			[apply(first_op[1]),List([ \
-				Tuple([Const(a[0]),Const(val)]) for a in ops \
+				Tuple([Const(a[0]),Const(emit(apply(a[1])))]) for a in ops \
 			])] \
 		)
 
@@ -90,85 +127,86 @@ def comparison_to_and(node):
 # PyMeta.
 
 tree_transform = """
-# "thing" matches anything, applying transforms to those which have them
-thing ::= <add>
-        | <and>
-        | <assattr>
-        | <asslist>
+# "thing" matches anything, applying transforms to those which have them. The
+# most common nodes come first (see python_rewriter/node_order.py).
+thing ::= <name>
+        | <const>
+        | <getattr>
+        | <callfunc>
+        | <stmt>
+        | <assign>
         | <assname>
+        | <if>
+        | <compare>
+        | <discard>
+        | <function>
+        | <return>
+        | <subscript>
+        | <assattr>
+        | <add>
+        | <tuple>
+        | <raise>
+        | <not>
+        | <slice>
+        | <keyword>
         | <asstuple>
-        | <assert>
-        | <assign>
+        | <mod>
+        | <list>
+        | <for>
+        | <tryexcept>
+        | <and>
+        | <import>
+        | <unarysub>
+        | <sub>
+        | <printnl>
+        | <class>
+        | <or>
         | <augassign>
-        | <backquote>
-        | <bitand>
-        | <bitor>
-        | <bitxor>
+        | <while>
+        | <mul>
+        | <pass>
+        | <dict>
         | <break>
-        | <callfunc>
-        | <class>
-        | <compare>
-        | <const>
+        | <from>
         | <continue>
+        | <bitand>
+        | <module>
+        | <tryfinally>
+        | <listcompfor>
+        | <yield>
+        | <listcomp>
         | <decorators>
-        | <dict>
-        | <discard>
-        | <div>
-        | <ellipsis>
-        | <emptynode>
-        | <exec>
-        | <expression>
+        | <assert>
+        | <with>
+        | <lambda>
+        | <print>
+        | <power>
         | <floordiv>
-        | <for>
-        | <from>
-        | <function>
-        | <genexpr>
+        | <leftshift>
+        | <bitor>
         | <genexprfor>
-        | <genexprif>
+        | <ifexp>
+        | <genexpr>
         | <genexprinner>
-        | <getattr>
         | <global>
-        | <if>
-        | <ifexp>
-        | <import>
-        | <invert>
-        | <keyword>
-        | <lambda>
-        | <leftshift>
-        | <list>
-        | <listcomp>
-        | <listcompfor>
-        | <listcompif>
-        | <mod>
-        | <module>
-        | <mul>
-        | <name>
-        | <not>
-        | <or>
-        | <pass>
-        | <power>
-        | <print>
-        | <printnl>
-        | <raise>
-        | <return>
+        | <div>
         | <rightshift>
-        | <slice>
+        | <listcompif>
+        | <bitxor>
+        | <exec>
+        | <genexprif>
+        | <invert>
+        | <asslist>
         | <sliceobj>
-        | <stmt>
-        | <sub>
-        | <subscript>
-        | <tryexcept>
-        | <tryfinally>
-        | <tuple>
         | <unaryadd>
-        | <unarysub>
-        | <while>
-        | <with>
-        | <yield>
+        | <backquote>
+        | <ellipsis>
+        | <emptynode>
+        | <expression>
         | <anything>:a !(sys.stdout.write('FAIL '+str(a)+' ENDFAIL'))
 
 # a + b becomes a.__add__(b)
-add ::= <anything>:a ?(a.__class__ == Add) => apply(CallFunc(Getattr(a.left, Name('__add__')), [a.right], None, None))
+add ::= <anything>:a ?(a.__class__ == Add) => apply(CallFunc(Getattr(a.left, method('__add__')), [a.right], None, None))
 
 # Recurse through "and" keywords
 and ::= <anything>:a ?(a.__class__ == And) => And(apply(a.nodes))
@@ -207,16 +245,16 @@ augassign ::= <anything>:a ?(a.__class__ == AugAssign) !(self.ins(a.node)) <thin
 backquote ::= <anything>:a ?(a.__class__ == Backquote) => apply(CallFunc(Name('repr'), [a.expr], None, None))
 
 # a & b becomes a.__and__(b)
-bitand ::= <anything>:a ?(a.__class__ == Bitand and len(a.nodes) > 2) => apply(CallFunc(Getattr(Bitand(a.nodes[:-1]), '__and__'), [a.nodes[-1]], None, None))
-         | <anything>:a ?(a.__class__ == Bitand) => apply(CallFunc(Getattr(a.nodes[0], '__and__'), [a.nodes[1]], None, None))
+bitand ::= <anything>:a ?(a.__class__ == Bitand and len(a.nodes) > 2) => apply(CallFunc(Getattr(Bitand(a.nodes[:-1]), method('__and__')), [a.nodes[-1]], None, None))
+         | <anything>:a ?(a.__class__ == Bitand) => apply(CallFunc(Getattr(a.nodes[0], method('__and__')), [a.nodes[1]], None, None))
 
 # a | b becomes a.__or__(b)
-bitor ::= <anything>:a ?(a.__class__ == Bitor and len(a.nodes) > 2) => apply(CallFunc(Getattr(Bitor(a.nodes[:-1]), '__or__'), [a.nodes[-1]], None, None))
-        | <anything>:a ?(a.__class__ == Bitor) => apply(CallFunc(Getattr(a.nodes[0], '__or__'), [a.nodes[1]], None, None))
+bitor ::= <anything>:a ?(a.__class__ == Bitor and len(a.nodes) > 2) => apply(CallFunc(Getattr(Bitor(a.nodes[:-1]), method('__or__')), [a.nodes[-1]], None, None))
+        | <anything>:a ?(a.__class__ == Bitor) => apply(CallFunc(Getattr(a.nodes[0], method('__or__')), [a.nodes[1]], None, None))
 
 # a ^ b becomes a.__xor__(b)
-bitxor ::= <anything>:a ?(a.__class__ == Bitxor and len(a.nodes) > 2) => apply(CallFunc(Getattr(Bitxor(a.nodes[:-1]), '__xor__'), [a.nodes[-1]], None, None))
-         | <anything>:a ?(a.__class__ == Bitxor) => apply(CallFunc(Getattr(a.nodes[0], '__xor__'), [a.nodes[1]], None, None))
+bitxor ::= <anything>:a ?(a.__class__ == Bitxor and len(a.nodes) > 2) => apply(CallFunc(Getattr(Bitxor(a.nodes[:-1]), method('__xor__')), [a.nodes[-1]], None, None))
+         | <anything>:a ?(a.__class__ == Bitxor) => apply(CallFunc(Getattr(a.nodes[0], method('__xor__')), [a.nodes[1]], None, None))
 
 # Recurse through breaks
 # Could replace this by converting programs to Continuation Passing Style
@@ -256,7 +294,7 @@ dict ::= <anything>:a ?(a.__class__ == Dict) => Dict(apply(a.items))
 discard ::= <anything>:a ?(a.__class__ == Discard) => Discard(apply(a.expr))
 
 # a / b becomes a.__div__(b)
-div ::= <anything>:a ?(a.__class__ == Div) => apply(CallFunc(Getattr(a.left, '__div__'), [a.right], None, None))
+div ::= <anything>:a ?(a.__class__ == Div) => apply(CallFunc(Getattr(a.left, method('__div__')), [a.right], None, None))
 
 # Recurse through ellipses
 # Global namespace call
@@ -274,7 +312,7 @@ exec ::= <anything>:a ?(a.__class__ == Exec) => Exec(apply(a.expr), apply(a.loca
 expression ::= <anything>:a ?(a.__class__ == Expression) => Expression(apply(a.node))
 
 # a // b becomes a.__floordiv__(b)
-floordiv ::= <anything>:a ?(a.__class__ == FloorDiv) => apply(CallFunc(Getattr(a.left, '__floordiv__'), [a.right], None, None))
+floordiv ::= <anything>:a ?(a.__class__ == FloorDiv) => apply(CallFunc(Getattr(a.left, method('__floordiv__')), [a.right], None, None))
 
 # Recurse through for loops
 # Could maybe do something with map, or __iter__?
@@ -307,7 +345,7 @@ genexprinner ::= <anything>:a ?(a.__class__ == GenExprInner) => GenExprInner(app
 
 # Recurse through attribute lookups
 # Oops, infinite recursion!
-#getattr ::= <anything>:a ?(a.__class__ == Getattr) => Callfunc(Getattr(a.expr, Name('__getattribute__')), a.attrname)
+#getattr ::= <anything>:a ?(a.__class__ == Getattr) => Callfunc(Getattr(a.expr, method('__getattribute__')), a.attrname)
 # Could maybe use objects' namespaces?
 getattr ::= <anything>:a ?(a.__class__ == Getattr) => Getattr(apply(a.expr), apply(a.attrname))
 
@@ -354,14 +392,14 @@ listcompfor ::= <anything>:a ?(a.__class__ == ListCompFor) => ListCompFor(apply(
 listcompif ::= <anything>:a ?(a.__class__ == ListCompIf) => ListCompIf(apply(a.test))
 
 # a % b becomes a.__mod__(b)
-mod ::= <anything>:a ?(a.__class__ == Mod) => apply(CallFunc(Getattr(a.left, '__mod__'), [a.right], None, None))
+mod ::= <anything>:a ?(a.__class__ == Mod) => apply(CallFunc(Getattr(a.left, method('__mod__')), [a.right], None, None))
 
 # Recurse through Python modules
 # No actual code, no no need to change
 module ::= <anything>:a ?(a.__class__ == Module) => a#Module(apply(a.doc), apply(a.node))
 
 # a * b becomes a.__mul__(b)
-mul ::= <anything>:a ?(a.__class__ == Mul) => apply(CallFunc(Getattr(a.left, '__mul__'), [a.right], None, None))
+mul ::= <anything>:a ?(a.__class__ == Mul) => apply(CallFunc(Getattr(a.left, method('__mul__')), [a.right], None, None))
 
 # Recurse through names
 # Maybe make it a namespace lookup message
@@ -378,7 +416,7 @@ or ::= <anything>:a ?(a.__class__ == Or) => Or(apply(a.nodes))
 pass ::= <anything>:a ?(a.__class__ == Pass) => Pass()
 
 # a**b becomes a.__pow__(b)
-power ::= <anything>:a ?(a.__class__ == Power) => apply(CallFunc(Getattr(a.left, '__pow__'), [a.right], None, None))
+power ::= <anything>:a ?(a.__class__ == Power) => apply(CallFunc(Getattr(a.left, method('__pow__')), [a.right], None, None))
 
 # Recurse through output
 # TODO: At a future point, when we implement namespaces and things, we
@@ -433,11 +471,11 @@ sliceobj ::= <anything>:a ?(a.__class__ == Sliceobj) => Sliceobj(apply(a.nodes))
 stmt ::= <anything>:a ?(a.__class__ == Stmt) => Stmt(apply(a.nodes))
 
 # a - b becomes a.__sub__(b)
-sub ::= <anything>:a ?(a.__class__ == Sub) => apply(CallFunc(Getattr(a.left, '__sub__'), [a.right], None, None))
+sub ::= <anything>:a ?(a.__class__ == Sub) => apply(CallFunc(Getattr(a.left, method('__sub__')), [a.right], None, None))
 
 # a[b] becomes a.__getitem__(b)
 # TODO: Check a.flags for deletion (__delitem__) and things
-subscript ::= <anything>:a ?(a.__class__ == Subscript) => apply(CallFunc(Getattr(a.expr, Name('__getitem__')), a.subs))
+subscript ::= <anything>:a ?(a.__class__ == Subscript) => apply(CallFunc(Getattr(a.expr, method('__getitem__')), a.subs))
 
 # Recurse through fallbacks
 # Continuation Passing Style should be able to overcome this
@@ -472,23 +510,9 @@ yield ::= <anything>:a ?(a.__class__ == Yield) => Yield(apply(a.value))
 # apply them recursively to their children
 #from python_rewriter.base import grammar
 import sys
-transforms = OMeta.makeGrammar(strip_comments(tree_transform), globals())
-
-# Patch the grammar for recursion
-def ins(self, val):
-	"""This is a very dangerous function! We monkey-patch PyMeta grammars with
-	this so that we can insert an arbitrary value as the next input. This allows
-	us to recurse without having to	instantiate another matcher (we effectively
-	use the existing input as a stack). Beware of leaving cruft behind on the
-	input!"""
-	# Insert the value
-	self.input.data.insert(self.input.position, val)
-	# Throw away any cached input
-	self.input.tl = None
-	self.input.memo = {}
-	# Ensure success, if needed
-	return True
+transforms = make_grammar(strip_comments(tree_transform), globals())
 
+transforms.__init__ = tree_init
 transforms.ins = ins
 
 
@@ -502,57 +526,101 @@ def trans(self):
 	# Uncomment to see exactly which bits are causing errors
 	#print str(self)
 	
-	self.transformer = self.transforms([self])
+	# As with rec, we don't keep the transformer on the node
+	transformer = self.transforms([self])
 	
-	r,err = self.transformer.apply('thing')
+	r,err = transformer.apply('thing')
 
 	return r
 	
 Node.trans = trans
 
-def translate(path_or_text, initial_indent=0):
+def translate_code(in_text, initial_indent=0, out=None):
+	"""Translates the Python code in_text to Diet Python. This is the work
+	done by translate, except that any errors are raised rather than
+	exiting, so that callers translating many files can carry on.
+
+	Results are kept in the translation cache, so code which has been
+	translated before (with the same extra_filters) isn't parsed again."""
+	key = translation_cache.cache_key(__file__, in_text, initial_indent,
+		active_filters())
+	cached = translation_cache.lookup(key)
+	if cached is not None:
+		if out is not None:
+			out.write(cached)
+			return out
+		return cached
+
+	if out is None:
+		diet_code = translate_uncached(in_text, initial_indent)
+		translation_cache.store(key, diet_code)
+		return diet_code
+	# Keep a copy of the code as it's written out, so we can cache it
+	recorder = translation_cache.Recorder(out)
+	translate_uncached(in_text, initial_indent, recorder)
+	translation_cache.store(key, recorder.getvalue())
+	return out
+
+def translate_uncached(in_text, initial_indent=0, out=None):
+	"""Does the translation of translate_code without using the cache."""
+	# Get an Abstract Syntax Tree for the contents of in_text
+	tree = parse(in_text)
+
+	# Transform the Python AST into a Diet Python AST
+	diet_tree = transform(tree)
+	#print str(tree)
+	#print str(diet_tree)
+
+	# Generate (Diet) Python code to match the transformed tree. We always
+	# use python_to, since that's done by emitter.emit, which doesn't recurse
+	# (so very long expressions, like the calls replace_logic makes for
+	# chains of hundreds of "or"s, don't hit the recursion limit)
+	from python_rewriter.base import grammar
+	matcher = grammar([diet_tree])
+	if out is not None:
+		return matcher.apply('python_to', initial_indent, out)[0]
+	written = StringIO()
+	matcher.apply('python_to', initial_indent, written)
+	diet_code = written.getvalue()
+
+	#print str(tree)
+	#print
+	#print str(diet_tree)
+	#print
+
+	return diet_code
+
+def translate(source=None, initial_indent=0, out=None, path=None, text=None):
 	"""This performs the translation from Python to Diet Python. It
-	takes in Python code (assuming the string to be a file path, falling
-	back to treating it as Python code if it is not a valid path) and
-	emits Diet Python code."""
-	# See if the given string is a valid path
-	if os.path.exists(path_or_text):
-		# If so then open it and read the file contents into in_text
-		infile = open(path_or_text, 'r')
-		in_text = '\n'.join([line for line in infile.readlines()])
-		infile.close()
-	# Otherwise take the string contents to be in_text
-	else:
-		in_text = path_or_text
-		
+	takes in Python code, as a Source (see python_rewriter.sources), the
+	path of a file (path=...) or the code itself (text=...), and emits Diet
+	Python code. If out is given then the code is written to this file-like
+	object as it is generated, rather than being returned."""
+	in_text = as_source(source, path, text).text()
+
 	# Wrap in try/except to give understandable error messages (PyMeta's
 	# are full of obscure implementation details)
 	try:
-		# Get an Abstract Syntax Tree for the contents of in_text
-		tree = parse(in_text)
-		
-		# Transform the Python AST into a Diet Python AST
-		diet_tree = apply(tree)
-		#print str(tree)
-		#print str(diet_tree)
-		
-		# Generate (Diet) Python code to match the transformed tree
-		from python_rewriter.base import grammar
-		matcher = grammar([diet_tree])
-		diet_code,err = matcher.apply('thing', initial_indent)
-		
-		#print str(tree)
-		#print
-		#print str(diet_tree)
-		#print
-		
-		return diet_code
+		return translate_code(in_text, initial_indent, out)
 		
 	except Exception, e:
 		sys.stderr.write(str(e)+'\n')
 		sys.stderr.write('Unable to translate.\n')
 		sys.exit(1)
 
+def add_extra(name):
+	"""Includes the transformations from the module called name (eg. for
+	"-extra foo" on the command line). The module's namespace is given our
+	node classes, then its extra_filters and node_filters are added to
+	ours."""
+	module = __import__(name)
+	# Fill its namespace with our node classes
+	for obj, value in globals().items():
+		if obj[0].isupper():
+			setattr(module, obj, value)
+	extra_filters.extend(getattr(module, 'extra_filters', []))
+	merge(node_filters, getattr(module, 'node_filters', {}))
+
 if __name__ == '__main__':
 	# TODO: Allow passing the initial indentation
 	if len(sys.argv) > 1:
@@ -573,12 +641,7 @@ if __name__ == '__main__':
 			n = args[i+1]
 			# Import it
 			try:
-				exec('import '+n)
-				# Fill its namespace with our node classes
-				for obj in dir():
-					if obj[0].isupper():
-						exec(n+'.'+obj+' = '+obj)
-				extra_filters.extend(eval(n+'.extra_filters'))
+				add_extra(n)
 			except:
 				print 'Failed to import '+n
 				sys.exit(1)
@@ -586,12 +649,12 @@ if __name__ == '__main__':
 			args.pop(i)
 			args.pop(i)
 		# Now run the translation
-		code = translate(in_file)
 		if out_file is None:
-			print code
+			print translate(path=in_file)
 		else:
+			# Write the code straight to the file as it's generated
 			o = open(out_file, 'w')
-			o.write(code)
+			translate(path=in_file, out=o)
 			o.close()
 	else:
 		print "Usage: diet_python.py -in input_path [-out output_path] [-extra foo]"
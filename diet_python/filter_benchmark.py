@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""Times running the replace_logic and if_brancher filters over deeply nested
+If/Or code. We compare a single walk which runs them all with a separate walk
+for each filter, and with the way extra_filters used to be run: diet_python's
+apply ran every filter over the whole subtree of each node it transformed.
+
+Usage: filter_benchmark.py [-depth N] [-width N] [-repeat N]
+
+Python won't parse more than 99 levels of indentation, so depth must be less
+than that."""
+
+import sys
+import time
+from python_rewriter.base import parse
+from python_rewriter.filters import walk, merge
+from python_rewriter.nodes import *
+import replace_logic
+import if_brancher
+
+node_classes = [Add, And, AssName, Assign, CallFunc, Const, Discard, Getattr,
+	If, Module, Name, Not, Or, Pass, Stmt]
+
+def nested_code(depth, width):
+	"""Returns code with depth levels of If statements, each of which has an
+	elif and a condition made of width "or"s."""
+	lines = []
+	for d in range(depth):
+		cond = ' or '.join(['x%d_%d' % (d, w) for w in range(width)])
+		lines.append('\t'*d + 'if ' + cond + ':')
+		lines.append('\t'*(d+1) + 'a = not b%d' % d)
+		lines.append('\t'*d + 'elif c%d or d%d:' % (d, d))
+		lines.append('\t'*(d+1) + 'pass')
+		lines.append('\t'*d + 'else:')
+	lines.append('\t'*depth + 'pass')
+	return '\n'.join(lines)+'\n'
+
+def separate(tree):
+	"""Runs each filter module over the tree in turn."""
+	for module in [replace_logic, if_brancher]:
+		tree = walk(tree, module.node_filters)
+	return tree
+
+def per_node(tree):
+	"""Runs each filter over the subtree of every node, from the bottom up,
+	as apply does with extra_filters."""
+	def whole_subtree(node):
+		for module in [replace_logic, if_brancher]:
+			node = walk(node, module.node_filters)
+		return node
+	visitors = dict([(cls, [whole_subtree]) for cls in node_classes])
+	return walk(tree, visitors)
+
+def fused(tree):
+	"""Runs the filters of both modules in a single walk."""
+	visitors = merge(merge({}, replace_logic.node_filters),
+		if_brancher.node_filters)
+	return walk(tree, visitors)
+
+def best_time(func, tree, repeat):
+	times = []
+	for n in range(repeat):
+		start = time.time()
+		func(tree)
+		times.append(time.time() - start)
+	return min(times)
+
+if __name__ == '__main__':
+	args = sys.argv
+	options = {'-depth':40, '-width':8, '-repeat':5}
+	for option in options:
+		if option in args:
+			options[option] = int(args[args.index(option)+1])
+	sys.setrecursionlimit(max(sys.getrecursionlimit(),
+		100*options['-depth']))
+	tree = parse(nested_code(options['-depth'], options['-width']))
+	s = best_time(separate, tree, options['-repeat'])
+	f = best_time(fused, tree, options['-repeat'])
+	p = best_time(per_node, tree, options['-repeat'])
+	print 'depth %d, width %d' % (options['-depth'], options['-width'])
+	print 'separate walks: %.4f seconds' % s
+	print 'single walk:    %.4f seconds' % f
+	print 'per node:       %.4f seconds' % p
@@ -107,99 +107,44 @@ functions :)
 """
 
 from python_rewriter.nodes import *
+from python_rewriter.filters import walk
+
+# These are run as visitors (see python_rewriter/filters.py), so the nodes
+# they're given have already had their children transformed
+
+def replace_elif(node):
+	"""Takes an If node and replaces its 'elif' conditions with nested If
+	nodes in its else clause."""
+	# Take the first (condition,code) pair
+	cond1 = node.tests[0]
+	# If there are elifs, put them in an If of their own (which we do
+	# recursively, to get rid of its elifs too)
+	if len(node.tests) > 1:
+		return If([cond1], Stmt([replace_elif(If(node.tests[1:], node.else_))]))
+	return node
+
+def replace_if(node):
+	"""Replaces an If node with a call to __if__."""
+	cond, body = node.tests[0]
+	# Any elifs become Ifs in the else clause, which we replace in turn
+	if len(node.tests) > 1:
+		else_ = Stmt([replace_if(If(node.tests[1:], node.else_))])
+	elif node.else_ is None:
+		# Without an else there's nothing to do if the condition is False
+		else_ = Name('None')
+	else:
+		else_ = node.else_
+	# Call the __if__ method of the condition instead
+	return CallFunc(Getattr(CallFunc(Name('bool'),[cond]), \
+		Name('__if__')), [body, else_])
+
+node_filters = {If:[replace_if]}
 
 def replace_elifs(node):
 	"""Takes an AST and replaces the 'elif' conditions in any If nodes,
 	recursively."""
-
-	# We want to replace If nodes containing elif clauses, so look for them
-	if node.__class__ == If:
-		# Take the first (condition,code) pair
-		cond1 = node.tests[0]
-		# If there are elifs...
-		if len(node.tests) > 1:
-			# ... replace them with unwrap_if and insert in a new If node
-			# (transforming its True and False branches first)
-			return If([(cond1[0], replace_elifs(cond1[1]))], \
-				unwrap_if(node.tests[1:], replace_elifs(node.else_)))
-		else:
-			# Otherwise return a new If with the branches transformed
-			return If([(cond1[0], replace_elifs(cond1[1]))], \
-				replace_elifs(node.else_))
-	else:
-		# If we've not got an If node then simply recurse
-		try:
-			# map our transformation to members of any lists or tuples
-			if type(node) in [type([]), type((0,1))]:
-				return map(replace_elifs, node)
-			# Stmt nodes are weird: their contents is [nodes] but asList only
-			# gives nodes, breaking the *varargs technique used below
-			if node.__class__ == Stmt:
-				return Stmt(map(replace_elifs, node.asList()))
-			# If we're not in a list or Stmt, return a new instance of our
-			# class, with transformed children
-			return node.__class__(*map(replace_elifs, node.asList()))
-		except:
-			# If an error occurs it's because strings, numbers, None, etc. don't
-			# have an asList method. Since they're leaves, just return them.
-			return node
-
-def unwrap_if(tests, else_):
-	"""Returns a recursive set of If nodes which capture the tests and else
-	statements given. tests is a list of tuples of the form (condition, code)
-	where 'code' is run if 'condition' is true, checking the next pair in the
-	list if 'condition' is false. If every condition in the list is false then
-	'else_' is run."""
-	# Act on a copy of the given (condition,code) pairs
-	ts = tests[:]
-	# Grab the last test (which, if it fails, leads to the else_)
-	if_ = ts.pop()
-	# Give this its own If node, with its code as the True branch and else_ as
-	# the False branch
-	node = If((if_[0], if_[1]), else_)
-
-	# Now loop through the remaining tests, which are elifs
-	while len(ts) > 0:
-		# Take a test off the end...
-		if_ = ts.pop()
-		# ... and make it an independent If node, using the previously defined
-		# node as the else_
-		node = If((if_[0], if_[1]), Stmt([node]))
-
-	# Our node should now be an If with no elifs, with a cascade of Ifs in the
-	# else clause(s)
-	return node
+	return walk(node, {If:[replace_elif]})
 
 def replace_ifs(node):
 	"""Given an AST node, replaces if statements with calls to __if__."""
-	# Get rid of elif statements
-	#tree = replace_elifs(node)
-	# We want to transform If nodes
-	if tree.__class__ == If:
-		# Call the __if__ method of the condition instead (and recurse through
-		# the If's children)
-		return CallFunc(Getattr(CallFunc(Name('bool'),[node.tests[0][0]]), \
-			Name('__if__')), [replace_ifs(node.tests[0][1]), replace_ifs(node.else_)])
-	# If it's not an If node then recurse
-	else:
-		try:
-			# Iterators should get mapped (but NOT strings, hence why we don't
-			# use __iter__ as a test at the moment)
-			if type(node) in [type([]), type((0,1))]:
-				return map(replace_ifs, node)
-			# Stmt nodes are a bit weird: they contain a list called nodes so
-			# that instantiation is Stmt(nodes), however the asList method
-			# doesn't give [nodes], it just gives nodes, which means we can't
-			# use the *varargs technique below
-			if node.__class__ == Stmt:
-				return Stmt(map(replace_ofs, node.asList()))
-			# Otherwise just go ahead and create a new node of the same class,
-			# with members mapped with this transformation
-			return node.__class__(*map(replace_ifs, node.asList()))
-		except:
-			# If we get an error it's because strings, None, numbers, etc. don't
-			# have an asList method. These are leaves anyway, so we don't need
-			# to recurse into them
-			return node
-
-extra_filters = [replace_ifs]
+	return walk(node, node_filters)
@@ -0,0 +1,91 @@
+"""Keeps a Diet Python translation up to date as its source is edited.
+
+translate redoes the whole Module every time, which is too slow to run on
+every change to a large file (for example to keep a live Diet Python view in
+an editor). An IncrementalTranslation remembers the translation of each
+top-level statement from the previous run; when given new code it parses it,
+compares its top-level statements against the previous ones and only
+transforms and generates code for those which have changed. The results are
+then spliced together with the code kept from last time.
+
+The output is the same as translate_code would give, as long as the
+extra_filters only rewrite the statements they're given (which is true of
+all of ours)."""
+
+from python_rewriter.base import parse, pick_quotes
+from python_rewriter.nodes import *
+from python_rewriter.emitter import emit
+import diet_python
+import translation_cache
+
+def is_none_discard(node):
+	"""Statements followed by one of these get a semicolon, as in the
+	stmt rule of the grammar."""
+	return node.__class__ == Discard and node.expr.__class__ == Const and \
+		node.expr.value is None
+
+class IncrementalTranslation(object):
+	"""Translates successive versions of some code, reusing the work done
+	for any top-level statements which haven't changed. Each call to
+	update gives the translation of the new version. Afterwards, reused and
+	translated say how many statements were kept and how many were
+	redone."""
+
+	def __init__(self, initial_indent=0):
+		self.initial_indent = initial_indent
+		# Maps each statement's repr to a list of translations of it. Each
+		# translation is a list of (Diet Python node, code) pairs, since
+		# the extra filters might turn one statement into several.
+		self.statements = {}
+		self.filters = None
+		self.reused = 0
+		self.translated = 0
+
+	def translate_statement(self, statement):
+		"""Returns the (node, code) pairs for one top-level statement. We
+		wrap it in a Module of its own, so the transformations and extra
+		filters see the same kind of tree as they do in translate_code."""
+		diet_tree = diet_python.transform(Module(None, Stmt([statement])))
+		nodes = diet_tree.node.nodes
+		return [(n, emit(n, self.initial_indent)) for n in nodes]
+
+	def update(self, in_text):
+		"""Returns the Diet Python translation of in_text."""
+		# Translations done with different extra filters are no use to us
+		filters = translation_cache.filters_version(diet_python.active_filters())
+		if filters != self.filters:
+			self.statements = {}
+			self.filters = filters
+
+		tree = parse(in_text)
+		previous = self.statements
+		self.statements = {}
+		self.reused = 0
+		self.translated = 0
+		results = []
+		for statement in tree.node.nodes:
+			# Statements print the same when they're the same (their line
+			# numbers aren't included), so their repr identifies them
+			key = repr(statement)
+			if previous.get(key):
+				result = previous[key].pop()
+				self.reused += 1
+			else:
+				result = self.translate_statement(statement)
+				self.translated += 1
+			self.statements.setdefault(key, []).append(result)
+			results.extend(result)
+
+		# Splice the statements together the same way as the stmt rule
+		i = self.initial_indent
+		if tree.doc is None:
+			pieces = []
+		else:
+			pieces = [pick_quotes(tree.doc)]
+		for e, (node, code) in enumerate(results):
+			pieces.append('\n'+'\t'*i+code)
+			if e+1 < len(results) and is_none_discard(results[e+1][0]):
+				pieces.append(';')
+		if not results:
+			pieces.append('\n'+'\t'*i)
+		return ''.join(pieces)
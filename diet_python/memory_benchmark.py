@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""Measures the peak memory use (resident set size) of translating a module,
+with and without the matchers used by rec and trans being kept on the nodes
+(which is what they used to do).
+
+The module is parsed, translated to Diet Python and printed with rec several
+times over, keeping each tree around afterwards, as a long-running tool like
+an editor would. Each run happens in a process of its own, so their peaks
+don't affect each other.
+
+Usage: memory_benchmark.py -in path [-copies N]"""
+
+import os
+import sys
+import resource
+import subprocess
+
+def keeping_rec(self, i):
+	"""rec as it used to be, keeping its matcher on the node."""
+	self.matcher = self.grammar([self])
+	return self.matcher.apply('thing', i)
+
+def keeping_trans(self):
+	"""trans as it used to be, keeping its transformer on the node."""
+	self.transformer = self.transforms([self])
+	return self.transformer.apply('thing')[0]
+
+def run(path, copies, keep):
+	"""Translates the module at path copies times, then returns the peak
+	resident set size of this process in kilobytes."""
+	import diet_python
+	from python_rewriter.base import grammar, parse
+	from python_rewriter.nodes import Node
+	Node.grammar = grammar
+	if keep:
+		Node.rec = keeping_rec
+		Node.trans = keeping_trans
+	source = open(path, 'r').read()
+	trees = []
+	for n in range(copies):
+		tree = parse(source)
+		diet_tree = diet_python.transform(tree)
+		diet_tree.rec(0)
+		trees.append((tree, diet_tree))
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if __name__ == '__main__':
+	args = sys.argv
+	if '-in' not in args:
+		print __doc__.split('\n')[-1]
+		sys.exit(1)
+	path = args[args.index('-in')+1]
+	if '-copies' in args:
+		copies = int(args[args.index('-copies')+1])
+	else:
+		copies = 5
+	if '-child' in args:
+		# We're one of the runs, so report our peak to the parent
+		print run(path, copies, args[args.index('-child')+1] == 'keep')
+		sys.exit(0)
+
+	results = {}
+	for mode in ['keep', 'drop']:
+		output = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+			'-in', path, '-copies', str(copies), '-child', mode],
+			stdout=subprocess.PIPE).communicate()[0]
+		results[mode] = int(output.strip().split()[-1])
+	print 'Peak RSS translating %s %d times:' % (path, copies)
+	print 'matchers kept on nodes: %7.1f MB' % (results['keep'] / 1024.0)
+	print 'no matchers on nodes:   %7.1f MB' % (results['drop'] / 1024.0)
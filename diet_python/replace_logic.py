@@ -12,137 +12,69 @@ implementations do not support such transformations for the boolean operators.
 
 NOTE: We put "log" in the method names to prevent conflict with the bitwise
 logic.
+
+Since the operands after the first mustn't be evaluated unless they're needed,
+they're passed as strings of code, all to the one call: "a or b or c" becomes
+"bool(a).__logor__('b', 'c')". So __logor__ and __logand__ take any number of
+strings, evaluating each in turn until the answer is known. (Before, each
+string held the next call, eg. "bool(a).__logor__(\"bool(b).__logor__('c')\")",
+but quoting each call inside the last doubled the code for every operand.)
 """
 
+from python_rewriter.nodes import *
+from python_rewriter.filters import walk
+from python_rewriter.emitter import emit
+
+def to_string(node):
+	"""Pretty prints the given node, so that it can be passed around as a
+	string to be evaled when needed."""
+	return emit(node)
+
+# These are run as visitors (see python_rewriter/filters.py), so the nodes
+# they're given have already had their children transformed
+
 def replace_ors(node):
-	"""Replace all occurances of "or" with calls to "__logor__"."""
-	if node.__class__ == Or:
-		# Or nodes can contain 2 or more nodes, we have to handle them all. We
-		# also have to respect the premature optimisation that if any is True
-		# then the rest aren't evaluated. Thus the expression a or b or c or d
-		# cannot be turned into simply a.__logor__(b).__logor__(c).__logor__(d)
-		# because this will evaluate them all. Instead we need to pass in the
-		# expressions as strings, and eval them if needed, so our call becomes
-		# a.__logor__('''b.__logor__("""c.__logor__('d')""")''')
+	"""Replace an "or" with a call to "__logor__"."""
+	# Or nodes can contain 2 or more nodes, we have to handle them all. We
+	# also have to respect the premature optimisation that if any is True
+	# then the rest aren't evaluated. Thus the expression a or b or c or d
+	# cannot be turned into simply a.__logor__(b).__logor__(c).__logor__(d)
+	# because this will evaluate them all. Instead we need to pass in the
+	# expressions as strings, and eval them if needed, so our call becomes
+	# bool(a).__logor__('b', 'c', 'd')
+	# where __logor__ evals each string in turn until one of them is True,
+	# giving that one (or the last, if none are).
+	# We don't nest the calls (ie. bool(a).__logor__("bool(b).__logor__('c')")
+	# since each level would quote the one inside it, doubling the size of
+	# the code every time; chains of a few dozen operands wouldn't fit in
+	# memory. This way each operand is printed once, as it is.
 
-		# We replace Ors recursively. If there's only 2 nodes to compare then
-		# we convert the first to a boolean, then recurse our tree
-		# transformations through the second node, then pretty print the result
-		# into a string which we wrap with a Const node and pass into a method
-		# call of __logor__ on the boolean of the first node
-		from python_rewriter.base import grammar
-		if len(node.nodes) == 2:
-			matcher = grammar([apply(node.nodes[-1])])
-			return CallFunc(Getattr(CallFunc(Name('bool'),[node.nodes[0]]), \
-				Name('__logor__')), [Const(matcher.apply('thing',0))])
-		# Otherwise we build a nested series of ors (ie. "a or b or c or d"
-		# becomes "a or (b or (c or d))") which we do recursively, and then we
-		# apply ourselves to it recursively to complete the translation
-		else:
-			matcher = grammar([apply(Or(node.nodes[1:]))])
-			return CallFunc(Getattr(CallFunc(Name('bool'),[node.nodes[0]]), \
-				Name('__logor__')), [Const(matcher.apply('thing',0))])
-	else:
-		# If we've not got an Or node then simply recurse
-		try:
-			# map our transformation to members of any lists or tuples
-			if type(node) in [type([]), type((0,1))]:
-				return map(replace_ors, node)
-			# Stmt nodes are weird: their contents is [nodes] but asList only
-			# gives nodes, breaking the *varargs technique used below
-			if node.__class__ == Stmt:
-				return Stmt(map(replace_ors, node.asList()))
-			# If we're not in a list or Stmt, return a new instance of our
-			# class, with transformed children
-			return node.__class__(*map(replace_ors, node.asList()))
-		except:
-			# If an error occurs it's because strings, numbers, None, etc. don't
-			# have an asList method. Since they're leaves, just return them.
-			return node
+	# We convert the first node to a boolean, then pretty print the others
+	# into strings which we wrap with Const nodes and pass into a method call
+	# of __logor__ on the boolean of the first node
+	return CallFunc(Getattr(CallFunc(Name('bool'),[node.nodes[0]]), \
+		Name('__logor__')), [Const(to_string(n)) for n in node.nodes[1:]])
 
 def replace_ands(node):
-	"""Replace all occurances of "and" with calls to "__logand__"."""
-	if node.__class__ == And:
-		# We've got to be careful that we don't evaluate any expressions after
-		# one which returns False, since this would break existing code that
-		# depends on the assumption that such expressions will not be evaluated
+	"""Replace an "and" with a call to "__logand__"."""
+	# We've got to be careful that we don't evaluate any expressions after
+	# one which returns False, since this would break existing code that
+	# depends on the assumption that such expressions will not be evaluated
 
-		# If we have exactly 2 expressions then we simply build a string out of
-		# the second and send it to the boolean value of the first, which will
-		# presumably eval it if needed
-		from python_rewriter.base import grammar
-		if len(node.nodes) == 2:
-			matcher = grammar([apply(node.nodes[-1])])
-			return CallFunc(Getattr(CallFunc(Name('bool'),node.nodes[0]),
-				Name('__logand__')), [Const(matcher.apply('thing',0))])
-		else:
-			matcher = grammar([apply(And(node.nodes[1:])).rec(0)])
-			return CallFunc(Getattr(CallFunc(Name('bool'),node.nodes[0]),
-				Name('__logand__')), [Const(matcher.apply('thing',0))])
-	else:
-		# If we've not got an And node then simply recurse
-		try:
-			# map our transformation to members of any lists or tuples
-			if type(node) in [type([]), type((0,1))]:
-				return map(replace_ands, node)
-			# Stmt nodes are weird: their contents is [nodes] but asList only
-			# gives nodes, breaking the *varargs technique used below
-			if node.__class__ == Stmt:
-				return Stmt(map(replace_ands, node.asList()))
-			# If we're not in a list or Stmt, return a new instance of our
-			# class, with transformed children
-			return node.__class__(*map(replace_ands, node.asList()))
-		except:
-			# If an error occurs it's because strings, numbers, None, etc. don't
-			# have an asList method. Since they're leaves, just return them.
-			return node
+	# Thus we build strings out of all but the first and send them to the
+	# boolean value of the first, which will presumably eval each of them in
+	# turn until one is False, as with "or"
+	return CallFunc(Getattr(CallFunc(Name('bool'),[node.nodes[0]]), \
+		Name('__logand__')), [Const(to_string(n)) for n in node.nodes[1:]])
 
 def replace_nots(node):
-	"""Replace all occurances of "not" with calls to "__lognot__"."""
-	if node.__class__ == Not:
-		# We replace "not foo" with "bool(foo).__lognot__()
-		return CallFunc(Getattr(CallFunc(Name('bool'),[node.expr]), Name('__lognot__')), [])
-	else:
-		# If we've not got an Not node then simply recurse
-		try:
-			# map our transformation to members of any lists or tuples
-			if type(node) in [type([]), type((0,1))]:
-				return map(replace_nots, node)
-			# Stmt nodes are weird: their contents is [nodes] but asList only
-			# gives nodes, breaking the *varargs technique used below
-			if node.__class__ == Stmt:
-				return Stmt(map(replace_nots, node.asList()))
-			# If we're not in a list or Stmt, return a new instance of our
-			# class, with transformed children
-			return node.__class__(*map(replace_nots, node.asList()))
-		except:
-			# If an error occurs it's because strings, numbers, None, etc. don't
-			# have an asList method. Since they're leaves, just return them.
-			return node
+	"""Replace a "not" with a call to "__lognot__"."""
+	# We replace "not foo" with "bool(foo).__lognot__()
+	return CallFunc(Getattr(CallFunc(Name('bool'),[node.expr]), \
+		Name('__lognot__')), [])
+
+node_filters = {Or:[replace_ors], And:[replace_ands], Not:[replace_nots]}
 
 def replace_logic(node):
 	"""Replaces all boolean logic under this node with method calls."""
-	if node.__class__ == Or:
-		return replace_ors(node)
-	elif node.__class__ == And:
-		return replace_ands(node)
-	elif node.__class__ == Not:
-		return replace_nots(node)
-	else:
-		try:
-			# map our transformation to members of any lists or tuples
-			if type(node) in [type([]), type((0,1))]:
-				return map(replace_logic, node)
-			# Stmt nodes are weird: their contents is [nodes] but asList only
-			# gives nodes, breaking the *varargs technique used below
-			if node.__class__ == Stmt:
-				return Stmt(map(replace_logic, node.asList()))
-			# If we're not in a list or Stmt, return a new instance of our
-			# class, with transformed children
-			return node.__class__(*map(replace_logic, node.asList()))
-		except:
-			# If an error occurs it's because strings, numbers, None, etc. don't
-			# have an asList method. Since they're leaves, just return them.
-			return node
-
-extra_filters = [replace_logic]
+	return walk(node, node_filters)
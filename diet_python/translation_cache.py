@@ -0,0 +1,220 @@
+"""Caches the results of translating Python code to Diet Python.
+
+Translating a file means parsing it, transforming the tree and generating
+code from the result, which is a lot of work to redo for files which haven't
+changed since the last run. This stores each translation on disk, keyed by a
+hash of the source code, the initial indentation, the extra_filters in use
+(including the source of the modules they come from) and the version of the
+translator (every module in diet_python and python_rewriter), so that later
+runs can return the stored code without parsing anything.
+
+Results are stored in the directory given by the environment variable
+DIET_PYTHON_CACHE, or ~/.cache/diet_python if it isn't set. Set it to an
+empty string to turn caching off. DIET_PYTHON_CACHE_SIZE gives the most
+bytes to keep (default 64MB); when this is exceeded the least recently used
+entries are removed.
+
+The stats dictionary counts the hits, misses and evictions of this process.
+"""
+
+import os
+import sys
+import hashlib
+import tempfile
+import python_rewriter
+from python_rewriter.grammar_cache import pymeta_version
+
+# Change this whenever the contents of the cache files change
+cache_version = 1
+
+cache_dir = os.environ.get('DIET_PYTHON_CACHE',
+	os.path.join(os.path.expanduser('~'), '.cache', 'diet_python'))
+
+max_size = int(os.environ.get('DIET_PYTHON_CACHE_SIZE', 64*1024*1024))
+
+stats = {'hits':0, 'misses':0, 'evictions':0}
+
+# Our estimate of the cache's size, in bytes
+known_size = None
+
+rewriter_dir = os.path.dirname(os.path.abspath(python_rewriter.__file__))
+
+def file_version(path):
+	"""Identifies the version of the code in path by its size and
+	modification time."""
+	if path.endswith('.pyc') or path.endswith('.pyo'):
+		path = path[:-1]
+	try:
+		info = os.stat(path)
+		return '%s:%d:%d' % (path, info.st_size, info.st_mtime)
+	except OSError:
+		return path
+
+def directory_version(directory):
+	"""Returns the versions of the Python files in directory."""
+	try:
+		names = sorted([n for n in os.listdir(directory) if n.endswith('.py')])
+	except OSError:
+		return directory
+	return '\0'.join([file_version(os.path.join(directory, n))
+		for n in names])
+
+# The hashes of the files read by source_hash, keyed by their file_version
+source_hashes = {}
+
+def source_hash(path):
+	"""Returns a hash of the contents of the file at path."""
+	if path.endswith('.pyc') or path.endswith('.pyo'):
+		path = path[:-1]
+	version = file_version(path)
+	if version not in source_hashes:
+		try:
+			f = open(path, 'rb')
+			try:
+				source_hashes[version] = hashlib.sha1(f.read()).hexdigest()
+			finally:
+				f.close()
+		except IOError:
+			return path
+	return source_hashes[version]
+
+def module_version(name):
+	"""Returns the version of the loaded module called name, which includes
+	a hash of its source (so that edits made within the same second, or
+	which keep its size, are noticed)."""
+	module = sys.modules.get(name)
+	if module is None or not hasattr(module, '__file__'):
+		return name
+	return file_version(module.__file__)+':'+source_hash(module.__file__)
+
+def translator_version(path):
+	"""Returns a string which changes whenever the translator, whose code is
+	in path, does. This covers every module beside it (eg. replace_logic and
+	if_brancher) and in python_rewriter (the code generator, filters,
+	grammar_cache and so on), and PyMeta."""
+	# We look at the files rather than the loaded modules, since some are
+	# only imported once they're needed
+	return '\0'.join([str(cache_version), sys.version, pymeta_version(),
+		file_version(path),
+		directory_version(os.path.dirname(os.path.abspath(path))),
+		directory_version(rewriter_dir)])
+
+def filters_version(filters):
+	"""Returns a string identifying the given list of extra filters, which
+	includes the versions of the modules they come from."""
+	return '\0'.join([f.__module__+'.'+f.__name__+':'+module_version(f.__module__)
+		for f in filters])
+
+def cache_key(translator, code, initial_indent, filters):
+	"""Returns the hash which identifies the translation of code by the
+	translator whose code is in the file translator."""
+	key = hashlib.sha1()
+	for part in [translator_version(translator), filters_version(filters),
+		str(initial_indent), code]:
+		key.update(part)
+		key.update('\0')
+	return key.hexdigest()
+
+def entry_path(key):
+	return os.path.join(cache_dir, key+'.diet')
+
+def lookup(key):
+	"""Returns the translation stored for key, or None if there isn't
+	one."""
+	if not cache_dir:
+		return None
+	path = entry_path(key)
+	try:
+		f = open(path, 'rb')
+		try:
+			result = f.read()
+		finally:
+			f.close()
+	except IOError:
+		stats['misses'] += 1
+		return None
+	# Mark this entry as recently used, so it's kept when evicting
+	try:
+		os.utime(path, None)
+	except OSError:
+		pass
+	stats['hits'] += 1
+	return result
+
+def store(key, result):
+	"""Stores result as the translation for key, then evicts old entries
+	if the cache has grown too big."""
+	if not cache_dir:
+		return
+	try:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		# Write to a temporary file first and rename it, so that other
+		# processes never see half an entry
+		handle, temp_path = tempfile.mkstemp(dir=cache_dir)
+		f = os.fdopen(handle, 'wb')
+		try:
+			f.write(result)
+		finally:
+			f.close()
+		os.rename(temp_path, entry_path(key))
+	except (IOError, OSError):
+		# Not being able to cache is no reason to fail
+		return
+	# Scanning the whole cache after every store would be slow, so we keep
+	# a running total and only look again when it might be too big
+	global known_size
+	if known_size is None:
+		known_size = evict()
+	else:
+		known_size += len(result)
+		if known_size > max_size:
+			known_size = evict()
+
+def evict():
+	"""Removes the least recently used entries until the cache fits in
+	max_size bytes. Returns the size of what's left."""
+	entries = []
+	total = 0
+	try:
+		names = os.listdir(cache_dir)
+	except OSError:
+		return 0
+	for name in names:
+		if not name.endswith('.diet'):
+			continue
+		path = os.path.join(cache_dir, name)
+		try:
+			info = os.stat(path)
+		except OSError:
+			continue
+		entries.append((info.st_mtime, info.st_size, path))
+		total += info.st_size
+	if total <= max_size:
+		return total
+	entries.sort()
+	for mtime, size, path in entries:
+		if total <= max_size:
+			break
+		try:
+			os.remove(path)
+			stats['evictions'] += 1
+		except OSError:
+			pass
+		total -= size
+	return total
+
+class Recorder(object):
+	"""A file-like object which passes everything written to it on to out,
+	whilst keeping a copy so that it can be cached afterwards."""
+
+	def __init__(self, out):
+		self.out = out
+		self.parts = []
+
+	def write(self, text):
+		self.parts.append(text)
+		self.out.write(text)
+
+	def getvalue(self):
+		return ''.join(self.parts)
@@ -1,7 +1,20 @@
 """
-This contains a translator from annotated Python to regular Python,
-using PyMeta (a Python implementation of the OMeta pattern matching
-system)"""
+This contains a translator from annotated Python to regular Python. It
+removes every annotation, of the form 'meta{...}meta', leaving everything
+else exactly as it was.
+
+The code is read a line at a time and split into tokens by Python's
+tokenize module, so that 'meta{' and '}meta' are only recognised as part of
+the code, not inside strings or comments (eg. 'my_string = "meta{...}meta"'
+is left alone). Only the lines which haven't been written out yet are kept
+in memory, so files of any size can be stripped.
+
+Usage: annotation_remover.py input_path [output_path]
+       annotation_remover.py -code python_code [output_path]
+       annotation_remover.py input_directory output_directory
+
+Given a directory, every .py file beneath it is stripped into the same place
+beneath the output directory."""
 
 try:
 	import psyco
@@ -11,69 +24,188 @@ except:
 
 import os
 import sys
-from python_rewriter.base import strip_comments
-from pymeta.grammar import OMeta
+import tokenize
+from python_rewriter.sources import as_source, load_paths
 
-# Our metadata is found by traversing the code
+class LineBuffer(object):
+	"""Hands out the lines of an iterable to tokenize, keeping those which
+	haven't been copied (or skipped) yet, so that the text between tokens
+	can be copied exactly."""
 
-## TODO: Give comments and strings higher priority than code, so that
-## we don't accidentally remove '# meta{...}meta' or 
-## 'my_string = "meta{...}meta"'
-## 
-annotation_finder = """
-# Annotations are of the form 'meta{...}meta'
-annotation ::= <token 'meta{'> <annotation_contents>		=> ''
+	def __init__(self, lines):
+		self.lines = iter(lines)
+		# The lines read so far which we still need, by line number (which
+		# start at 1, like tokenize's)
+		self.kept = {}
+		self.read = 0
+		# Everything before this (line, column) has been dealt with
+		self.done = (1, 0)
 
-# If we've reached a '}meta' then stop matching, otherwise keep going
-annotation_contents ::= <token '}meta'>						=> ''
-                      | <anything> <annotation_contents>	=> ''
+	def readline(self):
+		try:
+			line = self.lines.next()
+		except StopIteration:
+			return ''
+		self.read += 1
+		self.kept[self.read] = line
+		return line
 
-# A statement is a series of annotations or anything else
-statement ::= <annotation>+									=> ''
-            | <anything>+:a									=> ''.join(a)
+	def advance(self, position):
+		"""Returns the text from where we'd got up to until position, and
+		moves on to position."""
+		(row, col), (end_row, end_col) = self.done, position
+		if (end_row, end_col) <= (row, col):
+			return ''
+		if row == end_row:
+			text = self.kept.get(row, '')[col:end_col]
+		else:
+			parts = [self.kept.get(row, '')[col:]]
+			for n in range(row + 1, end_row):
+				parts.append(self.kept.get(n, ''))
+			parts.append(self.kept.get(end_row, '')[:end_col])
+			text = ''.join(parts)
+		for n in range(row, end_row):
+			self.kept.pop(n, None)
+		self.done = position
+		return text
 
-# A program is a series of statements
-program ::= <statement>+:a									=> ''.join(a)
+	def rest(self):
+		"""Returns everything which hasn't been dealt with yet."""
+		return self.advance((self.read + 1, 0))
 
-"""
+def stripped(lines, path='<string>'):
+	"""Yields the code in the iterable lines (such as an open file) in
+	pieces, with its annotations removed. The pieces aren't necessarily
+	whole lines. path is only used in error messages."""
+	source = LineBuffer(lines)
+	# Where the current annotation started, or None when we're not in one
+	start = None
+	# The last token we saw, if it's a 'meta' or '}' which may be half of
+	# the start or end of an annotation
+	last = None
+	try:
+		for kind, text, begin, end, line in tokenize.generate_tokens(
+			source.readline):
+			if start is None:
+				if last is not None and last[1] == 'meta' and text == '{' \
+					and begin == last[3]:
+					# last was the start of an annotation, which we've
+					# already copied up to
+					start = last[2]
+					last = None
+					continue
+				piece = source.advance(begin)
+				if piece:
+					yield piece
+				if kind == tokenize.NAME and text == 'meta':
+					last = (kind, text, begin, end)
+				else:
+					last = None
+			else:
+				if last is not None and kind == tokenize.NAME and \
+					text.startswith('meta') and begin == last[3]:
+					# The annotation ends after the 'meta', which may be
+					# the start of a longer name
+					source.advance((begin[0], begin[1] + len('meta')))
+					start = None
+					last = None
+				elif kind == tokenize.OP and text == '}':
+					last = (kind, text, begin, end)
+				else:
+					last = None
+	except tokenize.TokenError:
+		# We only get these at the end, eg. from brackets inside annotations
+		# which don't match up, so we've already seen every token which
+		# matters
+		pass
+	if start is not None:
+		raise SyntaxError("Annotation isn't closed with '}meta'",
+			(path, start[0], start[1] + 1, None))
+	piece = source.rest()
+	if piece:
+		yield piece
 
-# Now we embed the transformations in every AST node, so that they can
-# apply them recursively to their children
-finder = OMeta.makeGrammar(strip_comments(annotation_finder), globals())
+def strip_file(in_path, out_path):
+	"""Writes the file at in_path to out_path, with its annotations
+	removed."""
+	out = open(out_path, 'w')
+	try:
+		strip_annotations(path=in_path, out=out)
+	finally:
+		out.close()
+
+def strip_directory(in_dir, out_dir):
+	"""Strips every .py file beneath in_dir into the same place beneath
+	out_dir. Returns a list of (path, error) for the files which couldn't be
+	stripped (and which haven't been written)."""
+	paths = []
+	for directory, dirs, files in os.walk(in_dir):
+		dirs.sort()
+		paths.extend([os.path.join(directory, name) for name in sorted(files)
+			if name.endswith('.py')])
+	failures = []
+	for source in load_paths(paths):
+		out_path = os.path.join(out_dir, os.path.relpath(source.path, in_dir))
+		target = os.path.dirname(out_path)
+		if not os.path.isdir(target):
+			os.makedirs(target)
+		out = open(out_path, 'w')
+		try:
+			strip_annotations(source, out)
+			out.close()
+		except (SyntaxError, EnvironmentError, tokenize.TokenError), e:
+			out.close()
+			failures.append((source.path, str(e)))
+			os.remove(out_path)
+	return failures
 
-def strip_annotations(path_or_text):
+def strip_annotations(source=None, out=None, path=None, text=None):
 	"""This performs the translation from annotated Python to normal
-	Python. It takes in annotated Python code (assuming the string to be
-	a file path, falling back to treating it as raw code if it is not a
-	valid path) and emits Python code."""
-	# See if the given string is a valid path
-	if os.path.exists(path_or_text):
-		# If so then open it and read the file contents into in_text
-		infile = open(path_or_text, 'r')
-		in_text = '\n'.join([line for line in infile.readlines()])
-		infile.close()
-	# Otherwise take the string contents to be in_text
-	else:
-		in_text = path_or_text
-		
-	# Wrap in try/except to give understandable error messages (PyMeta's
-	# are full of obscure implementation details)
+	Python. It takes in annotated Python code, as a Source (see
+	python_rewriter.sources), the path of a file (path=...) or the code
+	itself (text=...), and returns Python code. If a file object is given as
+	out then the code is written to it instead, as it's produced, and out is
+	returned."""
+	source = as_source(source, path, text)
 	try:
-		# Generate Python code
-		stripper = finder(in_text)
-		stripped_code = stripper.apply(program)
-		
-		print stripped_code
-		
-	except Exception, e:
-		sys.stderr.write(str(e)+'\n')
-		sys.stderr.write('Unable to strip.\n')
-		sys.exit(1)
+		if out is None:
+			return ''.join(stripped(source.lines(), source.name))
+		for piece in stripped(source.lines(), source.name):
+			out.write(piece)
+		return out
+	finally:
+		source.close()
 
 if __name__ == '__main__':
-	# TODO: Allow passing the initial indentation
-	# TODO: Allow specifying an output file
-	if len(sys.argv) == 2:
-		strip_annotations(sys.argv[1])
+	args = sys.argv[1:]
+	# "-code text" strips text rather than the file at a path
+	code = None
+	if '-code' in args:
+		i = args.index('-code')
+		code = args[i+1]
+		del args[i:i+2]
+	if code is None and len(args) == 2 and os.path.isdir(args[0]):
+		failures = strip_directory(args[0], args[1])
+		for path, error in failures:
+			sys.stderr.write('Unable to strip %s: %s\n' % (path, error))
+		sys.exit(failures and 1 or 0)
+	elif (code is None and len(args) in [1, 2]) or \
+		(code is not None and len(args) in [0, 1]):
+		try:
+			if code is None:
+				source = as_source(path=args.pop(0))
+			else:
+				source = as_source(text=code)
+			if args:
+				out = open(args[0], 'w')
+				strip_annotations(source, out)
+				out.close()
+			else:
+				strip_annotations(source, sys.stdout)
+		except (SyntaxError, IOError, tokenize.TokenError), e:
+			sys.stderr.write(str(e)+'\n')
+			sys.stderr.write('Unable to strip.\n')
+			sys.exit(1)
 	else:
-		print "Usage: annotation_remover.py input_path_or_raw_python_code"
+		print __doc__[__doc__.index('Usage:'):]
+		sys.exit(1)
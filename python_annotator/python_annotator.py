@@ -66,84 +66,167 @@ except:
 
 import os
 import sys
+import hashlib
 from python_rewriter.base import parse, constants
 from python_rewriter.nodes import *
+from python_rewriter.filters import node_fields
+from python_rewriter.sources import as_source
+from rule_sets import load_rules
+
+# Annotations are strings of Python expressions which should be true of a
+# node (referring to it as "node"). Every node has a frozenset of them as its
+# "annotations" attribute once it has been annotated, or None before then.
+Node.annotations = None
+# The key (see Annotator.annotate) of a node's subtree when it was annotated
+Node.annotation_key = None
+
+# The rules which give nodes their annotations, by node class. Each rule is
+# given a node and returns the annotations for it, which may only depend on
+# the node and its children (so that they can be remembered for identical
+# subtrees). They're loaded from the rule files in the "rules" directory (see
+# rule_sets.py); use rule_sets.load_rules(directory, annotation_rules) to add
+# more.
+annotation_rules = load_rules()
+
+def field_key(value, keys):
+	"""Returns the part of a node's key which comes from one of its fields,
+	given the keys of the nodes below it (by id)."""
+	if isinstance(value, Node):
+		return keys[id(value)]
+	if type(value) in [type([]), type((0,1))]:
+		return '[' + ','.join([field_key(v, keys) for v in value]) + ']'
+	return repr(value)
+
+class Annotator(object):
+	"""Annotates trees using the rules in a dictionary like
+	annotation_rules, remembering the annotations for each subtree it has
+	seen so that annotating the same code again (eg. after some other part
+	of a module has changed) doesn't run the rules again."""
+
+	def __init__(self, rules=None):
+		if rules is None:
+			rules = annotation_rules
+		self.rules = rules
+		# The annotations of each subtree we've seen, by key
+		self.memo = {}
+		# Each distinct set of annotations, so that nodes with the same
+		# annotations share a set
+		self.sets = {frozenset():frozenset()}
+		self.hits = 0
+		self.misses = 0
+
+	def annotations_for(self, node, key):
+		"""Returns the annotations for node, whose subtree has the given
+		key."""
+		try:
+			found = self.memo[key]
+			self.hits += 1
+			return found
+		except KeyError:
+			self.misses += 1
+		annotations = set()
+		for rule in self.rules.get(node.__class__, ()):
+			annotations.update(rule(node))
+		annotations = frozenset(annotations)
+		annotations = self.sets.setdefault(annotations, annotations)
+		self.memo[key] = annotations
+		return annotations
+
+	def annotate(self, tree):
+		"""Annotates every node in tree, returning the number of annotations
+		which have been added (ie. zero means nothing has changed).
+
+		Each subtree gets a key, which is a hash of its nodes' classes and
+		the values in its leaves, worked out from the keys of its children.
+		Nodes which were annotated when their subtree had the same key are
+		left alone, and others get the annotations remembered for their key
+		if there are any. We use a stack rather than recursing, since some
+		trees are very deep."""
+		# Put the nodes in order, parents before their children
+		ordered = []
+		stack = [tree]
+		while stack:
+			node = stack.pop()
+			ordered.append(node)
+			stack.extend(node.getChildNodes())
+		# Then go backwards, so that each node's children have their keys
+		count = 0
+		keys = {}
+		for node in reversed(ordered):
+			cls = node.__class__
+			key = hashlib.sha1(cls.__name__ + '(' + ','.join([
+				field_key(getattr(node, f), keys) for f in node_fields(cls)]) +
+				')').digest()
+			keys[id(node)] = key
+			if node.annotation_key == key and node.annotations is not None:
+				continue
+			annotations = self.annotations_for(node, key)
+			if node.annotations is None:
+				count += len(annotations)
+			else:
+				count += len(annotations - node.annotations)
+			node.annotations = annotations
+			node.annotation_key = key
+		return count
+
+# The Annotator used by add_annotations
+annotator = Annotator()
 
 def add_annotations(node):
 	"""This adds annotation assertions to the given node, and
 	recursively to its children. It returns the number of annotations
 	made (ie. zero means no changes too place)."""
-	# Initialise the change counter
-	count = 0
-	# We can't do anything to "types" so if we've been given one, return
-	if type(node) in [type(''), type((,)), type([]), type({}),
-		type(None), type(True)]:
-		return count
-	# Here we define the annotations we're going to check for
-	# TODO: Make this more extensible, ie. read them from some external
-	# source rather than having them hard-coded
-
-	# First give the node a set of annotations if it doesn't have one
-	if 'annotations' not in dir(node):
-		node.annotations = set([])
-
-	# Now go through each Node possibility
-	if node.__class__ == Add:
-		node.annotations = node.annotations.union(set([
-			'"__add__" in dir(node.left)',
-			'"__call__" in dir(node.left.__add__)'
-		]))
-
-	for child in node.asList():
-		count += add_annotations(child)
-	return count
-
-def annotate(path_or_text, initial_indent=0):
-	"""This performs the translation from annotated Python to normal
-	Python. It takes in annotated Python code (assuming the string to be
-	a file path, falling back to treating it as raw code if it is not a
-	valid path) and emits Python code."""
-	# See if the given string is a valid path
-	if os.path.exists(path_or_text):
-		# If so then open it and read the file contents into in_text
-		infile = open(path_or_text, 'r')
-		in_text = '\n'.join([line for line in infile.readlines()])
-		infile.close()
-	# Otherwise take the string contents to be in_text
-	else:
-		in_text = path_or_text
-
-	# Wrap in try/except to give understandable error messages (PyMeta's
-	# are full of obscure implementation details)
-	try:
-		# Get an Abstract Syntax Tree for the contents of in_text
-		tree = parse(in_text)
-
-		# Transform the Python AST into a Diet Python AST
-		annotated_tree = tree.ann()
-
-		#print str(tree)
-		#print str(diet_tree)
-
-		# Generate (Diet) Python code to match the transformed tree
-		annotated_code = annotated_tree.rec(initial_indent)
-
-		print str(tree)
-		print
-		print str(annotated_tree)
-		print
-
-		print annotated_code
-
-	except Exception, e:
-		sys.stderr.write(str(e)+'\n')
-		sys.stderr.write('Unable to annotate.\n')
-		sys.exit(1)
+	return annotator.annotate(node)
+
+def annotate(source=None, path=None, text=None):
+	"""This annotates Python code. It takes in Python code, as a Source (see
+	python_rewriter.sources), the path of a file (path=...) or the code
+	itself (text=...), and returns its annotated syntax tree."""
+	# Get an Abstract Syntax Tree for the code
+	tree = parse(as_source(source, path, text).text())
+	add_annotations(tree)
+	return tree
+
+def annotated_nodes(tree):
+	"""Returns the nodes in tree which have annotations, in order."""
+	found = []
+	stack = [tree]
+	while stack:
+		node = stack.pop()
+		if node.annotations:
+			found.append(node)
+		children = list(node.getChildNodes())
+		children.reverse()
+		stack.extend(children)
+	return found
 
 if __name__ == '__main__':
-	# TODO: Allow passing the initial indentation
 	# TODO: Allow specifying an output file
-	if len(sys.argv) == 2:
-		translate(sys.argv[1])
+	# "-rules directory" adds the rules in directory to our own
+	while '-rules' in sys.argv:
+		i = sys.argv.index('-rules')
+		load_rules(sys.argv[i+1], annotation_rules)
+		del sys.argv[i:i+2]
+	# "-code text" annotates text rather than the file at a path
+	code = None
+	if '-code' in sys.argv:
+		i = sys.argv.index('-code')
+		code = sys.argv[i+1]
+		del sys.argv[i:i+2]
+	if (len(sys.argv) == 1 and code is not None) or \
+		(len(sys.argv) == 2 and code is None):
+		try:
+			if code is None:
+				tree = annotate(path=sys.argv[1])
+			else:
+				tree = annotate(text=code)
+		except Exception, e:
+			sys.stderr.write(str(e)+'\n')
+			sys.stderr.write('Unable to annotate.\n')
+			sys.exit(1)
+		for node in annotated_nodes(tree):
+			for annotation in sorted(node.annotations):
+				print '%s %s: %s' % (node.lineno, repr(node), annotation)
 	else:
-		print "Usage: python_annotator.py input_path_or_raw_python_code"
+		print "Usage: python_annotator.py [-rules directory] " \
+			"(input_path | -code python_code)"
@@ -70,27 +70,33 @@ from python_rewriter.base import grammar_def, strip_comments, parse, constants
 from python_rewriter.nodes import *
 from pymeta.grammar import OMeta
 
-def get_units(tree, list=[]):
+def get_units(tree, found=None):
 	"""Returns a list of all externally reusable bits of code
-	(functions, classes, modules, etc.)."""
-	if tree.__class__ in [Function, Class, Module]:
-		to_return = []
-		for lst in map(get_units, tree.asList()):
-			to_return = to_return + lst
-		return list+[tree]+to_return
-	elif type(tree) in [type(''), type((1,2,3)), type([]), type({}),
-		type(None), type(True), type(False), type(Ellipsis), type(1)]:
-		return list
+	(functions, classes, modules, etc.), in the order they appear, after
+	those in found if it's given. We only look at nodes' children, so the
+	strings, numbers, etc. in the tree are skipped whatever their type."""
+	if found is None:
+		units = []
 	else:
-		to_return = []
-		for lst in map(get_units, tree.asList()):
-			to_return = to_return + lst
-		return list+to_return
+		units = found[:]
+	stack = [tree]
+	while stack:
+		node = stack.pop()
+		if node.__class__ in [Function, Class, Module]:
+			units.append(node)
+		children = list(node.getChildNodes())
+		children.reverse()
+		stack.extend(children)
+	return units
 
-tree = parse(''.join(open('reasoner.py', 'r').readlines()))
-print str(tree)
-print '#########################'
-print str(get_units(tree, []))
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print "Usage: reasoner.py file.py"
+		sys.exit(1)
+	tree = parse(open(sys.argv[1], 'r').read())
+	print str(tree)
+	print '#########################'
+	print str(get_units(tree))
 
 #def add(arg):
 #	"""Runs transformations on the argument. If the argument has a trans
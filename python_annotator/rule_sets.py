@@ -0,0 +1,149 @@
+"""Loads annotation rules from rule files, one per node class.
+
+A rule file is named after the class of node it annotates (eg. Add.rules for
+Add nodes). Each line is an annotation: a Python expression which should be
+true, referring to the node as "node". Annotations which only apply to some
+nodes of the class go in a "when" block, whose condition is also a Python
+expression about "node". For example:
+
+# Adding needs an __add__ method
+"__add__" in dir(node.left)
+when node.right.__class__ == Const:
+	node.right.value is not None
+
+Blank lines and lines starting with "#" are ignored.
+
+Each file is compiled into a single function, which takes a node and returns
+the frozenset of its annotations. The annotations which always apply are
+gathered into one set beforehand, and those sharing a condition are grouped,
+so each condition is checked once however many rules there are. The compiled
+code is cached on disk alongside PyMeta's grammars (see grammar_cache), keyed
+by a hash of the rule file, so rule files are only compiled when they
+change."""
+
+import os
+import sys
+import hashlib
+from python_rewriter import nodes
+from python_rewriter import grammar_cache
+from python_rewriter.grammar_cache import load, save
+
+# Change this whenever the generated code changes
+rules_version = 2
+
+# The rules which come with the annotator
+rules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
+
+def check(expression, path, lineno):
+	"""Raises a SyntaxError, pointing at the rule file, if expression isn't a
+	valid Python expression."""
+	try:
+		compile(expression, path, 'eval')
+	except SyntaxError, e:
+		raise SyntaxError(e.msg, (path, lineno, e.offset, expression))
+
+def parse_rules(text, path):
+	"""Returns the annotations in the rule file text which always apply, and
+	a list of (condition, annotations) for the rest."""
+	always = []
+	conditional = []
+	current = None
+	for lineno, line in enumerate(text.splitlines()):
+		lineno += 1
+		if not line.strip() or line.lstrip().startswith('#'):
+			continue
+		stripped = line.strip()
+		if line[0] in ' \t':
+			# Indented lines belong to the last "when"
+			if current is None:
+				raise SyntaxError('indented annotation outside a "when"',
+					(path, lineno, 1, line))
+			check(stripped, path, lineno)
+			current.append(stripped)
+		elif stripped.startswith('when ') and stripped.endswith(':'):
+			condition = stripped[len('when '):-1].strip()
+			check(condition, path, lineno)
+			current = []
+			conditional.append((condition, current))
+		else:
+			check(stripped, path, lineno)
+			always.append(stripped)
+			current = None
+	return always, conditional
+
+def generate(text, path):
+	"""Returns the source of a module defining "rules", the function for the
+	given rule file."""
+	always, conditional = parse_rules(text, path)
+	# Group the annotations by condition
+	groups = []
+	conditions = {}
+	for condition, annotations in conditional:
+		if condition not in conditions:
+			conditions[condition] = len(groups)
+			groups.append((condition, []))
+		groups[conditions[condition]][1].extend(annotations)
+	source = ['always = frozenset(%r)' % (always,)]
+	for n, (condition, annotations) in enumerate(groups):
+		source.append('group_%d = frozenset(%r)' % (n, annotations))
+	# The groups which apply are joined on in one go, since joining them one
+	# at a time would copy the annotations found so far every time
+	source.append('def rules(node):')
+	source.append('\textra = []')
+	for n, (condition, annotations) in enumerate(groups):
+		source.append('\tif (%s):' % condition)
+		source.append('\t\textra.append(group_%d)' % n)
+	source.append('\tif extra:')
+	source.append('\t\treturn always.union(*extra)')
+	source.append('\treturn always')
+	return '\n'.join(source) + '\n'
+
+def cache_key(text):
+	key = hashlib.sha1()
+	for part in [str(rules_version), sys.version, text]:
+		key.update(part)
+		key.update('\0')
+	return key.hexdigest()
+
+def compile_rules(text, path):
+	"""Returns the function for the rule file text (read from path), using
+	the cached code if there is any."""
+	cache_dir = grammar_cache.cache_dir
+	if cache_dir:
+		cache_path = os.path.join(cache_dir, cache_key(text)+'.rules')
+		entry = load(cache_path)
+	else:
+		entry = None
+	if entry is None:
+		source = generate(text, path)
+		entry = (source, compile(source, path, 'exec'))
+		if cache_dir:
+			save(cache_path, entry)
+	namespace = dict(nodes.__dict__)
+	eval(entry[1], namespace)
+	return namespace['rules']
+
+def load_rules(directory=rules_dir, rules=None):
+	"""Compiles the rule files in directory, returning a dictionary of node
+	classes to lists of rule functions (like
+	python_annotator.annotation_rules). If a dictionary is given as rules
+	then the new rules are added to it."""
+	if rules is None:
+		rules = {}
+	for name in sorted(os.listdir(directory)):
+		if not name.endswith('.rules'):
+			continue
+		cls = getattr(nodes, name[:-len('.rules')], None)
+		try:
+			is_node = issubclass(cls, nodes.Node)
+		except TypeError:
+			is_node = False
+		if not is_node:
+			raise ValueError(os.path.join(directory, name) +
+				" isn't named after a class of node")
+		path = os.path.join(directory, name)
+		f = open(path, 'r')
+		text = f.read()
+		f.close()
+		rules.setdefault(cls, []).append(compile_rules(text, path))
+	return rules
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""A persistent index of the units (modules, classes and functions, as found
+by reasoner.get_units) in a tree of Python files, so that they can be looked
+up by name without parsing everything again.
+
+The index is an SQLite database. For each unit it stores its name, its
+qualified name (the module's dotted name, followed by those of any classes
+and functions it's inside), its kind ("module", "class" or "function"), the
+file it's in, its first and last lines and a hash of its source. The last
+line is the last line which has a node of the unit on it, since
+compiler.ast doesn't record where nodes end.
+
+Files are parsed by a pool of worker processes. Refreshing the index only
+parses the files whose size or modification time has changed since they
+were last indexed, and drops the units of files which have gone.
+
+index = UnitIndex('units.db')
+index.refresh('path/to/code')
+for unit in index.lookup('foo'):
+	print unit.path, unit.first_line
+
+Usage: unit_index.py index.db [-refresh directory] [-jobs N] [-lookup name]"""
+
+import os
+import sys
+import sqlite3
+import hashlib
+from collections import namedtuple
+from multiprocessing import Pool
+from python_rewriter.base import parse
+from python_rewriter.nodes import *
+from python_rewriter.arena import Arena
+from python_rewriter.filters import node_fields
+
+# The kinds of units, by the class of their nodes
+kinds = {Module:'module', Class:'class', Function:'function'}
+
+# A row of the units table
+Unit = namedtuple('Unit', ['name', 'qualified_name', 'kind', 'path',
+	'first_line', 'last_line', 'hash'])
+
+schema = """
+create table if not exists files (
+	path text primary key,
+	mtime real,
+	size integer,
+	hash text,
+	error text
+);
+create table if not exists units (
+	name text,
+	qualified_name text,
+	kind text,
+	path text,
+	first_line integer,
+	last_line integer,
+	hash text
+);
+create index if not exists units_by_name on units (name);
+create index if not exists units_by_qualified_name on units (qualified_name);
+create index if not exists units_by_path on units (path);
+"""
+
+# How many files to index between commits
+batch_size = 500
+
+def module_name(root, path):
+	"""Returns the dotted name of the module at path, relative to root."""
+	name = os.path.splitext(os.path.relpath(path, root))[0].split(os.sep)
+	if name[-1] == '__init__' and len(name) > 1:
+		name = name[:-1]
+	return '.'.join(name)
+
+def source_hash(text):
+	return hashlib.sha1(text).hexdigest()
+
+def extract_units(text, module):
+	"""Returns (name, qualified name, kind, first line, last line, hash) for
+	each unit in the given code of the named module."""
+	lines = text.splitlines(True)
+	arena = Arena(parse(text))
+	found = []
+	# The qualified names of the units found so far, by entry
+	qualified = {}
+	for n in arena.units():
+		cls = arena.node_class(n)
+		if cls == Module:
+			name = module.split('.')[-1]
+			qualified[n] = module
+			first, last = 1, len(lines)
+		else:
+			name = arena.value(arena.children(n)[node_fields(cls).index('name')])
+			# Units come before those inside them, so the nearest enclosing
+			# unit has already been named
+			parent = arena.parents[n]
+			while parent not in qualified:
+				parent = arena.parents[parent]
+			qualified[n] = qualified[parent] + '.' + name
+			first = arena.linenos[n]
+			last = max(arena.linenos[n:arena.ends[n]])
+		found.append((name, qualified[n], kinds[cls], first, last,
+			source_hash(''.join(lines[first-1:last]))))
+	return found
+
+def index_file(job):
+	"""Reads and extracts the units of a file (in a worker process). job is
+	(path, module name, hash when last indexed or None). Returns (path, hash,
+	units, error message or None), where units is None if the contents
+	haven't changed (eg. the file has only been touched)."""
+	path, module, old_hash = job
+	try:
+		f = open(path, 'r')
+		text = f.read()
+		f.close()
+	except IOError, e:
+		return (path, None, [], str(e))
+	digest = source_hash(text)
+	if digest == old_hash:
+		return (path, digest, None, None)
+	try:
+		return (path, digest, extract_units(text, module), None)
+	except Exception, e:
+		return (path, digest, [], str(e) or e.__class__.__name__)
+
+def find_files(root):
+	"""Yields (path, modification time, size) for the Python files under
+	root."""
+	for directory, dirs, files in os.walk(root):
+		dirs.sort()
+		for f in sorted(files):
+			if f.endswith('.py'):
+				path = os.path.join(directory, f)
+				try:
+					info = os.stat(path)
+				except OSError:
+					continue
+				yield (path, info.st_mtime, info.st_size)
+
+class UnitIndex(object):
+	"""An index of units stored in the SQLite database at path (which is
+	created if needed)."""
+
+	def __init__(self, path):
+		self.db = sqlite3.connect(path)
+		self.db.text_factory = str
+		self.db.executescript(schema)
+
+	def close(self):
+		self.db.close()
+
+	def refresh(self, root, jobs=None):
+		"""Brings the index up to date with the Python files under root.
+		Returns the numbers of files (re)indexed, unchanged and removed."""
+		root = os.path.abspath(root)
+		known = {}
+		prefix = os.path.join(root, '')
+		hashes = {}
+		for path, mtime, size, digest in self.db.execute(
+			'select path, mtime, size, hash from files'):
+			if path.startswith(prefix):
+				known[path] = (mtime, size)
+				hashes[path] = digest
+		stats = {}
+		for path, mtime, size in find_files(root):
+			stats[path] = (mtime, size)
+		changed = [(path, module_name(root, path), hashes.get(path))
+			for path in sorted(stats) if known.get(path) != stats[path]]
+		removed = [path for path in known if path not in stats]
+
+		for path in removed:
+			self.forget(path)
+		if jobs == 1:
+			results = (index_file(job) for job in changed)
+		else:
+			pool = Pool(jobs)
+			results = pool.imap_unordered(index_file, changed, 16)
+		try:
+			for n, (path, digest, units, error) in enumerate(results):
+				self.store(path, stats[path], digest, units, error)
+				if n % batch_size == batch_size - 1:
+					self.db.commit()
+		finally:
+			if jobs != 1:
+				pool.terminate()
+				pool.join()
+			self.db.commit()
+		return len(changed), len(stats) - len(changed), len(removed)
+
+	def forget(self, path):
+		"""Removes a file and its units from the index."""
+		self.db.execute('delete from units where path = ?', (path,))
+		self.db.execute('delete from files where path = ?', (path,))
+
+	def store(self, path, stat, digest, units, error):
+		"""Replaces the entries for a file with the given ones. stat is the
+		file's (modification time, size). If units is None then only the
+		file's stat is updated."""
+		mtime, size = stat
+		if units is None:
+			self.db.execute('update files set mtime = ?, size = ? '
+				'where path = ?', (mtime, size, path))
+			return
+		self.forget(path)
+		self.db.execute('insert into files values (?, ?, ?, ?, ?)',
+			(path, mtime, size, digest, error))
+		self.db.executemany('insert into units values (?, ?, ?, ?, ?, ?, ?)',
+			[(name, qualified, kind, path, first, last, unit_hash)
+			for name, qualified, kind, first, last, unit_hash in units])
+
+	def query(self, where, args):
+		return [Unit(*row) for row in self.db.execute(
+			'select * from units where ' + where +
+			' order by path, first_line', args)]
+
+	def lookup(self, name):
+		"""Returns the units called name (either their plain or qualified
+		name)."""
+		return self.query('name = ? or qualified_name = ?', (name, name))
+
+	def units_in(self, path):
+		"""Returns the units in the file at path."""
+		return self.query('path = ?', (os.path.abspath(path),))
+
+	def errors(self):
+		"""Returns (path, error message) for the files which couldn't be
+		indexed."""
+		return list(self.db.execute('select path, error from files '
+			'where error is not null order by path'))
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if len(args) < 1:
+		print __doc__[__doc__.index('Usage:'):]
+		sys.exit(1)
+	index = UnitIndex(args[0])
+	jobs = None
+	if '-jobs' in args:
+		jobs = int(args[args.index('-jobs')+1])
+	if '-refresh' in args:
+		indexed, unchanged, removed = index.refresh(
+			args[args.index('-refresh')+1], jobs)
+		print '%d files indexed, %d unchanged, %d removed' % (indexed,
+			unchanged, removed)
+	if '-lookup' in args:
+		for unit in index.lookup(args[args.index('-lookup')+1]):
+			print '%s:%d-%d %s %s %s' % (unit.path, unit.first_line,
+				unit.last_line, unit.kind, unit.qualified_name, unit.hash)
+	index.close()
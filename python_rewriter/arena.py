@@ -0,0 +1,204 @@
+"""A flat, array-backed representation of syntax trees, for bulk analysis.
+
+Walking trees of compiler.ast objects means following pointers from object to
+object and making lists as we go, which is slow when we want to look at the
+trees of thousands of files. An Arena stores a whole tree in a few parallel
+arrays instead, with an entry for each node in the order they appear in the
+code (ie. each node comes before its children). Lists and tuples in the tree
+get entries too, as do the values in their leaves (names, numbers, etc.), so
+that the tree can be rebuilt exactly.
+
+For entry number n:
+ * kinds[n] is the kind of entry: an index into node_classes for a node, or
+   one of LIST, TUPLE, STRING or CONSTANT
+ * parents[n] is the entry which contains it, or -1 for the root
+ * ends[n] is one past its last descendant, so its subtree is entries n to
+   ends[n]-1, and its first child (if it has any) is n+1
+ * values[n] is, for a STRING, its index in strings (which stores each
+   distinct string once) or for a CONSTANT its index in constants
+ * linenos[n] is the line number of a node, or -1 if it doesn't have one
+
+The children of a node are the arguments given to its constructor (see
+filters.node_fields), in order.
+
+Use Arena(tree) to make one from the output of parse(), and arena.node(n) to
+get the tree at entry n (eg. arena.node(0) for the whole thing) back as
+ordinary nodes."""
+
+import compiler.ast
+from array import array
+from nodes import *
+from filters import node_fields, make_node
+from compact import compact_classes
+
+# Every kind of node, in order of their kind codes
+node_classes = []
+for name in sorted(dir(compiler.ast)):
+	cls = getattr(compiler.ast, name)
+	try:
+		if issubclass(cls, Node) and cls is not Node:
+			node_classes.append(cls)
+	except TypeError:
+		pass
+del name, cls
+
+# The kind codes for entries which aren't nodes
+LIST = len(node_classes)
+TUPLE = LIST + 1
+STRING = LIST + 2
+CONSTANT = LIST + 3
+
+# Looks up the kind code for a node's class (compact nodes get the same code
+# as the ordinary ones)
+kind_codes = {}
+for code, cls in enumerate(node_classes):
+	kind_codes[cls] = code
+	kind_codes[compact_classes[cls]] = code
+del code, cls
+
+# Marks the point where we've finished an entry's subtree
+END = object()
+
+class Arena(object):
+	"""Holds a tree as parallel arrays (see above)."""
+
+	def __init__(self, tree=None):
+		self.kinds = array('H')
+		self.parents = array('i')
+		self.ends = array('i')
+		self.values = array('i')
+		self.linenos = array('i')
+		self.strings = []
+		self.constants = []
+		# Looks up the index of each string in strings
+		self.string_index = {}
+		if tree is not None:
+			self.add(tree)
+
+	def __len__(self):
+		return len(self.kinds)
+
+	def intern(self, string):
+		"""Returns the index of string in strings, adding it if needed."""
+		try:
+			return self.string_index[string]
+		except KeyError:
+			self.string_index[string] = len(self.strings)
+			self.strings.append(string)
+			return len(self.strings) - 1
+
+	def add(self, tree, parent=-1):
+		"""Adds entries for tree, as a child of the entry parent, and returns
+		the number of its first entry. We use a stack rather than recursing,
+		so that deep trees don't hit the recursion limit."""
+		first = len(self.kinds)
+		stack = [(tree, parent)]
+		# The entries whose subtrees we're in the middle of
+		ends_needed = []
+		while stack:
+			item = stack.pop()
+			if item is END:
+				# This is the end of the subtree at the top of ends_needed
+				self.ends[ends_needed.pop()] = len(self.kinds)
+				continue
+			thing, parent = item
+			n = len(self.kinds)
+			lineno = -1
+			value = -1
+			if type(thing) == type([]):
+				kind = LIST
+				children = thing
+			elif type(thing) == type((0,1)):
+				kind = TUPLE
+				children = thing
+			elif thing.__class__ in kind_codes:
+				kind = kind_codes[thing.__class__]
+				children = [getattr(thing, f)
+					for f in node_fields(node_classes[kind])]
+				if thing.lineno is not None:
+					lineno = thing.lineno
+			elif type(thing) == type(''):
+				kind = STRING
+				children = ()
+				value = self.intern(thing)
+			else:
+				kind = CONSTANT
+				children = ()
+				value = len(self.constants)
+				self.constants.append(thing)
+			self.kinds.append(kind)
+			self.parents.append(parent)
+			self.ends.append(n+1)
+			self.values.append(value)
+			self.linenos.append(lineno)
+			if children:
+				ends_needed.append(n)
+				stack.append(END)
+				stack.extend([(c, n) for c in reversed(children)])
+		return first
+
+	def children(self, n):
+		"""Returns the numbers of the entries directly under entry n."""
+		found = []
+		child = n + 1
+		end = self.ends[n]
+		while child < end:
+			found.append(child)
+			child = self.ends[child]
+		return found
+
+	def is_node(self, n):
+		"""Is entry n an AST node (rather than a list, string, etc.)?"""
+		return self.kinds[n] < LIST
+
+	def node_class(self, n):
+		"""Returns the class of the node at entry n."""
+		return node_classes[self.kinds[n]]
+
+	def value(self, n):
+		"""Returns the value of the STRING or CONSTANT at entry n."""
+		if self.kinds[n] == STRING:
+			return self.strings[self.values[n]]
+		return self.constants[self.values[n]]
+
+	def node(self, n=0):
+		"""Rebuilds the tree at entry n out of ordinary nodes."""
+		# Build each entry after its children, going backwards through the
+		# subtree, so that we don't need to recurse
+		built = {}
+		for m in xrange(self.ends[n]-1, n-1, -1):
+			kind = self.kinds[m]
+			if kind == STRING or kind == CONSTANT:
+				built[m] = self.value(m)
+				continue
+			children = [built.pop(c) for c in self.children(m)]
+			if kind == LIST:
+				built[m] = children
+			elif kind == TUPLE:
+				built[m] = tuple(children)
+			else:
+				node = make_node(node_classes[kind], children)
+				if self.linenos[m] != -1:
+					node.lineno = self.linenos[m]
+				built[m] = node
+		return built[n]
+
+	def count(self):
+		"""Returns a dictionary of how many of each class of node there are."""
+		counts = [0] * LIST
+		for kind in self.kinds:
+			if kind < LIST:
+				counts[kind] += 1
+		return dict([(node_classes[k], c) for k, c in enumerate(counts) if c])
+
+	def find(self, classes):
+		"""Returns the numbers of the entries whose nodes are of the given
+		classes, in order."""
+		wanted = set([kind_codes[cls] for cls in classes])
+		return [n for n, kind in enumerate(self.kinds) if kind in wanted]
+
+	def units(self):
+		"""Returns the entries of the externally reusable bits of code
+		(functions, classes and modules), in the same order as
+		reasoner.get_units."""
+		return self.find([Function, Class, Module])
@@ -1,119 +1,355 @@
 #!/usr/bin/env python
 
+"""
+Benchmarks the code generators by timing how long they take on random ASTs of
+various shapes and sizes.
+
+Every tree is made from a random number generator seeded from the benchmark's
+seed and the tree's shape, size and bias, so the same options always give the
+same trees, and a run can be compared against an earlier one (eg. from before
+a change to the grammar) to see whether generating code has got slower.
+
+The shapes of tree are:
+ * arithmetic: a single expression of nested binary operators. The bias is how
+   likely each step down the tree is to go left rather than right, so 0 and 1
+   give long chains and 0.5 gives bushy trees.
+ * statements: a module of simple statements, ifs, whiles and fors. The bias
+   is how likely each new statement is to go inside the last compound
+   statement rather than beside it, so 0 gives flat code and 1 deep nesting.
+ * classes: a module of classes with methods. The bias is how likely each new
+   method is to go into the last class rather than a new one.
+"""
+
 import nodes
 import random
 import sys
+import hashlib
+from timeit import default_timer as timer
+from node_counter import count_nodes
+
+try:
+	import json
+except ImportError:
+	json = None
+
+usage = """Code generation benchmark.
+Usage: ast_generator.py max samples [-seed N] [-step N] [-repeat N]
+                        [-shapes a,b] [-emitters a,b] [-json out.json]
+                        [-baseline old.json] [-tolerance 0.25]
+Times each emitter on trees of every shape with 4 to max nodes (going up in
+steps of -step), and samples+1 biases from 0 to 1. Each tree is generated -repeat
+times and the fastest is kept. The results are written as JSON to -json ("-" for
+stdout). With -baseline, the totals for each emitter and shape are compared to
+those in the given results, and we exit with 1 if any are more than -tolerance
+(as a fraction) slower."""
+
+shapes = ['arithmetic', 'statements', 'classes']
+
+# The shortest time, in seconds, to spend on each timing of a tree
+minimum = 0.001
+
+def random_const(rng):
+	return nodes.Const(rng.randint(1,1000000))
 
 class Tree(object):
 	"""Stores an AST, along with various parameters about it."""
 
-	def __init__(self, count, bias):
-		"""Creates a Tree storing the given properties."""
-		self.count = count + count%2		# We round count to an even number
+	def __init__(self, count, bias, shape='arithmetic', rng=None):
+		"""Creates a Tree of the given shape with at least count nodes (and at
+		least 4). If rng isn't given then the random module is used."""
 		if count < 4:
 			count = 4
+		self.count = count
 		self.bias = bias
-		# We create an AST with a single number
-		self.ast = nodes.Module(None,nodes.Stmt([nodes.Discard(nodes.Const(random.randint(1,1000000)))]))
-		# This gives us 4 nodes as a starting point
-		self._count = 4
-		while self._count < self.count:
+		self.shape = shape
+		if rng is None:
+			rng = random.Random()
+		self.rng = rng
+		self.index = 0
+		if shape == 'arithmetic':
+			# We create an AST with a single number
+			self.ast = nodes.Module(None, nodes.Stmt([nodes.Discard(
+				random_const(rng))]))
+		else:
+			self.ast = nodes.Module(None, nodes.Stmt([nodes.Pass()]))
+		self.nodes = sum(count_nodes(self.ast).values())
+		while self.nodes < self.count:
 			self.add_nodes()
 
+	def name(self, prefix):
+		"""Returns a new name, starting with prefix."""
+		self.index += 1
+		return prefix + str(self.index)
+
 	def add_nodes(self):
+		"""Makes the tree bigger, according to its shape."""
+		getattr(self, 'add_'+self.shape)()
+
+	def add_arithmetic(self):
 		"""This picks a random path down the AST with the given left-right bias,
 		until it hits a Const. It then replaces the Const with an arithmetic
 		node, containing 2 Consts. This bumps up the node count by 2."""
-		
-		def swap_const(node, bias):
-			"""A helper function which drills down an AST to find a Const to
-			swap."""
-			if node.__class__ == nodes.Const:
-				cls = random.choice([nodes.Add,nodes.Sub,nodes.Mul,nodes.Mod,nodes.Div,nodes.Power])
-				return cls([nodes.Const(random.randint(1,1000000)),nodes.Const(random.randint(1,1000000))])
-			else:
-				if random.random < bias:
-					return node.__class__([swap_const(node.left, self.bias),node.right])
+		rng = self.rng
+		cls = rng.choice([nodes.Add, nodes.Sub, nodes.Mul, nodes.Mod,
+			nodes.Div, nodes.Power])
+		new = cls([random_const(rng), random_const(rng)])
+		parent = self.ast.node.nodes[0]
+		if parent.expr.__class__ == nodes.Const:
+			parent.expr = new
+		else:
+			# Walk down without recursing, since the trees can be deep
+			parent = parent.expr
+			while True:
+				if rng.random() < self.bias:
+					side = 'left'
 				else:
-					return node.__class__([node.left,swap_const(node.right, self.bias)])
-		self.ast = nodes.Module(None,nodes.Stmt([nodes.Discard(swap_const(self.ast.node.nodes[0].expr, self.bias))]))
-		self._count += 2
+					side = 'right'
+				child = getattr(parent, side)
+				if child.__class__ == nodes.Const:
+					setattr(parent, side, new)
+					break
+				parent = child
+		self.nodes += 2
+
+	def add_statements(self):
+		"""Adds a random statement, going into the last compound statement at
+		each level with probability bias."""
+		rng = self.rng
+		body = self.ast.node
+		while True:
+			last = body.nodes[-1]
+			if last.__class__ == nodes.If:
+				inner = last.tests[0][1]
+			elif last.__class__ in [nodes.While, nodes.For]:
+				inner = last.body
+			else:
+				break
+			if rng.random() >= self.bias:
+				break
+			body = inner
+		kind = rng.randint(0, 5)
+		if kind == 0:
+			new = nodes.Assign([nodes.AssName(self.name('x'), 'OP_ASSIGN')],
+				random_const(rng))
+		elif kind == 1:
+			new = nodes.Discard(nodes.CallFunc(nodes.Name(self.name('f')),
+				[random_const(rng)], None, None))
+		elif kind == 2:
+			new = nodes.AugAssign(nodes.Name(self.name('x')), '+=',
+				random_const(rng))
+		elif kind == 3:
+			new = nodes.If([(nodes.Compare(nodes.Name(self.name('x')),
+				[('<', random_const(rng))]), nodes.Stmt([nodes.Pass()]))],
+				None)
+		elif kind == 4:
+			new = nodes.While(nodes.Name(self.name('x')),
+				nodes.Stmt([nodes.Pass()]), None)
+		else:
+			new = nodes.For(nodes.AssName(self.name('i'), 'OP_ASSIGN'),
+				nodes.Name(self.name('xs')), nodes.Stmt([nodes.Pass()]), None)
+		body.nodes.append(new)
+		self.nodes += sum(count_nodes(new).values())
+
+	def add_classes(self):
+		"""Adds a method, to the last class with probability bias or else to a
+		new class."""
+		rng = self.rng
+		method = nodes.Function(None, self.name('m'), ['self', 'x'], [], 0,
+			None, nodes.Stmt([nodes.Return(nodes.Getattr(nodes.Name('self'),
+			self.name('a')))]))
+		statements = self.ast.node.nodes
+		if statements[-1].__class__ == nodes.Class and \
+			rng.random() < self.bias:
+			statements[-1].code.nodes.append(method)
+			self.nodes += sum(count_nodes(method).values())
+		else:
+			new = nodes.Class(self.name('C'), [nodes.Name('object')], None,
+				nodes.Stmt([method]))
+			statements.append(new)
+			self.nodes += sum(count_nodes(new).values())
+
+def tree_seed(seed, shape, count, bias):
+	"""Returns the seed for the random numbers of a particular tree. This
+	doesn't depend on which other trees are being made, so runs with
+	different sizes or biases still make the same trees where they overlap."""
+	key = '%d/%s/%d/%r' % (seed, shape, count, bias)
+	return int(hashlib.md5(key).hexdigest(), 16)
 
 class Sample(object):
 	"""A sample of ASTs with the given characteristics."""
 
-	def __init__(self, max_nodes, sample_number):
-		"""Creates a sample of Trees. The sample contains random Trees starting
-		with 4 nodes (Module(Stmt([Discard(Const(x))]))) and going up to
-		max_nodes nodes. The sample contains sample_number Trees of each number
-		of nodes, with an even spread from left-leaning to right-leaning."""
+	def __init__(self, max_nodes, sample_number, shape='arithmetic', seed=0,
+		step=2):
+		"""Creates a sample of Trees. The sample contains random Trees of the
+		given shape starting with 4 nodes and going up to max_nodes nodes, in
+		steps of step. The sample contains sample_number+1 Trees of each number
+		of nodes, with an even spread of biases from 0 to 1."""
 		self.max_nodes = max_nodes
 		self.sample_number = sample_number
-		self.biases = [float(b)/float(self.sample_number) for b in range(self.sample_number+1)]
+		self.shape = shape
+		self.seed = seed
+		self.sizes = range(4, self.max_nodes+1, step)
+		self.biases = [float(b)/float(max(self.sample_number, 1))
+			for b in range(self.sample_number+1)]
 		self.trees = {}
-		for n in range(4,self.max_nodes,2):
+		for n in self.sizes:
 			self.trees[n] = []
 			for bias in self.biases:
-				sys.stderr.write('.')
-				sys.stderr.flush()
-				self.trees[n].append(Tree(n,bias))
+				rng = random.Random(tree_seed(seed, shape, n, bias))
+				self.trees[n].append(Tree(n, bias, shape, rng))
 
-	def time(self,grammar):
-		"""Times how long it takes for the given grammar to parse the ASTs in
-		this sample."""
+	def time(self, emit, repeat=5):
+		"""Times how long it takes for the function emit to generate code for
+		each of the ASTs in this sample, keeping the best of repeat runs.
+		Returns a dictionary of sizes to dictionaries of biases to times in
+		seconds (or None if emit failed)."""
 
 		def time_tree(tree):
-			"""Helper function to time an individual Tree."""
-			sys.stderr.write(',')
-			sys.stderr.flush()
-			results = []
-			matcher = base.grammar([tree.ast])
-			start_time = time.clock()
-			for _ in xrange(100):
-				try:
-					code, err = matcher.apply("thing", 0)
-					results.append(code)
-					del(code)
-					del(err)
-				except ParseError, e:
-					continue
-		
-			end_time = time.clock()
-			return float(end_time - start_time) / float(len(results))
+			"""Helper function to time an individual Tree. Quick trees are
+			generated several times over for each run, so that the timings
+			aren't lost in the clock's resolution."""
+			try:
+				start_time = timer()
+				emit(tree.ast)
+				taken = timer() - start_time
+			except Exception:
+				return None
+			loops = int(minimum / max(taken, 1e-9)) + 1
+			best = None
+			for _ in xrange(repeat):
+				start_time = timer()
+				for _ in xrange(loops):
+					emit(tree.ast)
+				taken = (timer() - start_time) / loops
+				if best is None or taken < best:
+					best = taken
+			return best
 
 		self.times = {}
-		for n in range(4,self.max_nodes,2):
+		for n in self.sizes:
 			self.times[n] = {}
-			for i,tree in enumerate(self.trees[n]):
-				self.times[n][str(self.biases[i])] = time_tree(tree)
-				tree = None
-
+			for i, tree in enumerate(self.trees[n]):
+				self.times[n][self.biases[i]] = time_tree(tree)
 		return self.times
 
-def make_graph(d):
-	"""Converts a dictionary given by Sample.time into a graph."""
-	points = []
-	keys = d.keys()
-	keys.sort
-	for n in keys:
-		keys2 = d[n].keys()
-		keys2.sort()
-		l = []
-		for k in keys2:
-			l.append(d[n][k])
-		points.append(l)
-
-	import enthought.mayavi.mlab
-	surface = enthought.mayavi.mlab.surf(points)
-	enthought.mayavi.mlab.show()
+def emitters():
+	"""Returns a dictionary of the code generators to time, each a function
+	taking an AST."""
+	import base
+	import emitter
+	return {
+		'grammar':lambda ast: base.grammar([ast]).apply('python', 0),
+		'dispatch':lambda ast: base.dispatch_grammar([ast]).apply('python', 0),
+		'emitter':lambda ast: emitter.emit(ast, 0)
+	}
+
+def run(max_nodes, sample_number, shape_names=shapes, emitter_names=None,
+	seed=0, step=2, repeat=5):
+	"""Runs the benchmark and returns its results, ready to be stored as
+	JSON."""
+	generators = emitters()
+	if emitter_names is None:
+		emitter_names = sorted(generators.keys())
+	results = {'seed':seed, 'max_nodes':max_nodes, 'samples':sample_number,
+		'step':step, 'repeat':repeat, 'times':[]}
+	for shape in shape_names:
+		sample = Sample(max_nodes, sample_number, shape, seed, step)
+		for name in emitter_names:
+			times = sample.time(generators[name], repeat)
+			for n in sample.sizes:
+				for tree in sample.trees[n]:
+					results['times'].append({'emitter':name, 'shape':shape,
+						'size':n, 'bias':tree.bias, 'nodes':tree.nodes,
+						'seconds':times[n][tree.bias]})
+	return results
+
+def totals(results):
+	"""Returns a dictionary of (emitter, shape) to (total seconds, total
+	nodes, failures) from the given results."""
+	found = {}
+	for t in results['times']:
+		key = (t['emitter'], t['shape'])
+		seconds, count, failed = found.get(key, (0.0, 0, 0))
+		if t['seconds'] is None:
+			failed += 1
+		else:
+			seconds += t['seconds']
+			count += t['nodes']
+		found[key] = (seconds, count, failed)
+	return found
+
+def compare(results, baseline, tolerance):
+	"""Compares results against baseline, only using the trees which are in
+	both. Returns a list of (emitter, shape, old seconds, new seconds) and a
+	list of those which are more than tolerance slower."""
+	def key(t):
+		return (t['emitter'], t['shape'], t['size'], t['bias'])
+	old = dict([(key(t), t['seconds']) for t in baseline['times']])
+	sums = {}
+	for t in results['times']:
+		k = key(t)
+		if k in old and old[k] is not None and t['seconds'] is not None:
+			before, after = sums.get(k[:2], (0.0, 0.0))
+			sums[k[:2]] = (before + old[k], after + t['seconds'])
+	rows = [(e, s, before, after)
+		for (e, s), (before, after) in sorted(sums.items())]
+	slower = [r for r in rows if r[3] > r[2] * (1 + tolerance)]
+	return rows, slower
 
 if __name__ == '__main__':
-	import time
-	import base
-	from pymeta.runtime import ParseError
-	if len(sys.argv) != 3:
-		print 'Usage: ast_generator.py max repeats'
-		sys.exit(0)
-	sample = Sample(int(sys.argv[1]), int(sys.argv[2]))
-	make_graph(sample.time(base.grammar))
-	raw_input()
+	args = sys.argv[1:]
+	options = {}
+	for option in ['-seed', '-step', '-repeat', '-shapes', '-emitters',
+		'-json', '-baseline', '-tolerance']:
+		if option in args:
+			i = args.index(option)
+			options[option] = args[i+1]
+			del args[i:i+2]
+	if len(args) != 2:
+		print usage
+		sys.exit(1)
+	# The grammars recurse once per level of the tree
+	sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
+	shape_names = shapes
+	if '-shapes' in options:
+		shape_names = options['-shapes'].split(',')
+	emitter_names = None
+	if '-emitters' in options:
+		emitter_names = options['-emitters'].split(',')
+	results = run(int(args[0]), int(args[1]), shape_names, emitter_names,
+		int(options.get('-seed', 0)), int(options.get('-step', 2)),
+		int(options.get('-repeat', 5)))
+
+	if '-json' in options:
+		if options['-json'] == '-':
+			out = sys.stdout
+		else:
+			out = open(options['-json'], 'w')
+		json.dump(results, out, indent=1, sort_keys=True)
+		out.write('\n')
+		if out is not sys.stdout:
+			out.close()
+
+	report = sys.stderr
+	if '-json' not in options:
+		report = sys.stdout
+	for (name, shape), (seconds, count, failed) in \
+		sorted(totals(results).items()):
+		report.write('%-10s %-12s %9.4f seconds %8.2f microseconds/node'
+			'%s\n' % (name, shape, seconds, 1e6 * seconds / max(count, 1),
+			failed and ' (%d failed)' % failed or ''))
+
+	if '-baseline' in options:
+		f = open(options['-baseline'], 'r')
+		baseline = json.load(f)
+		f.close()
+		rows, slower = compare(results, baseline,
+			float(options.get('-tolerance', 0.25)))
+		report.write('Compared with %s:\n' % options['-baseline'])
+		for name, shape, before, after in rows:
+			report.write('%-10s %-12s %9.4f -> %9.4f seconds (%+.1f%%)%s\n' % (
+				name, shape, before, after, 100 * (after / before - 1),
+				(name, shape, before, after) in slower and ' SLOWER' or ''))
+		if slower:
+			sys.exit(1)
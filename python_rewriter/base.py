@@ -11,6 +11,8 @@ from sys import version_info as v, argv, exit
 import compiler
 import compiler.ast as ast
 from pymeta.grammar import OMeta as OM
+from pymeta.runtime import ParseError, EOFError, expected
+from grammar_cache import make_grammar
 from nodes import *
 try:
 	import psyco
@@ -104,6 +106,44 @@ def set_defaults(argnames, defaults):
 	# And we're done
 	return ','.join(to_return)
 
+def strip_comments(grammar):
+	"""Removes the comment lines from an OMeta grammar definition."""
+	return '\n'.join([line for line in grammar.split('\n')
+		if not line.strip().startswith('#')])
+
+# Whether each grammar class has the same rules as grammar (see
+# same_rules)
+rules_checked = {}
+
+def same_rules(cls):
+	"""Does the grammar class cls use the same rules as grammar, so that
+	emitter.emit gives the same code as it does? Subclasses which only add
+	rules do, but those which override any of ours don't."""
+	try:
+		return rules_checked[cls]
+	except KeyError:
+		same = True
+		for name in dir(grammar):
+			if name.startswith('rule_') and \
+				getattr(cls, name).im_func is not getattr(grammar, name).im_func:
+				same = False
+				break
+		rules_checked[cls] = same
+		return same
+
+def write_python(matcher, tree, i, out):
+	"""Writes the code for the given tree, with i tabs of initial indentation,
+	to the file-like object out, giving the same code as the "python" rule of
+	matcher's grammar. If that grammar has the same rules as ours then the
+	code is written as it's generated by emitter.emit, otherwise it has to be
+	built by the grammar's rules and then written."""
+	if same_rules(matcher.__class__):
+		from emitter import emit
+		return emit(tree, i, out)
+	code, err = matcher.__class__([tree]).apply('python', i)
+	out.write(code)
+	return out
+
 def make_list(foo):
 	"""Returns the argument if it has a length, otherwise returns an empty list.
 	"""
@@ -119,6 +159,12 @@ grammar_def = """#
 # indentation.
 python :i ::= <thing i>:t => t
 
+# "python_to" is like "python", but writes the code to the file-like object
+# "out" as it is generated, rather than building it up as one string. This is
+# done by emitter.emit, unless this grammar overrides some of our rules (see
+# write_python), so it always gives the same code as "python".
+python_to :i :out ::= <anything>:a !(write_python(self, a, i, out)) => out
+
 # A "thing" matches an AST node or a constant (constants can be supplied
 # through the global "constants")
 thing :i ::= <node i>:t => ''.join(t)
@@ -127,79 +173,82 @@ thing :i ::= <node i>:t => ''.join(t)
 # A "node" is an AST node. The handling of each is deferred to the
 # appropriate rule for that node type. Note that the order is mostly arbitrary,
 # since the definitions don't overlap, except for "delete" which must occur
-# first. The rest are alphabetical, for lack of a better order.
-node :i ::= <delete i>:d => d
-          | <name i>:n => n
+# before the rules for the nodes it overlaps with (assname, assattr, asstuple,
+# slice and subscript). The rest are in order of how common each node is, so
+# that as few alternatives as possible get tried; run node_order.py on a
+# profile made by node_counter.py to regenerate it.
+node :i ::= <name i>:n => n
+          | <const i>:c => c
           | <getattr i>:g => g
           | <callfunc i>:c => c
-          | <const i>:c => c
           | <stmt i>:s => s
           | <assign i>:a => a
+          | <delete i>:d => d
           | <assname i>:a => a
-          | <discard i>:d => d
           | <if i>:g => g
-          | <function i>:f => f
           | <compare i>:c => c
+          | <discard i>:d => d
+          | <function i>:f => f
+          | <return i>:r => r
           | <subscript i>:s => s
           | <assattr i>:a => a
-          | <return i>:r => r
-          | <keyword i>:k => k
-          | <tuple i>:t => t
           | <add i>:a => a
-          | <from i>:f => f
-          | <list i>:l => l
-          | <printnl i>:p => p
-          | <for i>:f => f
+          | <tuple i>:t => t
+          | <raise i>:r => r
           | <not i>:n => n
+          | <slice i>:s => s
+          | <keyword i>:k => k
+          | <asstuple i>:a => a
           | <mod i>:m => m
-          | <class i>:c => c
+          | <list i>:l => l
+          | <for i>:f => f
           | <tryexcept i>:t => t
-          | <unarysub i>:u => u
-          | <import i>:g => g
           | <and i>:a => a
-          | <dict i>:d => d
-          | <augassign i>:a => a
-          | <asstuple i>:a => a
-          | <raise i>:r => r
-          | <slice i>:s => s
+          | <import i>:g => g
+          | <unarysub i>:u => u
           | <sub i>:s => s
-          | <module i>:m => m
+          | <printnl i>:p => p
+          | <class i>:c => c
           | <or i>:o => o
-          | <pass i>:p => p
+          | <augassign i>:a => a
+          | <while i>:w => w
           | <mul i>:m => m
-          | <assert i>:a => a
+          | <pass i>:p => p
+          | <dict i>:d => d
+          | <break i>:b => b
+          | <from i>:f => f
+          | <continue i>:c => c
+          | <bitand i>:b => b
+          | <module i>:m => m
+          | <tryfinally i>:t => t
           | <listcompfor i>:l => l
+          | <yield i>:y => y
           | <listcomp i>:l => l
-          | <div i>:d => d
-          | <tryfinally i>:t => t
-          | <break i>:b => b
+          | <decorators i>:d => d
+          | <assert i>:a => a
+          | <with i>:w => w
           | <lambda i>:l => l
+          | <print i>:p => p
+          | <power i>:p => p
+          | <floordiv i>:e => e
+          | <leftshift i>:l => l
           | <bitor i>:b => b
-          | <continue i>:c => c
-          | <while i>:w => w
-          | <backquote i>:b => b
-          | <decorators i>:d => d
+          | <genexprfor i>:g => g
+          | <ifexp i>:g => g
           | <global i>:g => g
-          | <listcompif i>:l => l
-          | <power i>:p => p
           | <genexpr i>:g => g
-          | <genexprfor i>:g => g
           | <genexprinner i>:g => g
-          | <floordiv i>:e => e
-          | <asslist i>:a => a
-          | <bitand i>:b => b
-          | <yield i>:y => y
-          | <exec i>:e => e
-          | <ifexp i>:g => g
-          | <print i>:p => p
-          | <with i>:w => w
-          | <unaryadd i>:u => u
-          | <genexprif i>:g => g
+          | <div i>:d => d
           | <rightshift i>:r => r
-          | <leftshift i>:l => l
+          | <listcompif i>:l => l
           | <bitxor i>:b => b
-          | <sliceobj i>:s => s
+          | <exec i>:e => e
+          | <genexprif i>:g => g
           | <invert i>:g => g
+          | <asslist i>:a => a
+          | <sliceobj i>:s => s
+          | <unaryadd i>:u => u
+          | <backquote i>:b => b
           | <ellipsis i>:e => e
           | <emptynode i>:e => e
           | <expression i>:e => e
@@ -598,28 +647,124 @@ args['tuple_args'] = tuple_args
 args['is_del'] = is_del
 args['pick_quotes'] = pick_quotes
 args['make_list'] = make_list
+args['write_python'] = write_python
 args['sys'] = sys
 
 # grammar is the class, instances of which can match using grammar_def
-grammar = OM.makeGrammar(grammar_def, args)
+grammar = make_grammar(grammar_def, args)
+
+class TreeInput(object):
+	"""An input stream for matching trees, used in place of PyMeta's
+	InputStream. Rather than a list and a position, the input is a linked
+	stack: each TreeInput holds the next value and the TreeInput for the rest
+	of the input. Since a TreeInput never changes, pushing a value on to the
+	input (see ins) is just making a new TreeInput on top of the current one,
+	and memo entries stay valid for as long as their TreeInput exists."""
+
+	def fromIterable(cls, iterable):
+		"""Makes a TreeInput for the values in iterable."""
+		data = list(iterable)
+		# The end of the input has no value and no tail
+		stream = cls(None, None, len(data))
+		for position in range(len(data)-1, -1, -1):
+			stream = cls(data[position], stream, position)
+		return stream
+	fromIterable = classmethod(fromIterable)
+
+	def __init__(self, value, tl, position):
+		self.value = value
+		self.tl = tl
+		self.position = position
+		self.memo = {}
+
+	def __repr__(self):
+		"""Shows the values left in the input, from this one on."""
+		values = []
+		stream = self
+		while stream.tl is not None:
+			values.append(stream.value)
+			stream = stream.tl
+		return 'TreeInput(%r, position=%d)' % (values, self.position)
+
+	def head(self):
+		if self.tl is None:
+			raise EOFError(self.position)
+		return self.value, [self.position, None]
+
+	def tail(self):
+		return self.tl
+
+	def nullError(self):
+		return [self.position, None]
+
+	def getMemo(self, name):
+		return self.memo.get(name, None)
+
+	def setMemo(self, name, rec):
+		self.memo[name] = rec
+		return rec
+
+# Patch the grammar to use TreeInput
+def tree_init(self, data, globals=None):
+	"""Replaces the __init__ of PyMeta grammars, so that their input is a
+	TreeInput."""
+	OM.__init__(self, [], globals)
+	self.input = TreeInput.fromIterable(data)
+	self.currentError = self.input.nullError()
 
 # Patch the grammar for recursion
 def ins(self, val):
-	"""This is a very dangerous function! We monkey-patch PyMeta grammars with
-	this so that we can insert an arbitrary value as the next input. This allows
-	us to recurse without having to	instantiate another matcher (we effectively
-	use the existing input as a stack). Beware of leaving cruft behind on the
-	input!"""
-	# Insert the value
-	self.input.data.insert(self.input.position, val)
-	# Throw away any cached input
-	self.input.tl = None
-	self.input.memo = {}
+	"""We monkey-patch PyMeta grammars with this so that we can push an
+	arbitrary value on to the input, to be matched next. This allows us to
+	recurse without having to instantiate another matcher. Since the input is
+	a TreeInput this takes constant time, and if the rule fails then the value
+	is discarded along with the rest of its input when PyMeta backtracks."""
+	self.input = TreeInput(val, self.input, self.input.nullError()[0])
 	# Ensure success, if needed
 	return True
 
+grammar.__init__ = tree_init
 grammar.ins = ins
 
+# The "node" rule above tries every alternative in turn until one matches, so
+# the rarer a node type is the more failed alternatives it has to pay for. Since
+# every alternative starts by checking the class of the node, we can instead
+# look up the class in a table and go straight to the rule(s) which can handle
+# it. The order here doesn't matter, except that "delete" must be tried before
+# the regular rule for those classes which can represent deletions.
+node_rules = {}
+for cls in [Add, And, AssAttr, AssList, AssName, AssTuple, Assert, Assign,
+	AugAssign, Backquote, Bitand, Bitor, Bitxor, Break, CallFunc, Class,
+	Compare, Const, Continue, Decorators, Dict, Discard, Div, Ellipsis,
+	EmptyNode, Exec, Expression, FloorDiv, For, From, Function, GenExpr,
+	GenExprFor, GenExprIf, GenExprInner, Getattr, Global, If, IfExp, Import,
+	Invert, Keyword, Lambda, LeftShift, List, ListComp, ListCompFor,
+	ListCompIf, Mod, Module, Mul, Name, Not, Or, Pass, Power, Print, Printnl,
+	Raise, Return, RightShift, Slice, Sliceobj, Stmt, Sub, Subscript,
+	TryExcept, TryFinally, Tuple, UnaryAdd, UnarySub, While, With, Yield]:
+	node_rules[cls] = [cls.__name__.lower()]
+for cls in [AssAttr, AssName, AssTuple, Slice, Subscript]:
+	node_rules[cls] = ['delete'] + node_rules[cls]
+del cls
+
+def dispatch_node(self, i):
+	"""A drop-in replacement for the "node" rule, which picks the rules to try
+	by looking up the class of the next input in node_rules, rather than trying
+	each alternative in turn."""
+	a, err = self.input.head()
+	try:
+		rules = node_rules[a.__class__]
+	except (KeyError, TypeError):
+		raise ParseError(err[0], expected('AST node'))
+	return self._or([lambda r=r: self._apply(getattr(self, 'rule_'+r), r, [i])
+		for r in rules])
+
+class dispatch_grammar(grammar):
+	"""A code generator which gives the same output as grammar, but dispatches
+	each node straight to its rule. Use this for bulk generation, or as the
+	class to extend if your own rules don't need to override "node"."""
+	rule_node = dispatch_node
+
 def parse(code):
 	"""This parses the given code using Python's compiler module, but
 	with our monkey patching applied to the nodes."""
@@ -0,0 +1,94 @@
+"""A compact version of the AST node classes, for holding lots of trees.
+
+compiler.ast's nodes are old-style classes, so every one of them has its own
+__dict__. This module has a class for each of them (with the same name, in
+compact_classes) which uses __slots__ instead, which takes a fraction of the
+memory. They're made with the same constructor arguments as the originals
+and have the same asList, getChildren, getChildNodes and repr, but they don't
+have rec or any of the other things which get patched into Node, so our
+grammars can't be run on them directly.
+
+Use to_compact(tree) to get a compact copy of a tree, and from_compact(tree)
+to get an ordinary one back, eg. to translate it."""
+
+import compiler.ast
+from nodes import *
+from filters import node_fields, make_node
+
+class CompactNode(object):
+	"""The superclass of every compact node. Like compiler.ast.Node, its
+	children are given by getChildren."""
+	__slots__ = ()
+
+	def __init__(self, lineno=None):
+		self.lineno = lineno
+
+for name in ['getChildren', 'getChildNodes', 'asList', '__iter__']:
+	setattr(CompactNode, name, getattr(compiler.ast.Node, name).im_func)
+del name
+
+def attribute_names(cls):
+	"""Returns the names of the attributes set by the constructor of the
+	given node class. As well as the constructor's arguments these can
+	include some which it works out, like Function's varargs."""
+	names = node_fields(cls) + ['lineno']
+	try:
+		code = cls.__init__.im_func.func_code
+	except AttributeError:
+		return names
+	# The only other names the constructors use are globals of compiler.ast
+	for n in code.co_names:
+		if n not in names and not hasattr(compiler.ast, n):
+			names.append(n)
+	return names
+
+def make_compact_class(cls):
+	"""Makes a compact version of the node class cls."""
+	members = {'__slots__':tuple(attribute_names(cls)),
+		'__module__':__name__}
+	for name in ['__init__', 'getChildren', 'getChildNodes', '__repr__']:
+		method = cls.__dict__.get(name)
+		if method is not None:
+			members[name] = method
+	return type(cls.__name__, (CompactNode,), members)
+
+# Maps each node class to its compact equivalent, and back again
+compact_classes = {}
+original_classes = {}
+for name in dir(compiler.ast):
+	cls = getattr(compiler.ast, name)
+	try:
+		if not issubclass(cls, Node) or cls is Node:
+			continue
+	except TypeError:
+		continue
+	compact_classes[cls] = make_compact_class(cls)
+	original_classes[compact_classes[cls]] = cls
+del name, cls
+
+def convert(tree, classes):
+	"""Copies tree, changing the class of every node to the one given for it
+	in the dictionary classes."""
+	if type(tree) == type([]):
+		return [convert(n, classes) for n in tree]
+	if type(tree) == type((0,1)):
+		return tuple([convert(n, classes) for n in tree])
+	try:
+		new_class = classes[tree.__class__]
+	except (KeyError, AttributeError, TypeError):
+		# Strings, numbers, None, etc. are kept as they are
+		return tree
+	# Both kinds of node take the same constructor arguments
+	original = original_classes.get(tree.__class__, tree.__class__)
+	node = make_node(new_class,
+		[convert(getattr(tree, n), classes) for n in node_fields(original)])
+	node.lineno = tree.lineno
+	return node
+
+def to_compact(tree):
+	"""Returns a copy of the given tree made of compact nodes."""
+	return convert(tree, compact_classes)
+
+def from_compact(tree):
+	"""Returns a copy of the given compact tree made of ordinary nodes."""
+	return convert(tree, original_classes)
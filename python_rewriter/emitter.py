@@ -0,0 +1,544 @@
+"""This module is a second code generator for the Syntax Trees used in base.py.
+
+It gives exactly the same output as "grammar([tree]).apply('python', i)", but
+rather than recursing through the "thing" rule it walks the tree using an
+explicit stack of work to do, writing each fragment of code to a single output
+buffer as soon as it is known. This means that very deep trees (eg. the long
+arithmetic chains made by ast_generator.Tree) don't hit Python's recursion
+limit, and large modules aren't rebuilt as strings all the way up the tree.
+
+Each node type has a function, which is given the node and the indentation
+level and returns a list of "pieces", in the order they appear in the output:
+
+ * A string is written to the output as-is.
+ * A tuple (child, indentation) is handled like an application of "thing".
+ * CAPTURE, KEEP and Apply are used for the few rules which need to do more to
+   their children's code than write it out (eg. "del" tuples chop the "del "
+   off each of their children). Anything written between a CAPTURE and a KEEP is
+   saved rather than written, and an Apply(n, f) writes out f(last_n_saved).
+
+Use emit(tree, indentation) to get the code as a string, or give a file-like
+object as the "out" argument to have the code written to it instead."""
+
+from base import constants, import_match, tuple_args, is_del, pick_quotes, \
+	set_defaults, make_list
+from nodes import *
+
+class Apply(object):
+	"""Marks the point where the last n saved fragments of code should be
+	given to the function f, and the result written to the output."""
+
+	def __init__(self, n, f):
+		self.n = n
+		self.f = f
+
+# Marks the start of a fragment of code to save
+CAPTURE = object()
+
+# Marks the end of a fragment of code to save
+KEEP = object()
+
+def joined(things, i, separator):
+	"""Returns pieces which write out each of things, with separator between
+	each of them."""
+	pieces = []
+	for n, thing in enumerate(things):
+		if n > 0:
+			pieces.append(separator)
+		pieces.append((thing, i))
+	return pieces
+
+def saved(things, i):
+	"""Returns pieces which save the code for each of things."""
+	pieces = []
+	for thing in things:
+		pieces.extend([CAPTURE, (thing, i), KEEP])
+	return pieces
+
+# These are the equivalents of the rules in base.grammar_def. Those which
+# are commented there are commented here only where they do something
+# different.
+
+def emit_add(a, i):
+	return ['((', (a.left, i), ') + (', (a.right, i), '))']
+
+def emit_and(a, i):
+	return ['('] + joined(make_list(a.nodes), i, ') and (') + [')']
+
+def emit_assattr(a, i):
+	return [(a.expr, i), '.'+a.attrname]
+
+def emit_asslist(a, i):
+	return ['['] + joined(make_list(a.nodes), i, ', ') + [']']
+
+def emit_assname(a, i):
+	return [a.name]
+
+def emit_asstuple(a, i):
+	return ['('] + joined(make_list(a.nodes), i, ', ') + [')']
+
+def emit_assert(a, i):
+	if a.fail is None:
+		return ['assert ', (a.test, i)]
+	return ['assert ', (a.test, i), ', ', (a.fail, i)]
+
+def emit_assign(a, i):
+	return joined(make_list(a.nodes), i, ' = ') + [' = ', (a.expr, i)]
+
+def emit_augassign(a, i):
+	return [(a.node, i), a.op, (a.expr, i)]
+
+def emit_backquote(a, i):
+	return ['`', (a.expr, i), '`']
+
+def emit_bitand(a, i):
+	return ['(('] + joined(make_list(a.nodes), i, ')&(') + ['))']
+
+def emit_bitor(a, i):
+	return ['(('] + joined(make_list(a.nodes), i, ')|(') + ['))']
+
+def emit_bitxor(a, i):
+	return ['(('] + joined(make_list(a.nodes), i, ')^(') + ['))']
+
+def emit_break(a, i):
+	return ['break']
+
+def emit_callfunc(a, i):
+	args = make_list(a.args)
+	if a.star_args is not None:
+		args.append(('*', a.star_args))
+	if a.dstar_args is not None:
+		args.append(('**', a.dstar_args))
+	pieces = [(a.node, i), '(']
+	for n, arg in enumerate(args):
+		if n > 0:
+			pieces.append(', ')
+		if type(arg) == tuple:
+			pieces.extend([arg[0], (arg[1], i)])
+		else:
+			pieces.append((arg, i))
+	return pieces + [')']
+
+def emit_class(a, i):
+	# The grammar can't print class decorators, so we print them like those of
+	# functions
+	pieces = []
+	decorators = make_list(a.decorators)
+	if len(decorators) > 0:
+		pieces = ['@'] + joined(decorators, i, '\n'+'\t'*i+'@') + \
+			['\n'+'\t'*i]
+	pieces.append('class '+a.name)
+	bases = make_list(a.bases)
+	if len(bases) > 0:
+		pieces.extend(['('] + joined(bases, i, ', ') + [')'])
+	pieces.append(':\n')
+	if a.doc is not None:
+		pieces.append(('\t'*(i+1))+pick_quotes(a.doc)+'\n')
+	return pieces + [(a.code, i+1)]
+
+def emit_compare(a, i):
+	# The grammar can only print a single comparison, we print chains too
+	pieces = ['(', (a.expr, i), ' ']
+	for n, (op, rhs) in enumerate(make_list(a.ops)):
+		if n > 0:
+			pieces.append(' ')
+		pieces.extend([op+' ', (rhs, i)])
+	return pieces + [')']
+
+def emit_const(a, i):
+	if a.value is None:
+		return ['']
+	if a.value == float('inf'):
+		return ['1e30000']
+	if a.value == float('-inf'):
+		return ['-1e30000']
+	if a.value != a.value:
+		return ['(float("nan"))']
+	return [repr(a.value)]
+
+def emit_continue(a, i):
+	return ['continue']
+
+def emit_decorators(a, i):
+	return ['@'] + joined(make_list(a.nodes), i, '\n'+'\t'*i+'@')
+
+def emit_delete(a, i):
+	"""Handles those nodes which represent deletions, or returns None if the
+	node isn't one."""
+	if a.__class__ == AssTuple and is_del(a):
+		nodes = make_list(a.nodes)
+		return ['del('] + saved(nodes, i) + \
+			[Apply(len(nodes), lambda dels: ', '.join([n[4:] for n in dels])),
+			')']
+	if getattr(a, 'flags', None) != 'OP_DELETE':
+		return None
+	if a.__class__ == AssName:
+		return ['del '+a.name]
+	if a.__class__ == AssAttr:
+		return ['del ', (a.expr, i), '.'+a.attrname]
+	if a.__class__ == Slice:
+		pieces = ['del ', (a.expr, i), '[']
+		if a.lower is not None:
+			pieces.append((a.lower, i))
+		pieces.append(':')
+		if a.upper is not None:
+			pieces.append((a.upper, i))
+		return pieces + [']']
+	if a.__class__ == Subscript:
+		return ['del ', (a.expr, i), '['] + \
+			joined(make_list(a.subs), i, ', ') + [']']
+	return None
+
+def emit_dict(a, i):
+	pieces = ['{']
+	for n, (key, value) in enumerate(make_list(a.items)):
+		if n > 0:
+			pieces.append(', ')
+		pieces.extend([(key, i), ':', (value, i)])
+	return pieces + ['}']
+
+def emit_discard(a, i):
+	return [(a.expr, i)]
+
+def emit_div(a, i):
+	return ['((', (a.left, i), ')/(', (a.right, i), '))']
+
+def emit_ellipsis(a, i):
+	return ['...']
+
+def emit_emptynode(a, i):
+	return ['']
+
+def emit_exec(a, i):
+	if a.globals is None and a.locals is None:
+		return ['exec (', (a.expr, i), ')']
+	if a.globals is None:
+		return ['exec (', (a.expr, i), ') in (', (a.locals, i), ')']
+	if a.locals is not None:
+		return ['exec (', (a.expr, i), ') in (', (a.locals, i), '), (',
+			(a.globals, i), ')']
+	return None
+
+def emit_expression(a, i):
+	return ['FAIL']
+
+def emit_floordiv(a, i):
+	return ['(', (a.left, i), ' // ', (a.right, i), ')']
+
+def emit_for(a, i):
+	pieces = ['for ', (a.assign, i), ' in ', (a.list, i), ':\n', (a.body, i+1)]
+	if a.else_ is not None:
+		pieces.extend(['\n'+(i*'\t')+'else:\n', (a.else_, i+1)])
+	return pieces
+
+def emit_from(a, i):
+	return ['from '+(a.level*'.')+a.modname+' import '+ \
+		', '.join(import_match(a.names))]
+
+def emit_function(a, i):
+	# The grammar only prints decorators and docstrings for functions without
+	# *args or **kwargs, so we do the same
+	defaults = make_list(a.defaults)
+	if a.varargs is None and a.kwargs is None:
+		extra = []
+		names = a.argnames[::-1]
+	elif a.varargs is None:
+		extra = ['**'+a.argnames[-1]]
+		names = a.argnames[-2::-1]
+	elif a.kwargs is None:
+		extra = ['*'+a.argnames[-1]]
+		names = a.argnames[-2::-1]
+	else:
+		extra = ['*'+a.argnames[-2], '**'+a.argnames[-1]]
+		names = a.argnames[-3::-1]
+	plain = tuple_args(a.argnames)[::-1][len(a.defaults)+len(extra):][::-1]
+	pieces = []
+	if a.decorators is not None and len(extra) == 0:
+		pieces.extend([(a.decorators, i), '\n'+(i*'\t')])
+	pieces.append('def '+a.name+'(')
+	args = plain + [names[x]+'=' for x in range(len(defaults))][::-1] + extra
+	for n, arg in enumerate(args):
+		if n > 0:
+			pieces.append(', ')
+		pieces.append(arg)
+		if len(plain) <= n < len(plain)+len(defaults):
+			pieces.append((defaults[n-len(plain)], i))
+	pieces.append('):')
+	if a.doc is not None and len(extra) == 0:
+		pieces.append('\n'+('\t'*(i+1))+pick_quotes(a.doc))
+	return pieces + [(a.code, i+1)]
+
+def emit_genexpr(a, i):
+	return ['(', (a.code, i), ')']
+
+def emit_genexprfor(a, i):
+	return ['for ', (a.assign, i), ' in ', (a.iter, i)] + \
+		joined(make_list(a.ifs), i, ' ')
+
+def emit_genexprif(a, i):
+	return [' if ', (a.test, i)]
+
+def emit_genexprinner(a, i):
+	return [(a.expr, i), ' '] + joined(make_list(a.quals), i, ' ')
+
+def emit_getattr(a, i):
+	return [(a.expr, i), '.', (a.attrname, i)]
+
+def emit_global(a, i):
+	return ['global '+', '.join(a.names)]
+
+def emit_if(a, i):
+	tests = make_list(a.tests)
+	pieces = ['if ', (tests[0][0], i), ':\n', (tests[0][1], i+1)]
+	for test, code in tests[1:]:
+		pieces.extend(['\n'+('\t'*i)+'elif ', (test, i), ':\n', (code, i+1)])
+	pieces.append('\n'+('\t'*i))
+	if a.else_ is not None:
+		pieces.extend(['else:\n', (a.else_, i+1)])
+	return pieces + ['\n']
+
+def emit_ifexp(a, i):
+	return ['(', (a.then, i), ') if (', (a.test, i), ') else (', (a.else_, i),
+		')']
+
+def emit_import(a, i):
+	return ['import '+', '.join(import_match(a.names))]
+
+def emit_invert(a, i):
+	return ['(~(', (a.expr, i), '))']
+
+def emit_keyword(a, i):
+	return [a.name+'=', (a.expr, i)]
+
+def emit_lambda(a, i):
+	defaults = make_list(a.defaults)
+	return saved(defaults, i) + [Apply(len(defaults),
+		lambda ds: 'lambda '+set_defaults(a.argnames, ds)+': '), (a.code, i)]
+
+def emit_leftshift(a, i):
+	return ['((', (a.left, i), ')<<(', (a.right, i), '))']
+
+def emit_list(a, i):
+	return ['['] + joined(make_list(a.nodes), i, ', ') + [']']
+
+def emit_listcomp(a, i):
+	return ['[', (a.expr, i)] + joined(make_list(a.quals), i, ' ') + [']']
+
+def emit_listcompfor(a, i):
+	return [' for ', (a.assign, i), ' in ', (a.list, i)] + \
+		joined(make_list(a.ifs), i, '')
+
+def emit_listcompif(a, i):
+	return [' if ', (a.test, i)]
+
+def emit_mod(a, i):
+	return ['((', (a.left, i), ') % (', (a.right, i), '))']
+
+def emit_module(a, i):
+	if a.doc is None:
+		return [(a.node, i)]
+	return [pick_quotes(a.doc), (a.node, i)]
+
+def emit_mul(a, i):
+	return ['((', (a.left, i), ') * (', (a.right, i), '))']
+
+def emit_name(a, i):
+	return [a.name]
+
+def emit_not(a, i):
+	return ['(not (', (a.expr, i), '))']
+
+def emit_or(a, i):
+	return ['(('] + joined(make_list(a.nodes), i, ') or (') + ['))']
+
+def emit_pass(a, i):
+	return ['pass']
+
+def emit_power(a, i):
+	return ['((', (a.left, i), ')**(', (a.right, i), '))']
+
+def emit_print(a, i):
+	return emit_printnl(a, i) + [',']
+
+def emit_printnl(a, i):
+	if a.dest is None:
+		pieces = ['print ']
+	else:
+		pieces = ['print >> ', (a.dest, i), ', ']
+	return pieces + joined(make_list(a.nodes), i, ', ')
+
+def emit_raise(a, i):
+	exprs = []
+	if a.expr1 is not None:
+		exprs.append((a.expr1, i))
+	elif a.expr2 is not None or a.expr3 is not None:
+		exprs.append('None')
+	if a.expr2 is not None:
+		exprs.append((a.expr2, i))
+	elif a.expr3 is not None:
+		exprs.append('None')
+	if a.expr3 is not None:
+		exprs.append((a.expr3, i))
+	pieces = ['raise ']
+	for n, expr in enumerate(exprs):
+		if n > 0:
+			pieces.append(', ')
+		pieces.append(expr)
+	return pieces
+
+def emit_return(a, i):
+	return ['return ', (a.value, i)]
+
+def emit_rightshift(a, i):
+	return ['((', (a.left, i), ')>>(', (a.right, i), '))']
+
+def emit_slice(a, i):
+	pieces = [(a.expr, i), '[']
+	if a.lower is not None:
+		pieces.append((a.lower, i))
+	pieces.append(':')
+	if a.upper is not None:
+		pieces.append((a.upper, i))
+	return pieces + [']']
+
+def emit_sliceobj(a, i):
+	return joined(make_list(a.nodes), i, ':')
+
+def emit_stmt(a, i):
+	# Statements followed by a constant None get a semicolon
+	pieces = []
+	nodes = make_list(a.nodes)
+	for e, n in enumerate(nodes):
+		pieces.extend(['\n'+'\t'*i, (n, i)])
+		if len(a.nodes) > e+1 and a.nodes[e+1].__class__ == Discard and \
+			a.nodes[e+1].expr.__class__ == Const and \
+			a.nodes[e+1].expr.value is None:
+			pieces.append(';')
+	if len(pieces) == 0:
+		pieces.append('\n'+'\t'*i)
+	return pieces
+
+def emit_sub(a, i):
+	return ['((', (a.left, i), ') - (', (a.right, i), '))']
+
+def emit_subscript(a, i):
+	return [(a.expr, i), '['] + joined(make_list(a.subs), i, ', ') + [']']
+
+def emit_tryexcept(a, i):
+	pieces = ['try:', (a.body, i+1), '\n'+i*'\t']
+	for n, (type_, target, body) in enumerate(a.handlers):
+		if n > 0:
+			pieces.append('\n'+i*'\t')
+		pieces.append('except')
+		if type_ is not None:
+			pieces.extend([' ', (type_, i)])
+		if target is not None:
+			pieces.extend([', ', (target, i)])
+		pieces.extend([':', (body, i+1)])
+	if a.else_ is not None:
+		pieces.extend(['\n'+'\t'*i+'else:', (a.else_, i+1)])
+	return pieces
+
+def emit_tryfinally(a, i):
+	if a.body.__class__ == TryExcept:
+		pieces = [(a.body, i)]
+	else:
+		pieces = ['try:', (a.body, i+1)]
+	return pieces + ['\n'+i*'\t'+'finally:', (a.final, i+1)]
+
+def emit_tuple(a, i):
+	if len(a.nodes) == 1:
+		return ['(', (a.nodes[0], i), ',)']
+	return ['('] + joined(make_list(a.nodes), i, ', ') + [')']
+
+def emit_unaryadd(a, i):
+	return ['(+', (a.expr, i), ')']
+
+def emit_unarysub(a, i):
+	return ['(-', (a.expr, i), ')']
+
+def emit_while(a, i):
+	pieces = ['while ', (a.test, i), ':\n', (a.body, i+1)]
+	if a.else_ is not None:
+		pieces.extend(['\n'+(i*'\t')+'else:\n', (a.else_, i+1)])
+	return pieces
+
+def emit_with(a, i):
+	pieces = ['with ', (a.expr, i)]
+	if a.vars is not None:
+		pieces.extend([' as ', (a.vars, i)])
+	return pieces + [':\n'+('\t'*(i+1)), (a.body, i+1)]
+
+def emit_yield(a, i):
+	return ['yield ', (a.value, i)]
+
+# Look up the function for each class of node in the same way as
+# base.dispatch_grammar
+emitters = {}
+for cls in [Add, And, AssAttr, AssList, AssName, AssTuple, Assert, Assign,
+	AugAssign, Backquote, Bitand, Bitor, Bitxor, Break, CallFunc, Class,
+	Compare, Const, Continue, Decorators, Dict, Discard, Div, Ellipsis,
+	EmptyNode, Exec, Expression, FloorDiv, For, From, Function, GenExpr,
+	GenExprFor, GenExprIf, GenExprInner, Getattr, Global, If, IfExp, Import,
+	Invert, Keyword, Lambda, LeftShift, List, ListComp, ListCompFor,
+	ListCompIf, Mod, Module, Mul, Name, Not, Or, Pass, Power, Print, Printnl,
+	Raise, Return, RightShift, Slice, Sliceobj, Stmt, Sub, Subscript,
+	TryExcept, TryFinally, Tuple, UnaryAdd, UnarySub, While, With, Yield]:
+	emitters[cls] = [globals()['emit_'+cls.__name__.lower()]]
+for cls in [AssAttr, AssName, AssTuple, Slice, Subscript]:
+	emitters[cls] = [emit_delete] + emitters[cls]
+del cls
+
+def thing(a, i):
+	"""The equivalent of the "thing" rule: returns the pieces for an AST node,
+	or for a constant."""
+	for emitter in emitters.get(a.__class__, []):
+		pieces = emitter(a, i)
+		if pieces is not None:
+			return pieces
+	if type(a) in constants:
+		return [str(a)]
+	raise Exception("Couldn't emit "+repr(a))
+
+def emit(tree, i=0, out=None):
+	"""Generates Python code for the given tree, with i tabs of initial
+	indentation. If out is given then the code is written to it, otherwise the
+	code is returned as a string."""
+	if out is None:
+		written = []
+		write = written.append
+	else:
+		write = out.write
+	# The work left to do, with the next piece on the end
+	stack = [(tree, i)]
+	# Where to write code to, for the fragments we're saving
+	captures = []
+	# The fragments we've saved
+	values = []
+	while stack:
+		piece = stack.pop()
+		if type(piece) == str:
+			write(piece)
+		elif type(piece) == tuple:
+			stack.extend(reversed(thing(*piece)))
+		elif piece is CAPTURE:
+			captures.append([])
+			write = captures[-1].append
+		elif piece is KEEP:
+			values.append(''.join(captures.pop()))
+			if len(captures) > 0:
+				write = captures[-1].append
+			elif out is None:
+				write = written.append
+			else:
+				write = out.write
+		else:
+			if piece.n == 0:
+				args = []
+			else:
+				args = values[-piece.n:]
+				del values[-piece.n:]
+			write(piece.f(args))
+	if out is None:
+		return ''.join(written)
+	return out
@@ -0,0 +1,92 @@
+"""Runs tree transformations ("filters") in a single pass.
+
+A filter used to be a function which took a whole tree, looked for the nodes
+it cares about and recursed through everything else. Running several of them
+means walking the whole tree once per filter, and filters which transform
+part of a tree and then recurse into the result walk some parts over and over
+again.
+
+Instead, filters can be given as visitors: a dictionary from node classes to
+lists of functions. walk goes through a tree once, and each node has the
+visitors for its class applied to it after its children have been walked, so
+visitors only ever need to handle a single node. For example:
+
+def not_to_call(node):
+	return CallFunc(Getattr(node.expr, Name('__lognot__')), [])
+
+walk(tree, {Not:[not_to_call]})"""
+
+from nodes import *
+
+# Caches the names of each node class's constructor arguments
+fields = {}
+
+# The classes whose constructors take their left and right children as a
+# single tuple
+paired = set()
+
+def node_fields(cls):
+	"""Returns the attribute names which get passed to the constructor of the
+	given node class, in order (except for lineno). Use make_node to make a
+	node from their values."""
+	try:
+		return fields[cls]
+	except KeyError:
+		try:
+			code = cls.__init__.im_func.func_code
+			names = [n for n in code.co_varnames[1:code.co_argcount]
+				if n != 'lineno']
+		except AttributeError:
+			names = []
+		# Binary operators like Add are given (left, right)
+		if names == ['leftright']:
+			names = ['left', 'right']
+			paired.add(cls)
+		fields[cls] = names
+		return names
+
+def make_node(cls, values):
+	"""Makes a node of class cls, given the values of its node_fields."""
+	node_fields(cls)
+	if cls in paired:
+		return cls((values[0], values[1]))
+	return cls(*values)
+
+def walk(node, visitors):
+	"""Returns the result of applying the given visitors to every node in the
+	tree under node. Nodes whose children haven't changed are reused rather
+	than copied."""
+	if type(node) == type([]):
+		return [walk(n, visitors) for n in node]
+	if type(node) == type((0,1)):
+		return tuple([walk(n, visitors) for n in node])
+	if not isinstance(node, Node):
+		# Strings, numbers, None, etc. are leaves
+		return node
+
+	# Walk the children first
+	cls = node.__class__
+	names = node_fields(cls)
+	old = [getattr(node, name) for name in names]
+	new = [walk(child, visitors) for child in old]
+	for o, n in zip(old, new):
+		if o is not n:
+			lineno = node.lineno
+			node = make_node(cls, new)
+			node.lineno = lineno
+			break
+
+	# Then run the visitors for this node's class. If one of them gives us a
+	# different kind of node then the rest don't apply to it.
+	for visitor in visitors.get(cls, ()):
+		if node.__class__ != cls:
+			break
+		node = visitor(node)
+	return node
+
+def merge(visitors, extra):
+	"""Adds the visitors in the dictionary extra to those in visitors, after
+	any which are already there."""
+	for cls, funcs in extra.items():
+		visitors.setdefault(cls, []).extend(funcs)
+	return visitors
@@ -0,0 +1,120 @@
+"""Caches the grammar classes which PyMeta makes from OMeta definitions.
+
+PyMeta's makeGrammar parses the grammar definition and generates Python code
+from it every time it is called, which is the bulk of the time it takes to
+import base.py, diet_python.py, etc. make_grammar does the same job, but
+stores the generated code on disk, so that later runs can load it straight
+from there.
+
+Cached code is stored in the directory given by the environment variable
+PYTHON_REWRITER_CACHE, or ~/.cache/python_rewriter if it isn't set. Set it to
+an empty string to turn caching off. Each entry is named after a hash of
+the grammar definition, along with the versions of Python, PyMeta and this
+cache format, so entries which are out of date are never loaded."""
+
+import os
+import sys
+import marshal
+import hashlib
+import linecache
+import tempfile
+from types import ModuleType
+import pymeta.builder
+from pymeta.builder import TreeBuilder, GeneratedCodeLoader, writePython
+from pymeta.grammar import OMeta
+
+# Change this whenever the contents of the cache files change
+cache_version = 1
+
+cache_dir = os.environ.get('PYTHON_REWRITER_CACHE',
+	os.path.join(os.path.expanduser('~'), '.cache', 'python_rewriter'))
+
+def pymeta_version():
+	"""PyMeta doesn't give a version number, so we identify it by the size and
+	modification time of its code generator."""
+	path = pymeta.builder.__file__
+	if path.endswith('.pyc') or path.endswith('.pyo'):
+		path = path[:-1]
+	try:
+		info = os.stat(path)
+		return '%s:%d:%d' % (path, info.st_size, info.st_mtime)
+	except OSError:
+		return getattr(pymeta, '__version__', 'unknown')
+
+def cache_key(definition, name, superclass):
+	"""Returns the hash which identifies the given grammar in the cache."""
+	key = hashlib.sha1()
+	for part in [str(cache_version), sys.version, pymeta_version(),
+		superclass.__module__, superclass.__name__, name, definition]:
+		key.update(part)
+		key.update('\0')
+	return key.hexdigest()
+
+def generate(definition, name, superclass):
+	"""Returns the Python code which PyMeta generates for the given grammar
+	definition."""
+	parser = superclass.metagrammarClass(definition)
+	tree = parser.parseGrammar(name, TreeBuilder)
+	return writePython(tree)
+
+def load(path):
+	"""Returns the (source, code) pair stored at path, or None if there's no
+	usable entry there."""
+	try:
+		f = open(path, 'rb')
+		try:
+			return marshal.load(f)
+		finally:
+			f.close()
+	except (IOError, EOFError, ValueError, TypeError):
+		return None
+
+def save(path, entry):
+	"""Stores the (source, code) pair entry at path. We write to a temporary
+	file first and rename it, so other processes never see half an entry."""
+	try:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		handle, temp_path = tempfile.mkstemp(dir=cache_dir)
+		f = os.fdopen(handle, 'wb')
+		try:
+			marshal.dump(entry, f)
+		finally:
+			f.close()
+		os.rename(temp_path, path)
+	except (IOError, OSError):
+		# Not being able to cache is no reason to fail
+		pass
+
+def make_grammar(definition, globals, name='Grammar', superclass=OMeta):
+	"""Does the same as superclass.makeGrammar(definition, globals, name),
+	but uses the cached code for this grammar if there is any."""
+	if cache_dir:
+		path = os.path.join(cache_dir,
+			cache_key(definition, name, superclass)+'.grammar')
+		entry = load(path)
+	else:
+		entry = None
+	modname = 'pymeta_grammar__' + name
+	filename = '/pymeta_generated_code/' + modname + '.py'
+	if entry is None:
+		source = generate(definition, name, superclass)
+		entry = (source, compile(source, filename, 'exec'))
+		if cache_dir:
+			save(path, entry)
+	source, code = entry
+
+	# The rest is the same as pymeta.builder.moduleFromGrammar
+	mod = ModuleType(modname)
+	mod.__dict__.update(globals)
+	mod.__name__ = modname
+	mod.__dict__[superclass.__name__] = superclass
+	mod.__dict__['GrammarBase'] = superclass
+	mod.__loader__ = GeneratedCodeLoader(source)
+	eval(code, mod.__dict__)
+	full_globals = dict(getattr(mod.__dict__[name], 'globals', None) or {})
+	full_globals.update(globals)
+	mod.__dict__[name].globals = full_globals
+	sys.modules[modname] = mod
+	linecache.getlines(filename, mod.__dict__)
+	return mod.__dict__[name]
@@ -1,96 +1,215 @@
 """
 This script is used for profiling. Give it the filename of a list of files (one
-per line) as an argument and it will try to compile each file, counting the
-number of occurances of each AST node type as it goes.
+per line, or "-" to read the list from stdin) and it will parse each file,
+counting the number of occurances of each AST node type and timing how long the
+parsing takes.
 
 This is useful to determine the precedence order of the "thing" rule in the base
 grammar, so as to minimise the number of alternative that need to be tried.
+
+The list of files is read as it's needed rather than all at once (the worker
+pool is given batch_size of them at a time), and the files are parsed by a pool
+of worker processes, so it can be used on large corpora.
+The results are written as CSV (one row per node type, giving how many there
+were, what fraction of all nodes they make up and an estimate of how much of the
+parse time they account for) and/or JSON, which also includes the files which
+couldn't be parsed. Each file's parse time is shared out between its node types
+in proportion to how many of each it has.
 """
 
 import sys
-import compiler
+import time
 import random
+import compiler
+from itertools import islice
+from collections import Counter
+from multiprocessing import Pool, cpu_count
 
 try:
-	import psyco
-	psyco.full()
-except:
-	pass
-
-
-def count_down(node):
-	"""Increments the counter for this node's class and recurses through its
-	children."""
-	# Assume that this is an AST node
-	if issubclass(node.__class__, Node):
-		node.__class__.counter += 1
-		map(count_down, node.asList())
-		return
-	# If not, it may be a collection
-	if '__iter__' in dir(node):
-		map(count_down, node)
-		return
-	# If not, it is a built-in type
-	return	
+	import json
+except ImportError:
+	json = None
+
+usage = """Python code analyser, used for counting AST node frequency.
+Usage: node_counter.py filename [number] [-jobs N] [-seed N] [-csv out.csv]
+                       [-json out.json]
+Where filename is a file that contains a list of Python files, one per line,
+that are to be scanned ("-" reads them from stdin), and the optional number
+argument indicates how many files are to be proccessed (chosen at random from
+the input). The CSV is written to stdout unless -csv or -json is given."""
+
+# How many filenames to give the worker pool at once. The pool reads all of
+# the filenames it's given straight away, so we don't give it them all.
+batch_size = 1024
+
+def count_nodes(tree):
+	"""Returns a Counter of the names of the classes of the nodes in tree. We
+	use a stack rather than recursing, since some trees are very deep."""
+	counts = Counter()
+	stack = [tree]
+	while stack:
+		node = stack.pop()
+		counts[node.__class__.__name__] += 1
+		stack.extend(node.getChildNodes())
+	return counts
+
+def profile_file(filename):
+	"""Parses the given file and counts its nodes. This runs in a worker
+	process, so rather than raising we return (filename, counts, parse time,
+	error message or None)."""
+	try:
+		f = open(filename, 'r')
+		text = f.read()
+		f.close()
+		start = time.time()
+		tree = compiler.parse(text)
+		taken = time.time() - start
+		return (filename, count_nodes(tree), taken, None)
+	except Exception, e:
+		return (filename, Counter(), 0.0, str(e) or e.__class__.__name__)
+
+def read_filenames(list_file):
+	"""Yields the (non-empty) filenames in list_file as they're read."""
+	for line in list_file:
+		line = line.strip()
+		if line:
+			yield line
+
+def sample(filenames, number, rng):
+	"""Returns number filenames chosen at random from the iterable filenames,
+	in the order they were given. We don't know how many there are until we
+	reach the end, so this uses reservoir sampling."""
+	chosen = []
+	for index, filename in enumerate(filenames):
+		if index < number:
+			chosen.append((index, filename))
+		else:
+			# Keep this one with probability number/(index+1)
+			slot = rng.randint(0, index)
+			if slot < number:
+				chosen[slot] = (index, filename)
+	return [filename for index, filename in sorted(chosen)]
+
+def imap_batches(pool, func, items, size, chunksize=16):
+	"""Like pool.imap_unordered(func, items, chunksize), but only takes size
+	of items at a time. The next batch is started before we wait for the
+	results of the last, so the workers aren't left waiting, which means at
+	most 2*size items are held at once."""
+	items = iter(items)
+	batch = list(islice(items, size))
+	current = None
+	if batch:
+		current = pool.imap_unordered(func, batch, chunksize)
+	while current is not None:
+		batch = list(islice(items, size))
+		following = None
+		if batch:
+			following = pool.imap_unordered(func, batch, chunksize)
+		for result in current:
+			yield result
+		current = following
+
+def profile(filenames, jobs=None):
+	"""Profiles each of the given files. Returns a dictionary of the total
+	counts, total parse time, number of files parsed and a list of failures
+	(pairs of filename and error message)."""
+	totals = Counter()
+	times = Counter()
+	results = {'files':0, 'parse_time':0.0, 'failures':[]}
+	if jobs == 1:
+		profiles = (profile_file(f) for f in filenames)
+	else:
+		pool = Pool(jobs)
+		profiles = imap_batches(pool, profile_file, filenames, batch_size)
+	for filename, counts, taken, error in profiles:
+		if error is None:
+			totals.update(counts)
+			nodes = float(sum(counts.values()))
+			for name, count in counts.items():
+				times[name] += taken * count / nodes
+			results['files'] += 1
+			results['parse_time'] += taken
+		else:
+			results['failures'].append((filename, error))
+	if jobs != 1:
+		pool.close()
+		pool.join()
+	results['counts'] = totals
+	results['times'] = times
+	return results
+
+def node_rows(results):
+	"""Returns (node type, count, frequency, parse time) for each node type
+	found, most frequent first."""
+	total = sum(results['counts'].values())
+	return [(name, count, float(count) / total, results['times'][name])
+		for name, count in results['counts'].most_common()]
+
+def write_csv(results, out):
+	out.write('node,count,frequency,parse_time\n')
+	for row in node_rows(results):
+		out.write('%s,%d,%.6f,%.6f\n' % row)
+
+def write_json(results, out):
+	nodes = sum(results['counts'].values())
+	json.dump({
+		'files':results['files'],
+		'nodes':nodes,
+		'parse_time':results['parse_time'],
+		'node_types':dict([(name, {'count':count, 'frequency':frequency,
+			'parse_time':taken})
+			for name, count, frequency, taken in node_rows(results)]),
+		'failures':[{'file':f, 'error':e} for f, e in results['failures']]
+	}, out, indent=1, sort_keys=True)
+	out.write('\n')
 
 if __name__ == '__main__':
-	if len(sys.argv) < 2:
-		print "Python code analyser, used for counting AST node frequency."
-		print "Usage: node_counter.py filename [number]"
-		print "Where filename is a file that contains a list of Python files,"
-		print "one per line, that are to be scanned, and the optional number"
-		print "argument indicates how many files are to be proccessed (chosen"
-		print "at random from the input)"
+	args = sys.argv[1:]
+	options = {}
+	for option in ['-jobs', '-seed', '-csv', '-json']:
+		if option in args:
+			i = args.index(option)
+			options[option] = args[i+1]
+			del args[i:i+2]
+	if len(args) < 1:
+		print usage
 		sys.exit()
-	
-	# First we instrument the compiler nodes
-	sys.stderr.write('Grabbing nodes\n')
-	import nodes
-	nodelist = []
-	sys.stderr.write('Instrumenting nodes\n')
-	for node in [n for n in dir(nodes) if n[0].isupper()]:
-		sys.stderr.write('Setting counter for '+node+'\n')
-		exec('nodes.'+node+'.counter = 0')		# Give it a counter
-		sys.stderr.write('Importing '+node+'\n')
-		exec(node+' = nodes.'+node)		# Import it directly to our namespace
-		nodelist.append(node)
-
-	sys.stderr.write('Reading filenames\n')
-	filenames = [line.strip() for line in open(sys.argv[1],'r').readlines()]
-
-	if (len(sys.argv) > 2):
-		sys.stderr.write('Explicit count given.\n')
-		counter = int(sys.argv[2])
-		if counter > len(filenames):
-			sys.stderr.write('The given count is larger than the number of files given.\n')
-			sys.stderr.write('Only '+len(filenames)+'files will be proccessed.\n')
-			counter = len(filenames)
+
+	if args[0] == '-':
+		list_file = sys.stdin
+	else:
+		list_file = open(args[0], 'r')
+	filenames = read_filenames(list_file)
+	if len(args) > 1:
+		if '-seed' in options:
+			rng = random.Random(int(options['-seed']))
+		else:
+			rng = random.Random()
+		filenames = sample(filenames, int(args[1]), rng)
+	if '-jobs' in options:
+		jobs = int(options['-jobs'])
 	else:
-		counter = len(filenames)
-	total = counter
-
-	sys.stderr.write('Starting scan\n')
-	while counter > 0:
-		choice = random.randint(0,counter)
-		filename = filenames.pop(choice)
-		try:
-			f = open(filename,'r')
-			text = ''.join(f.readlines())
-			f.close()
-			tree = compiler.parse(text)
-			count_down(tree)
-		except Exception, e:
-			# If it fails then just skip. We're not getting exact data anyway.
-			sys.stderr.write(str(e))
-			sys.stderr.write ('Ack')
-			pass
-		sys.stderr.write('\n'+str(counter))
-		sys.stderr.flush()
-		counter -= 1
-
-	sys.stdout.write('\nsamples,')
-	for node in nodelist:
-		sys.stdout.write(node+',')
-	sys.stdout.write('\n'+str(total)+',')
-	for node in nodelist:
-		sys.stdout.write(str(eval(node+'.counter'))+',')
+		jobs = cpu_count()
+
+	start = time.time()
+	results = profile(filenames, jobs)
+	taken = time.time() - start
+
+	if '-csv' in options:
+		out = open(options['-csv'], 'w')
+		write_csv(results, out)
+		out.close()
+	if '-json' in options:
+		out = open(options['-json'], 'w')
+		write_json(results, out)
+		out.close()
+	if '-csv' not in options and '-json' not in options:
+		write_csv(results, sys.stdout)
+
+	nodes = sum(results['counts'].values())
+	sys.stderr.write('%d files (%d failed), %d nodes in %.2f seconds '
+		'(%.2f seconds parsing, %.0f nodes/second)\n' % (results['files'],
+		len(results['failures']), nodes, taken, results['parse_time'],
+		nodes / max(results['parse_time'], 1e-9)))
+	for filename, error in results['failures']:
+		sys.stderr.write(filename+': '+error+'\n')
@@ -0,0 +1,262 @@
+"""
+Puts the alternatives of the rules which dispatch on node type in order of how
+common each type of node is, so that as few alternatives as possible have to
+be tried for each node.
+
+This rewrites the "node" rule of grammar_def in base.py and the "thing" rule
+of tree_transform in diet_python.py, using a profile made by node_counter.py
+(either its JSON or CSV output). Alternatives which don't handle a particular
+type of node (eg. the catch-all at the end of "thing") are left at the end,
+and "delete" is kept before the rules for the nodes it overlaps with.
+
+Usage: node_order.py [profile] [-check] [-benchmark files.txt]
+
+The profile defaults to node_profile.csv, next to this file, which gave the
+current order. It was made by running node_counter.py over the 206 modules at
+the top level of Python 2.7.18's standard library (lib/python2.7/*.py):
+
+ls /path/to/lib/python2.7/*.py > files.txt
+node_counter.py files.txt -csv node_profile.csv
+
+With -check nothing is written, but we exit with 1 if the order is out of
+date. With -benchmark the given list of files is used to time how long each
+node takes to match with the current order and with the new one.
+"""
+
+import os
+import re
+import sys
+import time
+import compiler.ast
+
+try:
+	import json
+except ImportError:
+	json = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# The rules to reorder, as (file, the start of the rule's first line)
+targets = [
+	(os.path.join(here, 'base.py'), 'node :i ::= '),
+	(os.path.join(os.path.dirname(here), 'diet_python', 'diet_python.py'),
+		'thing ::= ')
+]
+
+# Rules which must come before the rules for some other nodes, since they
+# match some of the same nodes
+before = {'delete':['assattr', 'assname', 'asstuple', 'slice', 'subscript']}
+
+# The profile which gave the current order
+default_profile = os.path.join(here, 'node_profile.csv')
+
+# How many times to run each benchmark
+repeats = 5
+
+# Picks out the name of the rule applied by an alternative
+applied = re.compile(r'<(\w+)')
+
+# The names of the rules for each type of node
+node_rules = set()
+for name in dir(compiler.ast):
+	try:
+		if issubclass(getattr(compiler.ast, name), compiler.ast.Node):
+			node_rules.add(name.lower())
+	except TypeError:
+		pass
+del name
+
+def load_profile(path):
+	"""Returns a dictionary of how many of each type of node there are, with
+	the lowercase names of their classes (ie. their rule names) as keys."""
+	f = open(path, 'r')
+	text = f.read()
+	f.close()
+	counts = {}
+	if text.lstrip().startswith('{'):
+		for name, info in json.loads(text)['node_types'].items():
+			counts[name.lower()] = info['count']
+	else:
+		for line in text.splitlines()[1:]:
+			if line.strip():
+				fields = line.split(',')
+				counts[fields[0].lower()] = int(fields[1])
+	return counts
+
+def find_rule(lines, start):
+	"""Returns the (first, last+1) line numbers of the rule whose first line
+	begins with start. The rule continues for as long as lines begin with
+	"|"."""
+	for first, line in enumerate(lines):
+		if line.startswith(start):
+			last = first + 1
+			while last < len(lines) and lines[last].lstrip().startswith('|'):
+				last += 1
+			return first, last
+	raise Exception("Couldn't find the rule "+repr(start))
+
+def order(alternatives, counts):
+	"""Returns the given alternatives in the order they should be tried."""
+	names = [applied.search(a).group(1) for a in alternatives]
+	# Alternatives for a type of node are sorted, most common first (keeping
+	# the current order for ties). The others stay at the end.
+	sortable = [n for n, name in enumerate(names) if name in node_rules]
+	sortable.sort(key=lambda n: (-counts.get(names[n], 0), n))
+	fixed = [n for n, name in enumerate(names)
+		if name not in node_rules and name not in before]
+	# Put each of the "before" rules just in front of the first rule it
+	# overlaps with
+	for name, others in before.items():
+		if name not in names:
+			continue
+		positions = [p for p, n in enumerate(sortable) if names[n] in others]
+		if positions:
+			sortable.insert(min(positions), names.index(name))
+		else:
+			sortable.insert(0, names.index(name))
+	return [alternatives[n] for n in sortable + fixed]
+
+def reorder(source, start, counts):
+	"""Returns source with the alternatives of the rule beginning with start
+	put in order."""
+	lines = source.split('\n')
+	first, last = find_rule(lines, start)
+	# The first alternative is on the same line as the rule's name, the rest
+	# begin with "|"
+	head = lines[first][:len(start)]
+	alternatives = [lines[first][len(start):]]
+	continuation = lines[first+1][:lines[first+1].index('|')+2]
+	alternatives.extend([line[len(continuation):]
+		for line in lines[first+1:last]])
+	ordered = order(alternatives, counts)
+	lines[first:last] = [head + ordered[0]] + \
+		[continuation + a for a in ordered[1:]]
+	return '\n'.join(lines)
+
+def node_cost(grammar, trees, rule, *args):
+	"""Returns the time, in seconds, to apply rule to each of trees with a
+	fresh matcher of the given grammar, per node. This is the best of a few
+	runs, since the timings are noisy."""
+	from node_counter import count_nodes
+	from StringIO import StringIO
+	nodes = 0
+	for tree in trees:
+		nodes += sum(count_nodes(tree).values())
+	best = None
+	# The catch-all at the end of "thing" prints what it's given
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		for run in range(repeats):
+			start = time.time()
+			for tree in trees:
+				grammar([tree]).apply(rule, *args)
+			taken = time.time() - start
+			if best is None or taken < best:
+				best = taken
+	finally:
+		sys.stdout = stdout
+	return best / max(nodes, 1)
+
+def benchmark(files, counts):
+	"""Prints the time taken per node by the current order of each rule and
+	by the new one, for the files listed in files."""
+	import base
+	from base import parse, tree_init, ins
+	from grammar_cache import make_grammar
+	sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+	trees = []
+	for line in open(files, 'r'):
+		try:
+			trees.append(parse(open(line.strip(), 'r').read()))
+		except Exception:
+			pass
+
+	def build(definition, globals):
+		g = make_grammar(definition, globals)
+		g.__init__ = tree_init
+		g.ins = ins
+		return g
+
+	# The code generator, applying "python" to each module
+	working = []
+	for tree in trees:
+		try:
+			base.grammar([tree]).apply('python', 0)
+			working.append(tree)
+		except Exception:
+			pass
+	old = build(base.grammar_def, base.grammar.globals)
+	new = build(reorder(base.grammar_def, targets[0][1], counts),
+		base.grammar.globals)
+	print 'base.py "node", %d modules:' % len(working)
+	print '  current order: %.2f microseconds per node' % (
+		1e6 * node_cost(old, working, 'python', 0))
+	print '  new order:     %.2f microseconds per node' % (
+		1e6 * node_cost(new, working, 'python', 0))
+
+	# The Diet Python transformations, applying "thing" to each statement
+	# (its "module" rule doesn't go any further)
+	sys.path.insert(0, os.path.dirname(targets[1][0]))
+	import diet_python
+	from base import strip_comments
+	from nodes import Node
+	from StringIO import StringIO
+	statements = []
+	for tree in trees:
+		statements.extend(tree.node.nodes)
+	definition = strip_comments(diet_python.tree_transform)
+	globals = diet_python.transforms.globals
+	for label, grammar in [('current order', build(definition, globals)),
+		('new order', build(reorder(definition, targets[1][1], counts),
+			globals))]:
+		# apply goes through Node.transforms, so use ours
+		Node.transforms = grammar
+		working = []
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		for statement in statements:
+			try:
+				grammar([statement]).apply('thing')
+				working.append(statement)
+			except Exception:
+				pass
+		sys.stdout = stdout
+		if label == 'current order':
+			print 'diet_python.py "thing", %d statements:' % len(working)
+		print '  %-14s %.2f microseconds per node' % (label+':',
+			1e6 * node_cost(grammar, working, 'thing'))
+	Node.transforms = diet_python.transforms
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if '-help' in args or '--help' in args:
+		print __doc__
+		sys.exit(1)
+	if args and not args[0].startswith('-'):
+		counts = load_profile(args[0])
+	else:
+		counts = load_profile(default_profile)
+	if '-benchmark' in args:
+		benchmark(args[args.index('-benchmark')+1], counts)
+		sys.exit(0)
+
+	out_of_date = []
+	for path, start in targets:
+		f = open(path, 'r')
+		source = f.read()
+		f.close()
+		new_source = reorder(source, start, counts)
+		if new_source == source:
+			continue
+		out_of_date.append(path)
+		if '-check' not in args:
+			f = open(path, 'w')
+			f.write(new_source)
+			f.close()
+	if '-check' in args:
+		for path in out_of_date:
+			print path+' is out of date'
+		sys.exit(len(out_of_date) > 0 and 1 or 0)
+	for path in out_of_date:
+		print 'Reordered '+path
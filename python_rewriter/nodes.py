@@ -35,8 +35,10 @@ def rec(self, i):
 	"""This creates a matcher with the current instance as the input. It
 	then applies the "thing" rule with "i" as the indentation argument.
 	Finally it returns the result."""
-	self.matcher = self.grammar([self])
-	r = self.matcher.apply('thing', i)
+	# We don't keep the matcher on the node, since it holds on to its whole
+	# input and memo for as long as the node is around
+	matcher = self.grammar([self])
+	r = matcher.apply('thing', i)
 	return r
 
 # Stick it into the superclass namespace
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""Profiles the rules of PyMeta grammars, such as base.grammar and Diet
+Python's transforms.
+
+Every rule application in a PyMeta grammar goes through its _apply method, so
+enable(cls) replaces that with one which records, for each rule:
+
+ * calls: how many times the rule was applied
+ * backtracks: how many of those failed, making the matcher go back and try
+   something else
+ * cumulative: the time spent in the rule, including the rules it applied (a
+   rule which ends up applying itself is only counted once)
+ * own: the time spent in the rule, not counting the rules it applied
+
+It also records the own time of every stack of rule applications, which can
+be written in the "folded" format used by flamegraph.pl and speedscope. The
+timing adds some overhead to every application, so the times are only useful
+for comparing rules with each other.
+
+profile = RuleProfile()
+enable(grammar, profile)
+grammar([tree]).apply('python', 0)
+disable(grammar)
+profile.write_table(sys.stdout)
+
+Usage: rule_profile.py [-diet] file.py [-table out.txt] [-folded out.folded]
+                       [-sort calls|backtracks|cumulative|own]
+This profiles generating code for file.py, or with -diet translating it to
+Diet Python. The table is written to stdout unless -table or -folded is
+given."""
+
+import sys
+from timeit import default_timer as timer
+from pymeta.runtime import ParseError
+
+class RuleProfile(object):
+	"""Collects the statistics of rule applications, which may be from more
+	than one grammar."""
+
+	def __init__(self):
+		self.calls = {}
+		self.backtracks = {}
+		self.cumulative = {}
+		self.own = {}
+		# The own time of each stack of rules, keyed by their names joined
+		# with ";"
+		self.stacks = {}
+		# The applications we're in the middle of, as lists of [name, stack,
+		# start time, time spent in the rules it applied]
+		self.active = []
+		# How many times each rule appears in active
+		self.depth = {}
+
+	def enter(self, name):
+		"""Records the start of an application of the named rule."""
+		self.calls[name] = self.calls.get(name, 0) + 1
+		self.depth[name] = self.depth.get(name, 0) + 1
+		if self.active:
+			stack = self.active[-1][1] + ';' + name
+		else:
+			stack = name
+		self.active.append([name, stack, timer(), 0.0])
+
+	def leave(self, failed):
+		"""Records the end of the innermost application."""
+		name, stack, start, inner = self.active.pop()
+		taken = timer() - start
+		if failed:
+			self.backtracks[name] = self.backtracks.get(name, 0) + 1
+		self.own[name] = self.own.get(name, 0.0) + taken - inner
+		self.stacks[stack] = self.stacks.get(stack, 0.0) + taken - inner
+		self.depth[name] -= 1
+		if self.depth[name] == 0:
+			self.cumulative[name] = self.cumulative.get(name, 0.0) + taken
+		if self.active:
+			self.active[-1][3] += taken
+
+	def rows(self, sort='cumulative'):
+		"""Returns (rule, calls, backtracks, cumulative, own) for each rule,
+		biggest first by the given column."""
+		rows = [(name, self.calls[name], self.backtracks.get(name, 0),
+			self.cumulative.get(name, 0.0), self.own.get(name, 0.0))
+			for name in self.calls]
+		column = ['calls', 'backtracks', 'cumulative', 'own'].index(sort) + 1
+		rows.sort(key=lambda row: (-row[column], row[0]))
+		return rows
+
+	def write_table(self, out, sort='cumulative'):
+		out.write('%-30s %10s %10s %12s %12s\n' % ('rule', 'calls',
+			'backtracks', 'cumulative', 'own'))
+		for row in self.rows(sort):
+			out.write('%-30s %10d %10d %12.6f %12.6f\n' % row)
+
+	def write_folded(self, out):
+		"""Writes each stack of rules with its own time in microseconds, one
+		per line, for flamegraph.pl and the like."""
+		for stack, taken in sorted(self.stacks.items()):
+			microseconds = int(round(taken * 1e6))
+			if microseconds > 0:
+				out.write('%s %d\n' % (stack, microseconds))
+
+def profiling_apply(self, rule, ruleName, args):
+	"""A replacement for OMetaBase._apply which records each application in
+	the class's rule_profile."""
+	profile = self.rule_profile
+	profile.enter(self.rule_prefix + ruleName)
+	try:
+		result = self.unprofiled_apply(rule, ruleName, args)
+	except ParseError:
+		profile.leave(True)
+		raise
+	except:
+		profile.leave(False)
+		raise
+	profile.leave(False)
+	return result
+
+def enable(cls, profile=None, prefix=''):
+	"""Starts recording the rule applications of the grammar class cls (and
+	its subclasses) in profile, returning the profile. Each rule's name is
+	recorded with prefix in front, which can be used to tell grammars apart
+	when they share a profile."""
+	if profile is None:
+		profile = RuleProfile()
+	# A subclass of a class we're already profiling is already set up
+	if cls._apply.im_func is not profiling_apply:
+		cls.unprofiled_apply = cls._apply.im_func
+		cls._apply = profiling_apply
+	cls.rule_profile = profile
+	cls.rule_prefix = prefix
+	return profile
+
+def disable(cls):
+	"""Stops recording the rule applications of cls."""
+	if cls.__dict__.get('_apply') is profiling_apply:
+		del cls._apply
+		del cls.unprofiled_apply
+	for name in ['rule_profile', 'rule_prefix']:
+		if name in cls.__dict__:
+			delattr(cls, name)
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	options = {}
+	for option in ['-table', '-folded', '-sort']:
+		if option in args:
+			i = args.index(option)
+			options[option] = args[i+1]
+			del args[i:i+2]
+	diet = '-diet' in args
+	if diet:
+		args.remove('-diet')
+	if len(args) != 1:
+		print __doc__[__doc__.index('Usage:'):]
+		sys.exit(1)
+	sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
+	profile = RuleProfile()
+	if diet:
+		# Diet Python uses the python_rewriter package, so we must profile
+		# its copy of base rather than our own
+		import os
+		root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+		sys.path[0:0] = [os.path.join(root, 'diet_python'), root]
+		from python_rewriter import base
+		import diet_python
+		enable(base.grammar, profile, 'grammar.')
+		enable(diet_python.transforms, profile, 'transforms.')
+		diet_python.translate_uncached(open(args[0], 'r').read())
+		disable(diet_python.transforms)
+	else:
+		import base
+		tree = base.parse(open(args[0], 'r').read())
+		enable(base.grammar, profile)
+		base.grammar([tree]).apply('python', 0)
+	disable(base.grammar)
+
+	sort = options.get('-sort', 'cumulative')
+	if '-table' in options:
+		out = open(options['-table'], 'w')
+		profile.write_table(out, sort)
+		out.close()
+	if '-folded' in options:
+		out = open(options['-folded'], 'w')
+		profile.write_folded(out)
+		out.close()
+	if '-table' not in options and '-folded' not in options:
+		profile.write_table(sys.stdout, sort)
@@ -0,0 +1,146 @@
+"""Reads the Python code given to our tools (diet_python.translate,
+python_annotator.annotate and annotation_remover.strip_annotations).
+
+Code comes from a file or is given directly, and we say which rather than
+guessing: from_path(path) and from_text(text) both give a Source. Files are
+memory-mapped rather than read, so nothing is copied until it's needed: the
+whole text is only copied (once) when text() is called, and lines() reads a
+line at a time straight from the mapping. Decoding the text into unicode is
+only done if decoded() is asked for. The bytes are never altered, so line
+endings come through exactly as they are in the file.
+
+for source in load_paths(paths):
+	tree = parse(source.text())
+
+load_paths maps each file as it's reached and unmaps it once the next one is
+asked for, so a batch of large files is never in memory all at once."""
+
+import os
+import re
+import mmap
+from cStringIO import StringIO
+
+# Encoding declarations, as described in PEP 263
+coding = re.compile(r'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+
+class Source(object):
+	"""Some Python code, from the file at path or given as text. name is
+	used to refer to the code in messages."""
+
+	def __init__(self, path=None, text=None, name=None):
+		if (path is None) == (text is None):
+			raise ValueError('A Source needs either a path or some text')
+		self.path = path
+		self.name = name or path or '<string>'
+		self.contents = text
+		self.file = None
+		self.map = None
+
+	def __repr__(self):
+		return 'Source(%r)' % self.name
+
+	def data(self):
+		"""Returns the code as a string or, for a file, an mmap (which can be
+		sliced, searched and read like a file without copying it all)."""
+		if self.contents is not None:
+			return self.contents
+		if self.map is None:
+			self.file = open(self.path, 'rb')
+			if os.fstat(self.file.fileno()).st_size == 0:
+				# Empty files can't be mapped
+				self.close()
+				self.contents = ''
+				return self.contents
+			self.map = mmap.mmap(self.file.fileno(), 0,
+				access=mmap.ACCESS_READ)
+		return self.map
+
+	def text(self):
+		"""Returns the code as a string. For a file this is copied out of the
+		mapping once, after which the file is closed."""
+		if self.contents is None:
+			self.contents = self.data()[:]
+			self.close()
+		return self.contents
+
+	def lines(self):
+		"""Yields the lines of the code, each with its line ending."""
+		data = self.data()
+		if data is self.contents:
+			data = StringIO(data)
+		else:
+			data.seek(0)
+		line = data.readline()
+		while line:
+			yield line
+			line = data.readline()
+
+	def encoding(self):
+		"""Returns the encoding the code declares (or Python's default)."""
+		data = self.data()
+		if data[:3] == '\xef\xbb\xbf':
+			return 'utf-8'
+		first = data.find('\n')
+		second = data.find('\n', first + 1)
+		if first == -1:
+			head = [data[:]]
+		elif second == -1:
+			head = [data[:first], data[first+1:]]
+		else:
+			head = [data[:first], data[first+1:second]]
+		for line in head:
+			found = coding.match(line)
+			if found:
+				return found.group(1)
+		return 'ascii'
+
+	def decoded(self):
+		"""Returns the code as unicode."""
+		text = self.text()
+		if text[:3] == '\xef\xbb\xbf':
+			text = text[3:]
+		return text.decode(self.encoding())
+
+	def close(self):
+		"""Unmaps and closes the file, if it's open. It'll be opened again if
+		it's needed."""
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+def from_path(path):
+	"""Returns a Source for the code in the file at path."""
+	return Source(path=path)
+
+def from_text(text, name='<string>'):
+	"""Returns a Source for the code in text."""
+	return Source(text=text, name=name)
+
+def as_source(source=None, path=None, text=None):
+	"""Returns a Source for the code given to one of our tools, as either a
+	Source, the path of a file or the code itself. Exactly one must be given.
+	Plain strings aren't accepted in place of a Source, since there's no
+	telling whether they're paths or code (eg. "x" is both)."""
+	if len([x for x in [source, path, text] if x is not None]) != 1:
+		raise TypeError('Give one of a Source, path= or text=')
+	if path is not None:
+		return from_path(path)
+	if text is not None:
+		return from_text(text)
+	if not isinstance(source, Source):
+		raise TypeError('Expected a Source, not %r (give a path as path= or '
+			'code as text=)' % (source,))
+	return source
+
+def load_paths(paths):
+	"""Yields a Source for each of paths. Each file is closed when the next
+	Source is asked for, so only one is open at a time."""
+	for path in paths:
+		source = from_path(path)
+		try:
+			yield source
+		finally:
+			source.close()
@@ -1,184 +1,221 @@
+import os
 import sys
 import gc
+import time
 import base
-
-from subprocess import call
+import Queue
+from StringIO import StringIO
+from multiprocessing import Pool
+from node_counter import count_nodes
 
 class EscapeException(Exception):
 	pass
 
-if __name__ != '__main__' or len(sys.argv) == 1:
-	class Test:
-
-		def __init__(self, name, code, deps):
-			self.name = name
-			self.code = code
-			self.deps = deps
-			self.result = False
-			self.message = self.name + ": Test didn't run"
-
-		def get_tree(self):
-			return base.parse(self.code)
-
-		def run(self, grammar):
-			self.message = self.name.upper() + '\n=======================\n'
-			if self.code == '' and self.name is not 'Empty':
-				self.message = self.message + 'No test set'
-				return
+class Test:
+
+	def __init__(self, name, code, deps):
+		self.name = name
+		self.code = code
+		self.deps = deps
+		self.result = False
+		self.message = self.name + ": Test didn't run"
+		# How long generating the code, and parsing and comparing it, took
+		self.emit_time = None
+		self.round_trip_time = None
+
+	def get_tree(self):
+		return base.parse(self.code)
+
+	def run(self, grammar):
+		self.result = False
+		self.emit_time = None
+		self.round_trip_time = None
+		self.message = self.name.upper() + '\n=======================\n'
+		if self.code == '' and self.name != 'Empty':
+			self.message = self.message + 'No test set'
+			return (self.result, self.message, self.deps)
+		try:
 			try:
 				tree = self.get_tree()
 			except SyntaxError:
-				message = message + """Error in test.\n""" + self.code
+				self.message = self.message + """Error in test.\n""" + self.code
 				raise EscapeException()
 			try:
-<<<<<<< HEAD
-				generated = tree.rec(0)
+				start = time.time()
+				generated = grammar([tree]).apply('python', 0)[0]
+				self.emit_time = time.time() - start
 			except ParseError:
-				message = message + """Error in grammar.\n""" + self.code + """\n\n""" + tree
+				self.message = self.message + """Error in grammar.\n""" + self.code + """\n\n""" + str(tree)
+				raise EscapeException()
+			# Writing the code out as it's generated must give the same code
+			streamed = StringIO()
+			grammar([tree]).apply('python_to', 0, streamed)
+			if streamed.getvalue() != generated:
+				self.message = self.message + """Error, python_to does not match python.\n""" + self.code + """\n\n""" + generated + """\n\n""" + streamed.getvalue()
 				raise EscapeException()
 			try:
+				start = time.time()
 				assert str(compiler.parse(generated)) == str(tree)
+				self.round_trip_time = time.time() - start
 			except AssertionError:
-				message = message + """Error, generated code does not match original.\n""" + self.code + """\n\n""" + str(tree) + """\n\n""" + generated
+				self.message = self.message + """Error, generated code does not match original.\n""" + self.code + """\n\n""" + str(tree) + """\n\n""" + generated
 				raise EscapeException()
 			except SyntaxError:
-				message = message + """Error in generated code.\n""" + self.code + """\n\n""" + str(tree) + """\n\n""" + generated
+				self.message = self.message + """Error in generated code.\n""" + self.code + """\n\n""" + str(tree) + """\n\n""" + generated
 				raise EscapeException()
-			message = message + "OK"
-			result = True
+			self.message = self.message + "OK"
+			self.result = True
 		except EscapeException:
-			try: del(tree)
-			except: pass
-			try: del(generated)
-			except: pass
-		return (result, message, self.deps)
-
-def do_file(testfile, name, do_print=False, notfile=None, workfile=None):
-	if notfile is None: keepnot = False
-	else: keepnot = True
-	if workfile is None: keepwork = False
-	else: keepwork = True
-
-	# Attempt to parse the file contents into an AST
-	try:
-		tree = base.parse(''.join(testfile.readlines()))
-		testfile.close()
-	except Exception, e:
-		# If we fail then make a note of it as appropriate
-		if keepnot:
-			notfile.write(name+'\n')
-			notfile.flush()
-		# And output more information if asked to
-		if do_print:
-			testfile.seek(0)
-			print ''.join(testfile.readlines())
-			print
-			print str(e)
-			print "Error parsing input."
-		# Now quit (we can't go any further)
-		#sys.exit(0)
-		return
-
-	# Attempt to generate code from the AST
-	try:
-		code = tree.rec(0)
-	except Exception, e:
-		# If we fail then make a note of it as appropriate
-		if keepnot:
-			notfile.write(name+'\n')
-			notfile.flush()
-		# And output more information if asked to
-		if do_print:
-			print repr(tree)
-			print
-			print str(e)
-			print "Error generating code"
-		# Now quit (we can't go any further)
-		#sys.exit(0)
-		return
-
-	# Attempt to parse the generated code into an AST
-	try:
-		new_tree = base.parse(code)
-		# Get rid of the code now that we don't need it
-		del(code)
-	except Exception, e:
-		# If we fail then make a note of it if asked to
-		if keepnot:
-			notfile.write(name+'\n')
-			notfile.flush()
-		# And output more information if asked to
-		if do_print:
-			print code
-			print
-			print str(e)
-			print "Error parsing generated code"
-		# Now quit (we can't go any further)
-		#sys.exit(0)
-		return
+			pass
+		return (self.result, self.message, self.deps)
+
+# Prints integers in hex, which gives the same trees but different code to
+# base.grammar (and hence emitter.emit)
+hex_grammar_def = """
+const :i ::= <anything>:a ?(a.__class__ == Const) ?(type(a.value) == int) => hex(a.value)
+           | <super i>
+"""
 
-	# Attempt to equate the two trees
-	try:
-		# repr(tree1) should equal repr(tree2)
-		if repr(tree) == repr(new_tree):
-			# If so then we have succeeded, note is as required
-			if keepwork:
-				workfile.write(name+'\n')
-				workfile.flush()
-			if do_print:
-				print "Match"
-		# Otherwise...
+class StreamTest(Test):
+	"""A test which is run with a grammar overriding some of the given
+	grammar's rules, to check that python_to uses them."""
+
+	def run(self, grammar):
+		from grammar_cache import make_grammar
+		overriding = make_grammar(hex_grammar_def, grammar.globals,
+			'HexGrammar', grammar)
+		return Test.run(self, overriding)
+
+def import_diet():
+	"""Returns the diet_python module, making its directory importable (Diet
+	Python's modules import each other by their plain names)."""
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	diet_dir = os.path.join(root, 'diet_python')
+	if diet_dir not in sys.path:
+		sys.path[0:0] = [diet_dir, root]
+	import diet_python
+	return diet_python
+
+class IncrementalTest(Test):
+	"""Checks that Diet Python's IncrementalTranslation, having translated
+	code, gives the same code for edited as translating it from scratch
+	does. reused and translated are how many of edited's top-level
+	statements it should keep from last time and how many it should redo."""
+
+	def __init__(self, name, code, edited, reused, translated, deps):
+		Test.__init__(self, name, code, deps)
+		self.edited = edited
+		self.reused = reused
+		self.translated = translated
+
+	def run(self, grammar):
+		self.result = False
+		self.emit_time = None
+		self.round_trip_time = None
+		self.message = self.name.upper() + '\n=======================\n'
+		diet_python = import_diet()
+		from incremental import IncrementalTranslation
+		incremental = IncrementalTranslation()
+		incremental.update(self.code)
+		start = time.time()
+		updated = incremental.update(self.edited)
+		self.emit_time = time.time() - start
+		fresh = diet_python.translate_uncached(self.edited)
+		if updated != fresh:
+			self.message = self.message + """Error, incremental translation does not match a fresh one.\n""" + self.edited + """\n\n""" + fresh + """\n\n""" + updated
+		elif (incremental.reused, incremental.translated) != \
+			(self.reused, self.translated):
+			self.message = self.message + """Error, reused %d and translated %d statements rather than %d and %d.\n""" % (incremental.reused, incremental.translated, self.reused, self.translated) + self.edited
 		else:
-			# If they're not equal then make a note as required
-			if keepnot:
-				notfile.write(name+'\n')
-				notfile.flush()
-			# And output if we've been asked to
-			if do_print:
-				tree1 = repr(tree)
-				tree2 = repr(new_tree)
-				for index in range(max(len(tree1), len(tree2))):
-					if tree1[index] == tree2[index]:
-						sys.stdout.write(tree1[index])
-					else:
-						print "FAIL HERE"
-						print
-						print tree1[index:]
-						print
-						print tree2[index:]
-						break
-		# Now quit
-		#sys.exit(0)
-		return
-
-	except Exception, e:
-		# If there's an error then note it as appropriate
-		if keepnot:
-			notfile.write(name+'\n')
-			notfile.flush()
-		# And output more information if asked to
-		if do_print:
-			tree1 = repr(tree)
-			tree2 = repr(new_tree)
-			for index in range(max(len(tree1), len(tree2))):
-				if tree1[index] == tree2[index]:
-					sys.stdout.write(tree1[index])
-				else:
-					print "FAIL HERE"
-					print
-					print tree1[index:]
-					print
-					print tree2[index:]
-					break
-		# Now quit
-		#sys.exit(0)
-		return
-
-def no_args():
-	# Define the tests
-	[\
+			self.message = self.message + "OK"
+			self.result = True
+		return (self.result, self.message, self.deps)
+
+class FilterTest(Test):
+	"""Translates code to Diet Python with the extra filters from the modules
+	named in extras (as "-extra" does), and checks that the result is valid
+	Python of at most limit characters (if limit isn't None)."""
+
+	def __init__(self, name, code, extras, limit, deps):
+		Test.__init__(self, name, code, deps)
+		self.extras = extras
+		self.limit = limit
+
+	def run(self, grammar):
+		self.result = False
+		self.emit_time = None
+		self.round_trip_time = None
+		self.message = self.name.upper() + '\n=======================\n'
+		diet_python = import_diet()
+		# The filters are global, so we put back the ones we found
+		extra_filters = list(diet_python.extra_filters)
+		node_filters = dict([(cls, list(funcs)) for cls, funcs in
+			diet_python.node_filters.items()])
+		try:
+			for name in self.extras:
+				diet_python.add_extra(name)
+			start = time.time()
+			try:
+				translated = diet_python.translate(text=self.code)
+			except SystemExit:
+				translated = None
+			self.emit_time = time.time() - start
+		finally:
+			diet_python.extra_filters[:] = extra_filters
+			diet_python.node_filters.clear()
+			diet_python.node_filters.update(node_filters)
+		if translated is None:
+			self.message = self.message + """Error, unable to translate.\n""" + self.code
+			return (self.result, self.message, self.deps)
+		try:
+			compiler.parse(translated)
+		except SyntaxError:
+			self.message = self.message + """Error in translated code.\n""" + self.code + """\n\n""" + translated
+			return (self.result, self.message, self.deps)
+		if self.limit is not None and len(translated) > self.limit:
+			self.message = self.message + """Error, translated code is %d characters, more than %d.\n""" % (len(translated), self.limit) + self.code[:1000]
+			return (self.result, self.message, self.deps)
+		self.message = self.message + "OK"
+		self.result = True
+		return (self.result, self.message, self.deps)
+
+# Define the tests
+tests = [\
 	Test('Addition','1+2', ['Statement', 'Constant']), \
+	StreamTest('Streaming Overridden Rules', 'x = [1, 2.5, "a"] + f(3)',
+		['Addition', 'List', 'Function Call']), \
+	IncrementalTest('Incremental Edit', """x = 1
+def f(a):
+	return a + 1
+y = x * 2
+""", """x = 1
+def f(a):
+	return a - 1
+y = x * 2
+""", 2, 1, ['Function', 'Return', 'Addition', 'Subtraction',
+		'Multiplication', 'Assign Name']), \
+	IncrementalTest('Incremental Repeated Statements', """x = x + 1
+x = x + 1
+print x
+""", """x = x + 1
+print x
+x = x + 1
+x = x + 1
+""", 3, 1, ['Assign Name', 'Addition', 'Print New Line']), \
 	Test('And', '1 and True', ['Name', 'Constant']), \
+	# Each operand is printed into a string once, so the code grows in line
+	# with the chain (nesting the calls would double it for each operand)
+	FilterTest('Long Logic Chains', 'x = ' + ' or '.join(
+		['a%d' % n for n in range(300)]) + '\ny = ' + ' and '.join(
+		['(a%d and b or not c)' % n for n in range(100)]) + '\n',
+		['replace_logic'], 30000, ['And', 'Or', 'Not', 'Assign Name']), \
+	FilterTest('If Without Else', """if a:
+	f(x)
+if b:
+	f(y)
+elif c:
+	g(z)
+""", ['if_brancher'], None, ['If', 'Function Call']), \
 	Test('Assign Attribute', 'x.name = "ex"', ['Statement', 'Name']), \
 	Test('Assign List', '[a,b,c] = x', ['Statement', 'Name', 'Assign']), \
 	Test('Assign Name', """x = 10
@@ -192,7 +229,7 @@ assert x < 5, "x is not less than five"
 """, ['Compare', 'Constant']), \
 		Test('Assign', 'x = y = 10', ['Name', 'Constant', 'Statement']), \
 		Test('Augmenting Assign', 'x += 10', ['Statement', 'Name', 'Constant']), \
-		Test('Backquote', '`something`+`some_function(some_arg)`', ['Statement', 'Add']), \
+		Test('Backquote', '`something`+`some_function(some_arg)`', ['Statement', 'Addition']), \
 		Test('Bitwise And', 'a&b&(c&d)', ['Statement']), \
 		Test('Bitwise Or', 'a|b|(c|d)', ['Statement']), \
 		Test('Bitwise Exclusive Or', 'a^b^(c^d)', ['Statement']), \
@@ -349,7 +386,7 @@ lambda: 5*2
 lambda x, y: x*y
 filter(lambda x: x>5, range(10))
 lambda x, y, z=func(15, a=Person()): z/x**y
-lambda:'n/a'""", ['Statement', 'Call Function']), \
+lambda:'n/a'""", ['Statement', 'Function Call']), \
 		Test('Left Shift', 'x<<(y<<z)', ['Statement']), \
 		Test('List', """[1,2,3,[1,2,"s"]]
 x = []""", ['Statement']), \
@@ -457,7 +494,22 @@ with open('a', 'r') as f:
 		Test('Yield', 'yield x', ['Statement']) \
 	]
 
-def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None):
+# The results of do_file
+MATCH = 'match'
+PARSE_ERROR = 'parse-error'
+EMIT_ERROR = 'emit-error'
+REPARSE_ERROR = 'reparse-error'
+MISMATCH = 'mismatch'
+COMPARE_ERROR = 'compare-error'
+# Used by check_file for anything else going wrong (eg. hitting the recursion
+# limit)
+ERROR = 'error'
+
+def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None, info=None):
+	"""Checks that the code generated by grammar for the contents of testfile
+	parses to the same tree. Returns MATCH if it does, or one of the other
+	statuses below if it doesn't. If a dictionary is given as info then the
+	number of nodes in the tree is put in it as "nodes"."""
 	if notfile is None: keepnot = False
 	else: keepnot = True
 	if workfile is None: keepwork = False
@@ -467,6 +519,8 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 	try:
 		tree = base.parse('\n'.join([l.rstrip() for l in testfile.readlines()]))
 		testfile.close()
+		if info is not None:
+			info['nodes'] = sum(count_nodes(tree).values())
 	except Exception, e:
 		# If we fail then make a note of it as appropriate
 		if keepnot:
@@ -481,7 +535,7 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 			print "Error parsing input."
 		# Now quit (we can't go any further)
 		#sys.exit(0)
-		return
+		return PARSE_ERROR
 
 	# Attempt to generate code from the AST
 	try:
@@ -501,10 +555,10 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 				print "Error generating code"
 			# Now quit (we can't go any further)
 			#sys.exit(0)
-			return
+			return EMIT_ERROR
 		else:
-			print "Died at "+str(matcher.input.position)+" of "+str(matcher.input.data)
-			return
+			print "Died at "+str(matcher.input.position)+" of "+repr(matcher.input)
+			return EMIT_ERROR
 
 	# Attempt to parse the generated code into an AST
 	try:
@@ -524,12 +578,13 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 			print "Error parsing generated code"
 		# Now quit (we can't go any further)
 		#sys.exit(0)
-		return
+		return REPARSE_ERROR
 
 	# Attempt to equate the two trees
 	try:
 		# repr(tree1) should equal repr(tree2)
 		if repr(tree) == repr(new_tree):
+			status = MATCH
 			# If so then we have succeeded, note is as required
 			if keepwork:
 				workfile.write(name+'\n')
@@ -538,6 +593,7 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 				print "Match"
 		# Otherwise...
 		else:
+			status = MISMATCH
 			# If they're not equal then make a note as required
 			if keepnot:
 				notfile.write(name+'\n')
@@ -563,7 +619,7 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 						break
 		# Now quit
 		#sys.exit(0)
-		return
+		return status
 
 	except Exception, e:
 		# If there's an error then note it as appropriate
@@ -586,29 +642,245 @@ def do_file(grammar, testfile, name, do_print=False, notfile=None, workfile=None
 					break
 		# Now quit
 		#sys.exit(0)
-		return
-
-# Do imports first. These are expensive (especially base) so they'e conditional
+		return COMPARE_ERROR
+
+def unknown_deps(tests):
+	"""Returns (test, dependency) for each dependency which isn't the name
+	of one of tests."""
+	names = set([test.name for test in tests])
+	return [(test, dep) for test in tests for dep in test.deps
+		if dep not in names]
+
+def test_groups(tests):
+	"""Splits tests into groups which have to be run together because they
+	depend on each other (eg. Statement depends on Module, which depends on
+	Statement). Returns a list of the groups (each a list of tests) and a
+	list of the groups which each group depends on (as indices). Unknown
+	dependencies are ignored."""
+	by_name = dict([(test.name, test) for test in tests])
+	# Find every test each test depends on, directly or not
+	needs = {}
+	for test in tests:
+		found = set()
+		stack = [d for d in test.deps if d in by_name]
+		while stack:
+			name = stack.pop()
+			if name not in found:
+				found.add(name)
+				stack.extend([d for d in by_name[name].deps if d in by_name])
+		needs[test.name] = found
+	# Tests which depend on each other go in the same group
+	groups = []
+	group_of = {}
+	for test in tests:
+		if test.name in group_of:
+			continue
+		group = [t for t in tests if t is test or (t.name in needs[test.name]
+			and test.name in needs[t.name])]
+		for t in group:
+			group_of[t.name] = len(groups)
+		groups.append(group)
+	group_deps = []
+	for n, group in enumerate(groups):
+		deps = set([group_of[d] for t in group for d in t.deps if d in by_name])
+		deps.discard(n)
+		group_deps.append(sorted(deps))
+	return groups, group_deps
+
+def run_test(test):
+	"""Runs a test (in a worker process) and returns its results."""
+	try:
+		test.run(g)
+	except Exception, e:
+		test.result = False
+		test.message = test.name.upper() + \
+			'\n=======================\nError running test: ' + repr(e)
+	return (test.result, test.message, test.emit_time, test.round_trip_time)
+
+def run_tests(tests, jobs=None):
+	"""Runs the given tests on a pool of jobs processes, starting each group
+	of tests (see test_groups) once the groups it depends on have passed.
+	Tests depending on a group which didn't pass are skipped, and have their
+	"skipped" attribute set. Returns the tests in the order they finished."""
+	groups, group_deps = test_groups(tests)
+	# How many of each group's tests are still to finish
+	remaining = [len(group) for group in groups]
+	passed = [True] * len(groups)
+	started = [False] * len(groups)
+	finished = []
+	results = Queue.Queue()
+	if jobs == 1:
+		pool = None
+	else:
+		pool = Pool(jobs)
+
+	def submit(n):
+		started[n] = True
+		for test in groups[n]:
+			test.skipped = False
+			if pool is None:
+				results.put((n, test, run_test(test)))
+			else:
+				pool.apply_async(run_test, (test,),
+					callback=lambda r, n=n, test=test: results.put((n, test, r)))
+
+	def skip(n):
+		started[n] = True
+		for test in groups[n]:
+			test.skipped = True
+			results.put((n, test, None))
+
+	running = 0
+	while len(finished) < len(tests):
+		# Start (or skip) every group whose dependencies are finished
+		for n in range(len(groups)):
+			if started[n] or [d for d in group_deps[n] if remaining[d]]:
+				continue
+			if [d for d in group_deps[n] if not passed[d]]:
+				skip(n)
+			else:
+				submit(n)
+		n, test, result = results.get()
+		if result is not None:
+			test.result, test.message, test.emit_time, \
+				test.round_trip_time = result
+		if not test.result:
+			passed[n] = False
+		remaining[n] -= 1
+		finished.append(test)
+	if pool is not None:
+		pool.close()
+		pool.join()
+	return finished
+
+def milliseconds(seconds):
+	if seconds is None:
+		return '-'
+	return '%.2f' % (seconds * 1000)
+
+def find_corpus(directory):
+	"""Returns the paths of the Python files under directory, in order."""
+	found = []
+	for root, dirs, files in os.walk(directory):
+		dirs.sort()
+		found.extend([os.path.join(root, f) for f in sorted(files)
+			if f.endswith('.py')])
+	return found
+
+def check_file(path):
+	"""Does the round trip of do_file for the file at path (in a worker
+	process). Returns (path, status, number of nodes, seconds taken)."""
+	info = {'nodes':0}
+	start = time.time()
+	try:
+		status = do_file(g, open(path, 'r'), path, info=info)
+	except Exception:
+		status = ERROR
+	return (path, status, info['nodes'], time.time() - start)
+
+def read_checkpoint(path):
+	"""Returns the results stored in the checkpoint file at path, as a
+	dictionary of file paths to (status, nodes, seconds)."""
+	results = {}
+	if not os.path.exists(path):
+		return results
+	for line in open(path, 'r'):
+		# The last line might be half-written if we were interrupted
+		fields = line.rstrip('\n').split('\t', 3)
+		if not line.endswith('\n') or len(fields) != 4:
+			continue
+		status, nodes, seconds, name = fields
+		results[name] = (status, int(nodes), float(seconds))
+	return results
+
+def check_corpus(paths, jobs=None, checkpoint=None, notfile=None,
+	workfile=None):
+	"""Runs check_file on each of paths with a pool of jobs processes.
+
+	If a checkpoint filename is given then each result is appended to it as
+	soon as it's known, and files which already have a result there aren't
+	checked again, so an interrupted run can be carried on by running it
+	again. The names of files which fail (succeed) are written to notfile
+	(workfile), if they're given.
+
+	Returns a dictionary of paths to (status, nodes, seconds), along with the
+	number of files checked, the nodes they contain and the time taken by
+	this run."""
+	if checkpoint is None:
+		results = {}
+	else:
+		results = read_checkpoint(checkpoint)
+		out = open(checkpoint, 'a')
+	todo = [path for path in paths if path not in results]
+	start = time.time()
+	nodes = 0
+	if jobs == 1:
+		checked = (check_file(path) for path in todo)
+	else:
+		pool = Pool(jobs)
+		checked = pool.imap_unordered(check_file, todo)
+	try:
+		for n in range(len(todo)):
+			if jobs == 1:
+				path, status, count, seconds = checked.next()
+			else:
+				# Waiting with a timeout lets Ctrl-C through
+				path, status, count, seconds = checked.next(1e6)
+			results[path] = (status, count, seconds)
+			nodes += count
+			if checkpoint is not None:
+				out.write('%s\t%d\t%f\t%s\n' % (status, count, seconds, path))
+				out.flush()
+			if status != MATCH and notfile is not None:
+				notfile.write(path+'\n')
+				notfile.flush()
+			if status == MATCH and workfile is not None:
+				workfile.write(path+'\n')
+				workfile.flush()
+			# Give a progress indicator (the number remaining)
+			sys.stderr.write(str(len(todo)-n-1)+'\n')
+			sys.stderr.flush()
+	finally:
+		if jobs != 1:
+			pool.terminate()
+			pool.join()
+		if checkpoint is not None:
+			out.close()
+	return results, len(todo), nodes, time.time() - start
+
+# Do imports first. These are expensive (especially base)
 are_imported = __name__ != '__main__'
 no_arguments = len(sys.argv) == 1
 file_of_files = "-f" in sys.argv
-if are_imported or no_arguments or not file_of_files:
-	import base
-	from base import grammar as g
-	from pymeta.runtime import ParseError
-	import compiler
-	try:
-		import psyco
-		psyco.full()
-	except:
-		pass
+corpus = "-corpus" in sys.argv
+import base
+from base import grammar as g
+from pymeta.runtime import ParseError
+import compiler
+try:
+	import psyco
+	psyco.full()
+except:
+	pass
+
+# "-jobs N" runs the tests on N processes (by default, one per CPU)
+jobs = None
+if '-jobs' in sys.argv:
+	jobs = int(sys.argv[sys.argv.index('-jobs')+1])
+	no_arguments = len(sys.argv) == 3
 
 # Run the following if we've been imported or if we've not been given any
 # arguments
 if are_imported or no_arguments:
-	# Run the tests
-	for test in tests:
-		test.run(g)
+	for test, dep in unknown_deps(tests):
+		sys.stderr.write('Warning: '+test.name+' depends on unknown test ' + \
+			dep+'\n')
+
+	# Run the tests, in order of their dependencies. We don't start any
+	# processes when we're being imported.
+	if are_imported:
+		jobs = 1
+	run_tests(tests, jobs)
 
 	# These will store our results
 	failed = []
@@ -618,24 +890,13 @@ if are_imported or no_arguments:
 	# Go through each test
 	for test in tests:
 		# Assign it to the relevant list based on its result
-		if not test.result:
+		if test.skipped:
+			unknown.append(test)
+		elif not test.result:
 			failed.append(test)
 		else:
 			succeeded.append(test)
 
-	# Now go through (a copy of) each failed test
-	for test in failed[:]:
-		# See if any features it relies on also failed
-		for dep in test.deps:
-			for test2 in failed[:]:
-				if test2.name == dep:
-					# If so then move it to the "unknown" list
-					try:
-						failed.remove(test)
-						unknown.append(test)
-					except ValueError:
-						pass
-
 	# Now our "succeeded" list will contain every successful feature
 	# The "failed" list will contain those features which don't work
 	# The "unknown" list will have those with no information (ie.
@@ -651,45 +912,63 @@ if are_imported or no_arguments:
 		for f in failed:
 			print f.message
 
+		# Show how long each test took, slowest first
+		print
+		print '%-30s %8s %12s %12s' % ('test', 'result', 'emit ms',
+			'round trip ms')
+		for test in sorted(tests, key=lambda t: -(t.emit_time or 0)):
+			if test.skipped:
+				result = 'skipped'
+			elif test.result:
+				result = 'ok'
+			else:
+				result = 'FAILED'
+			print '%-30s %8s %12s %12s' % (test.name, result,
+				milliseconds(test.emit_time),
+				milliseconds(test.round_trip_time))
+
 # If we've got arguments then run the following instead
 else:
-	# A "-f" argument means "test the files named in this file"
-	if file_of_files:
+	# A "-f" argument means "test the files named in this file", and
+	# "-corpus" means "test the Python files in this directory"
+	if file_of_files or corpus:
 
-		# Make some defaults
-		keepnot = False
-		keepwork = False
-
-		# See if we've been given files to write to
-		# "-w" should be followed by a file to append successes to
+		# See if we've been given files to append successes ("-w") and
+		# failures ("-n") to, or a checkpoint file to carry on from
+		workfile = None
+		notfile = None
+		checkpoint = None
 		if '-w' in sys.argv:
-			workfile = sys.argv[sys.argv.index('-w')+1]
-			keepwork = True
-		else: workfile = None
-		# "-n" should be followed by a file to append failures to
+			workfile = open(sys.argv[sys.argv.index('-w')+1], 'a')
 		if '-n' in sys.argv:
-			notfile = sys.argv[sys.argv.index('-n')+1]
-			keepnot = True
-		else: notfile = None
+			notfile = open(sys.argv[sys.argv.index('-n')+1], 'a')
+		if '-checkpoint' in sys.argv:
+			checkpoint = sys.argv[sys.argv.index('-checkpoint')+1]
 
 		# Generate the filenames we're to test
-		infile = open(sys.argv[sys.argv.index('-f')+1], 'r')
-		lines = [line.strip() for line in infile.readlines()]
-
-		# Test each file by calling do_file.
-		# We could easily do testing concurrently, but I only have
-		# one processor, so haven't bothered doing it yet).
-		for num, line in enumerate(lines):
-			arguments = ['python', 'tests.py', line]
-			if keepnot:
-				arguments.extend(['-n', notfile])
-			if keepwork:
-				arguments.extend(['-w', workfile])
-			call(arguments)
-			#do_file(open(line, 'r'), line, False, open(notfile, 'a'), open(workfile, 'a'))
-			# Give a progress indicator (the number remaining)
-			sys.stderr.write(str(len(lines)-num)+'\n')
-			sys.stderr.flush()
+		if corpus:
+			paths = find_corpus(sys.argv[sys.argv.index('-corpus')+1])
+		else:
+			infile = open(sys.argv[sys.argv.index('-f')+1], 'r')
+			paths = [line.strip() for line in infile.readlines()
+				if line.strip()]
+
+		results, checked, nodes, taken = check_corpus(paths, jobs,
+			checkpoint, notfile, workfile)
+		failures = sorted([(results[path][0], path) for path in paths
+			if results[path][0] != MATCH])
+		print '%d files, %d matched, %d failed' % (len(paths),
+			len(paths) - len(failures), len(failures))
+		print 'Checked %d files (%d nodes) in %.2f seconds: %.2f files/second, ' \
+			'%.0f nodes/second' % (checked, nodes, taken,
+			checked / max(taken, 1e-9), nodes / max(taken, 1e-9))
+		if checked < len(paths):
+			print '%d files were already in %s' % (len(paths) - checked,
+				checkpoint)
+		for status, path in failures:
+			print status + '\t' + path
+		if failures:
+			sys.exit(1)
 
 	# If we have no list of files, we should use the first argument
 	else: